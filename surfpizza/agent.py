@@ -2,22 +2,47 @@ import logging
 import os
 import time
 import traceback
-from typing import Final, List, Optional, Tuple, Type
+from contextlib import ExitStack
+from typing import Any, Final, List, Optional, Tuple, Type
 
+import requests
 from agentdesk.device_v1 import Desktop
 from devicebay import Device
+from mllm import ChatResponse
 from pydantic import BaseModel
 from rich.console import Console
 from rich.json import JSON
-from skillpacks import EnvState
 from skillpacks.server.models import V1ActionSelection
 from surfkit.agent import TaskAgent
 from taskara import Task, TaskStatus
-from tenacity import before_sleep_log, retry, stop_after_attempt
+from tenacity import (
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
 from threadmem import RoleMessage, RoleThread
 from toolfuse.util import AgentUtils
 
-from .tool import SemanticDesktop, router
+from . import metrics
+from .cancel import CancelWatcher, TaskCancelled
+from .history import StepHistory
+from .pool import WarmDesktop, desktop_pool
+from .prefetch import ScreenshotPrefetcher
+from .recorder import ActionRecorder
+from .retry import (
+    ActionError,
+    ErrorKind,
+    ParseError,
+    classify_error,
+    is_transient,
+    record_retry,
+    retry_stats,
+)
+from .startup import startup_timer
+from .tool import SemanticDesktop, get_router
+from .trace import TraceRecorder
+from .workers import get_image_workers
 
 logging.basicConfig(level=logging.INFO)
 logger: Final = logging.getLogger(__name__)
@@ -25,6 +50,17 @@ logger.setLevel(int(os.getenv("LOG_LEVEL", str(logging.DEBUG))))
 
 console = Console(force_terminal=True)
 
+# Desktop actions that aren't useful to the model, click_object replaces them
+EXCLUDED_ACTIONS: Final = [
+    "move_mouse",
+    "click",
+    "drag_mouse",
+    "mouse_coordinates",
+    "take_screenshot",
+    "open_url",
+    "double_click",
+]
+
 
 class SurfPizzaConfig(BaseModel):
     pass
@@ -62,8 +98,91 @@ class SurfPizza(TaskAgent):
         if not isinstance(device, Desktop):
             raise ValueError("Only desktop devices supported")
 
+        # Everything acquired for the task is released in reverse order, however far
+        # the setup got before failing
+        with ExitStack() as stack:
+            # Reuse the setup from earlier tasks on this desktop if we have it, and an
+            # idle session to it, tasks running at the same time each get their own
+            warm = desktop_pool.get(device)
+            stack.callback(desktop_pool.release, warm)
+            session = warm.acquire_session()
+            stack.callback(warm.release_session, session)
+
+            # Buffer prompt and action uploads so they don't block the steps
+            recorder = ActionRecorder(
+                task,
+                batch_size=int(os.getenv("RECORDER_BATCH_SIZE", 8)),
+                flush_interval=float(os.getenv("RECORDER_FLUSH_INTERVAL", 2.0)),
+            )
+            stack.callback(recorder.close)
+            # Watch for the task being cancelled so steps don't have to fetch it
+            cancel = CancelWatcher(
+                task,
+                interval=float(os.getenv("CANCEL_POLL_INTERVAL", 1.0)),
+                max_interval=float(os.getenv("CANCEL_POLL_MAX_INTERVAL", 5.0)),
+            ).start()
+            stack.callback(cancel.stop)
+            # Record what the run takes from the desktop and the model so it can be replayed
+            trace = None
+            trace_dir = os.getenv("TRACE_DIR")
+            if trace_dir:
+                trace = TraceRecorder(os.path.join(trace_dir, task.id))
+                stack.callback(
+                    lambda: trace.close(task.status.value if task.status else None)  # type: ignore
+                )
+                trace.start(task.id, task.description, info=warm.get_info(device))
+            # Capture screenshots ahead of the steps that use them
+            frames = ScreenshotPrefetcher(
+                device,
+                settle=float(os.getenv("STEP_SETTLE_SECONDS", 2.0)),
+                workers=get_image_workers(),
+                trace=trace,
+            )
+            stack.callback(frames.close)
+
+            metrics.active_tasks.inc()
+            stack.callback(metrics.active_tasks.dec)
+            return self._solve_task(
+                task, device, warm, session, recorder, cancel, frames, trace, max_steps
+            )
+
+    def _solve_task(
+        self,
+        task: Task,
+        device: Desktop,
+        warm: WarmDesktop,
+        session: requests.Session,
+        recorder: ActionRecorder,
+        cancel: CancelWatcher,
+        frames: ScreenshotPrefetcher,
+        trace: Optional[TraceRecorder],
+        max_steps: int,
+    ) -> Task:
+        """Run the steps of a task, see `solve_task`
+
+        Args:
+            task (Task): Task to solve.
+            device (Desktop): Desktop to perform the task on.
+            warm (WarmDesktop): Warm setup state for the desktop.
+            session (requests.Session): HTTP session to the desktop, checked out for this task.
+            recorder (ActionRecorder): Recorder to buffer uploads in.
+            cancel (CancelWatcher): Watcher for the task being cancelled.
+            frames (ScreenshotPrefetcher): Prefetcher for the screenshots.
+            trace (Optional[TraceRecorder]): Trace to record the run in.
+            max_steps (int): Max steps to try and solve.
+
+        Returns:
+            Task: The task
+        """
         # Wrap the standard desktop in our special tool
-        semdesk = SemanticDesktop(task=task, desktop=device)
+        semdesk = SemanticDesktop(
+            task=task,
+            desktop=device,
+            session=session,
+            recorder=recorder,
+            cancel=cancel,
+            trace=trace,
+        )
 
         # Add standard agent utils to the device
         semdesk.merge(AgentUtils())
@@ -77,48 +196,83 @@ class SurfPizza(TaskAgent):
             console.print("waiting for browser to open...", style="blue")
             time.sleep(5)
 
+        # Capture the first screenshot while the rest of the setup happens, after
+        # that each one is captured once the screen settles after an action
+        frames.schedule(delay=0)
+
         # Get info about the desktop
-        info = semdesk.desktop.info()
+        info = warm.get_info(semdesk.desktop)
         screen_size = info["screen_size"]
         console.print(f"Desktop info: {screen_size}")
 
         # Get the json schema for the tools, excluding actions that aren't useful
-        tools = semdesk.json_schema(
-            exclude_names=[
-                "move_mouse",
-                "click",
-                "drag_mouse",
-                "mouse_coordinates",
-                "take_screenshot",
-                "open_url",
-                "double_click",
-            ]
+        tools = warm.get_tools(
+            lambda: semdesk.json_schema(exclude_names=EXCLUDED_ACTIONS)
         )
         console.print("tools: ", style="purple")
         console.print(JSON.from_data(tools))
 
-        # Create our thread and start with a system prompt
-        thread = RoleThread()
-        thread.post(
-            role="user",
-            msg=(
-                "You are an AI assistant which uses a devices to accomplish tasks. "
-                f"Your current task is {task.description}, and your available tools are {tools} "
-                "For each screenshot I will send you please return the result chosen action as  "
-                f"raw JSON adhearing to the schema {V1ActionSelection.model_json_schema()} "
-                "Let me know when you are ready and I'll send you the first screenshot"
-            ),
+        # Create our thread and start with a system prompt, the prompt doesn't depend
+        # on the task so the handshake is only done once per desktop
+        system_prompt = (
+            "You are an AI assistant which uses a devices to accomplish tasks. "
+            f"Your available tools are {tools} "
+            "For each screenshot I will send you please return the result chosen action as  "
+            f"raw JSON adhearing to the schema {V1ActionSelection.model_json_schema()} "
+            "Let me know when you are ready and I'll send you your task and the first screenshot"
         )
-        response = router.chat(thread, namespace="system")
-        console.print(f"system prompt response: {response}", style="blue")
-        thread.add_msg(response.msg)
+
+        def handshake(prompt: str) -> RoleMessage:
+            _thread = RoleThread()
+            _thread.post(role="user", msg=prompt)
+            with metrics.llm_call("system"):
+                response = semdesk.router.chat(_thread, namespace="system")
+            console.print(f"system prompt response: {response}", style="blue")
+            return response.msg
+
+        # The prefix of every action request, keep it unchanged between steps so
+        # provider prompt caching applies
+        history = StepHistory(
+            prefix=[
+                RoleMessage(role="user", text=system_prompt),
+                warm.get_system_response(system_prompt, handshake),
+                RoleMessage(
+                    role="user", text=f"Your current task is {task.description}"
+                ),
+            ],
+            max_turns=int(os.getenv("HISTORY_MAX_TURNS", 10)),
+            keep_turns=int(os.getenv("HISTORY_KEEP_TURNS", 5)),
+            summary_steps=int(os.getenv("HISTORY_SUMMARY_STEPS", 20)),
+            action_chars=int(os.getenv("HISTORY_ACTION_CHARS", 200)),
+        )
+
+        # A desktop that keeps failing every action is broken, don't spend the rest
+        # of the steps on it
+        max_action_errors = int(os.getenv("MAX_ACTION_ERRORS", 3))
+        action_errors = 0
 
         # Loop to run actions
         for i in range(max_steps):
             console.print(f"-------step {i + 1}", style="green")
 
             try:
-                thread, done = self.take_action(semdesk, task, thread)
+                done = self.take_action(
+                    semdesk, task, history, recorder, cancel, frames
+                )
+                action_errors = 0
+            except ActionError as e:
+                action_errors += 1
+                if action_errors < max_action_errors:
+                    continue
+                console.print(f"Giving up after {action_errors} errors", style="red")
+                task.status = TaskStatus.FAILED
+                task.error = str(e)
+                task.save()
+                task.post_message(
+                    "assistant",
+                    f"❗ Giving up after {action_errors} actions in a row failed: {e}",
+                )
+                return task
             except Exception as e:
                 console.print(f"Error: {e}", style="red")
                 task.status = TaskStatus.FAILED
@@ -131,8 +285,6 @@ class SurfPizza(TaskAgent):
                 console.print("task is done", style="green")
                 return task
 
-            time.sleep(2)
-
         task.status = TaskStatus.FAILED
         task.save()
         task.post_message("assistant", "❗ Max steps reached without solving task")
@@ -140,100 +292,81 @@ class SurfPizza(TaskAgent):
 
         return task
 
+    # Only transport errors retry the whole step, parse errors are re-asked with the
+    # same screenshot in _select_action and action errors never re-query the model
     @retry(
+        retry=retry_if_exception(is_transient),
+        wait=wait_random_exponential(multiplier=1, max=30),
         stop=stop_after_attempt(5),
-        before_sleep=before_sleep_log(logger, logging.INFO),
+        before_sleep=record_retry,
+        reraise=True,
     )
     def take_action(
         self,
         semdesk: SemanticDesktop,
         task: Task,
-        thread: RoleThread,
-    ) -> Tuple[RoleThread, bool]:
+        history: StepHistory,
+        recorder: ActionRecorder,
+        cancel: CancelWatcher,
+        frames: ScreenshotPrefetcher,
+    ) -> bool:
         """Take an action
 
         Args:
             desktop (SemanticDesktop): Desktop to use
             task (str): Task to accomplish
-            thread (RoleThread): Role thread for the task
+            history (StepHistory): History of the conversation for the task
+            recorder (ActionRecorder): Recorder to buffer uploads in
+            cancel (CancelWatcher): Watcher for the task being cancelled
+            frames (ScreenshotPrefetcher): Prefetcher for the screenshots
+
+        Raises:
+            ActionError: If the selected action failed, once the failure is noted in the history for the
+                next step
 
         Returns:
             bool: Whether the task is complete
         """
         try:
             # Check to see if the task has been cancelled
-            if task.remote:
-                task.refresh()
-            console.print("task status: ", task.status.value)
-            if (
-                task.status == TaskStatus.CANCELING
-                or task.status == TaskStatus.CANCELED
-            ):
-                console.print(f"task is {task.status}", style="red")
-                if task.status == TaskStatus.CANCELING:
-                    task.status = TaskStatus.CANCELED
-                    task.save()
-                return thread, True
+            console.print("task status: ", cancel.status.value)
+            if cancel.cancelled:
+                return self._cancel_task(task, cancel)
 
             console.print("taking action...", style="white")
+            metrics.steps.inc()
 
-            # Create a copy of the thread, and remove old images
-            _thread = thread.copy()
-            _thread.remove_images()
+            # Get the screenshot of the desktop, usually captured while the last step
+            # finished, and post a message with it
+            frame = frames.get()
+            screenshot_img = frame.image
+            semdesk.post_debug("current image", [frame.b64])
 
-            # Take a screenshot of the desktop and post a message with it
-            screenshot_img = semdesk.desktop.take_screenshots()[0]
-            console.print(f"screenshot img type: {type(screenshot_img)}")
-            task.post_message(
-                "assistant",
-                "current image",
-                images=[screenshot_img],
-                thread="debug",
-            )
-
-            # Get the current mouse coordinates
-            x, y = semdesk.desktop.mouse_coordinates()
+            # The mouse coordinates were read along with the screenshot
+            x, y = frame.mouse
             console.print(f"mouse coordinates: ({x}, {y})", style="white")
 
             # Craft the message asking the MLLM for an action
-            msg = RoleMessage(
-                role="user",
-                text=(
-                    "Here is a screenshot of the current desktop, please select an action from the provided schema."
-                    "Please return just the raw JSON"
-                ),
-                images=[screenshot_img],
+            request_text = (
+                "Here is a screenshot of the current desktop, please select an action from the provided schema."
+                "Please return just the raw JSON"
             )
-            _thread.add_msg(msg)
+            msg = RoleMessage(role="user", text=request_text, images=[frame.b64])
 
             # Make the action selection
-            response = router.chat(
-                _thread,
-                namespace="action",
-                expect=V1ActionSelection,
-                agent_id=self.name(),
-            )
-            task.add_prompt(response.prompt)
-
-            try:
-                # Post to the user letting them know what the modle selected
-                selection = response.parsed
-                if not selection:
-                    raise ValueError("No action selection parsed")
+            response, selection = self._select_action(semdesk, history, msg)
+            recorder.add_prompt(response.prompt)
 
-                task.post_message("assistant", f"👁️ {selection.observation}")
-                task.post_message("assistant", f"💡 {selection.reason}")
-                console.print("action selection: ", style="white")
-                console.print(JSON.from_data(selection.model_dump()))
+            # Post to the user letting them know what the modle selected
+            task.post_message("assistant", f"👁️ {selection.observation}")
+            task.post_message("assistant", f"💡 {selection.reason}")
+            console.print("action selection: ", style="white")
+            console.print(JSON.from_data(selection.model_dump()))
 
-                task.post_message(
-                    "assistant",
-                    f"▶️ Taking action '{selection.action.name}' with parameters: {selection.action.parameters}",
-                )
-
-            except Exception as e:
-                console.print(f"Response failed to parse: {e}", style="red")
-                raise
+            task.post_message(
+                "assistant",
+                f"▶️ Taking action '{selection.action.name}' with parameters: {selection.action.parameters}",
+            )
 
             # The agent will return 'result' if it believes it's finished
             if selection.action.name == "result":
@@ -245,20 +378,27 @@ class SurfPizza(TaskAgent):
                 )
                 task.status = TaskStatus.FINISHED
                 task.save()
-                return _thread, True
+                return True
 
-            # Find the selected action in the tool
-            action = semdesk.find_action(selection.action.name)
-            console.print(f"found action: {action}", style="blue")
-            if not action:
-                console.print(f"action returned not found: {selection.action.name}")
-                raise SystemError("action not found")
-
-            # Take the selected action
+            # Take the selected action, if it fails let the model know in the next step
+            # rather than asking it again for this screenshot
+            cancel.check()
             try:
-                action_response = semdesk.use(action, **selection.action.parameters)
-            except Exception as e:
-                raise ValueError(f"Trouble using action: {e}")
+                action_response = self._use_action(semdesk, selection)
+            except ActionError as e:
+                frames.schedule()
+                console.print(f"Error using action: {e}", style="red")
+                task.post_message("assistant", f"⚠️ Error taking action: {e}")
+                history.add_turn(
+                    request_text,
+                    response.msg,
+                    f"{selection.action.name} {selection.action.parameters} which failed",
+                    note=f"Taking that action failed with the error: {e}",
+                )
+                raise
+
+            # Start capturing the next screenshot while this step is posted and recorded
+            frames.schedule()
 
             console.print(f"action output: {action_response}", style="blue")
             if action_response:
@@ -267,8 +407,8 @@ class SurfPizza(TaskAgent):
                 )
 
             # Record the action for feedback and tuning
-            task.record_action(
-                state=EnvState(images=[screenshot_img]),
+            recorder.record_action(
+                images=[screenshot_img],
                 prompt=response.prompt,
                 action=selection.action,
                 tool=semdesk.ref(),
@@ -277,15 +417,152 @@ class SurfPizza(TaskAgent):
                 model=response.model,
             )
 
-            _thread.add_msg(response.msg)
-            return _thread, False
+            history.add_turn(
+                request_text,
+                response.msg,
+                f"{selection.action.name} {selection.action.parameters}",
+            )
+            return False
+
+        except TaskCancelled:
+            return self._cancel_task(task, cancel)
+
+        except ActionError:
+            raise
 
         except Exception as e:
             console.print("Exception taking action: ", e)
             traceback.print_exc()
-            task.post_message("assistant", f"⚠️ Error taking action: {e} -- retrying...")
+            if is_transient(e):
+                task.post_message(
+                    "assistant", f"⚠️ Error taking action: {e} -- retrying..."
+                )
             raise e
 
+    def _cancel_task(self, task: Task, cancel: CancelWatcher) -> bool:
+        """Stop working on a cancelled task, marking it cancelled if it was cancelling
+
+        Args:
+            task (Task): The task
+            cancel (CancelWatcher): Watcher for the task being cancelled
+
+        Returns:
+            bool: Always True, the task is done
+        """
+        status = cancel.status
+        console.print(f"task is {status}", style="red")
+        if status == TaskStatus.CANCELING:
+            task.status = TaskStatus.CANCELED
+            task.save()
+        return True
+
+    def _select_action(
+        self,
+        semdesk: SemanticDesktop,
+        history: StepHistory,
+        msg: RoleMessage,
+    ) -> Tuple[ChatResponse, V1ActionSelection]:
+        """Ask the model to select an action, re-asking with the same screenshot if the response can't be used
+
+        Args:
+            semdesk (SemanticDesktop): Desktop to use
+            history (StepHistory): History of the conversation for the task
+            msg (RoleMessage): Message with the current screenshot
+
+        Returns:
+            Tuple[ChatResponse, V1ActionSelection]: The response and the selected action
+        """
+        max_retries = int(os.getenv("PARSE_RETRIES", 2))
+        thread = history.build(msg)
+
+        for attempt in range(max_retries + 1):
+            start = time.time()
+            try:
+                # We handle parse retries here, with feedback to the model, rather
+                # than have the router resend the same thread
+                with metrics.llm_call("action"):
+                    response = semdesk.router.chat(
+                        thread,
+                        namespace="action",
+                        expect=V1ActionSelection,
+                        agent_id=self.name(),
+                        retries=1,
+                    )
+                selection = response.parsed
+                if not selection:
+                    raise ParseError("No action selection parsed")
+
+                name = selection.action.name
+                if name != "result" and not semdesk.find_action(name):
+                    raise ParseError(f"action '{name}' not found")
+
+                history.record_usage(thread, response.tokens_request)
+                return response, selection
+
+            except Exception as e:
+                if classify_error(e) != ErrorKind.PARSE or attempt == max_retries:
+                    raise
+
+                console.print(f"Response failed to parse: {e}", style="red")
+                retry_stats.record(ErrorKind.PARSE, time.time() - start, llm_calls=1)
+                thread = history.build(
+                    msg,
+                    RoleMessage(
+                        role="user",
+                        text=(
+                            f"Your response could not be used: {e}. Please select an action from the "
+                            "provided schema and return just the raw JSON"
+                        ),
+                    ),
+                )
+
+        raise ParseError("No action selection parsed")
+
+    def _use_action(
+        self, semdesk: SemanticDesktop, selection: V1ActionSelection
+    ) -> Any:
+        """Take the selected action, the desktop retries its own input on transport errors
+
+        Args:
+            semdesk (SemanticDesktop): Desktop to use
+            selection (V1ActionSelection): The selected action
+
+        Raises:
+            ActionError: If the action fails, including once its retries are used up, so the step
+                isn't taken again with a new screenshot and action selection
+
+        Returns:
+            Any: The action result
+        """
+        action = semdesk.find_action(selection.action.name)
+        console.print(f"found action: {action}", style="blue")
+        if not action:
+            raise ActionError(f"action '{selection.action.name}' not found")
+
+        start = time.perf_counter()
+        try:
+            result = semdesk.use(action, **selection.action.parameters)
+        except TaskCancelled:
+            raise
+        except Exception as e:
+            if semdesk.trace:
+                semdesk.trace.action(
+                    selection.action.name,
+                    selection.action.parameters,
+                    seconds=time.perf_counter() - start,
+                    error=str(e),
+                )
+            raise ActionError(f"Trouble using action: {e}") from e
+
+        if semdesk.trace:
+            semdesk.trace.action(
+                selection.action.name,
+                selection.action.parameters,
+                result,
+                seconds=time.perf_counter() - start,
+            )
+        return result
+
     @classmethod
     def supported_devices(cls) -> List[Type[Device]]:
         """Devices this agent supports
@@ -328,6 +605,8 @@ class SurfPizza(TaskAgent):
     @classmethod
     def init(cls) -> None:
         """Initialize the agent class"""
+        with startup_timer.phase("init_router"):
+            get_router()
         return
 
 
@@ -0,0 +1,117 @@
+import logging
+import os
+import threading
+from typing import Optional
+
+from taskara import Task, TaskStatus
+
+logger = logging.getLogger(__name__)
+logger.setLevel(int(os.getenv("LOG_LEVEL", logging.DEBUG)))
+
+CANCEL_STATUSES = {TaskStatus.CANCELING, TaskStatus.CANCELED}
+
+
+class TaskCancelled(Exception):
+    """The task was cancelled while it was being worked on"""
+
+
+class CancelWatcher:
+    """
+    Watches a task for cancellation in the background.
+
+    Remote tasks are polled for their status alone rather than refreshed, a refresh also fetches the
+    episode and every prompt, and the interval backs off while the status doesn't change. Once the task
+    is seen cancelling an in-process flag is set, so the step loop and long running actions can check
+    for cancellation without a round trip.
+    """
+
+    def __init__(
+        self, task: Task, interval: float = 1.0, max_interval: float = 5.0
+    ) -> None:
+        """
+        Initialize the watcher.
+
+        Args:
+            task (Task): Task to watch.
+            interval (float, optional): Seconds between the first polls. Defaults to 1.0.
+            max_interval (float, optional): Max seconds between polls as it backs off. Defaults to 5.0.
+        """
+        self.task = task
+        self.interval = interval
+        self.max_interval = max_interval
+        self.polls = 0
+
+        self._status: Optional[TaskStatus] = None
+        self._cancelled = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "CancelWatcher":
+        """Start polling, local tasks are only checked in-process
+
+        Returns:
+            CancelWatcher: The watcher
+        """
+        if self.task.remote and self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name=f"cancel-{self.task.id}", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop polling"""
+        self._stopped.set()
+        if self._thread:
+            self._thread.join(timeout=1)
+
+    @property
+    def status(self) -> TaskStatus:
+        """Latest known status of the task"""
+        return self._status if self._status else self.task.status
+
+    @property
+    def cancelled(self) -> bool:
+        """Whether the task has been cancelled"""
+        return self._cancelled.is_set() or self.task.status in CANCEL_STATUSES
+
+    def check(self) -> None:
+        """Stop work on a cancelled task
+
+        Raises:
+            TaskCancelled: If the task has been cancelled
+        """
+        if self.cancelled:
+            raise TaskCancelled(f"task {self.task.id} is {self.status.value}")
+
+    def _poll(self) -> TaskStatus:
+        data = self.task._remote_request(
+            self.task.remote,  # type: ignore
+            "GET",
+            f"/v1/tasks/{self.task.id}",
+            auth_token=self.task.auth_token,
+        )
+        self.polls += 1
+        return TaskStatus(data.get("status") or "defined")
+
+    def _run(self) -> None:
+        interval = self.interval
+        while not self._stopped.wait(interval):
+            try:
+                status = self._poll()
+            except Exception as e:
+                logger.warning(f"failed to poll status of task {self.task.id}: {e}")
+                interval = min(interval * 2, self.max_interval)
+                continue
+
+            if status in CANCEL_STATUSES:
+                logger.info(f"task {self.task.id} is {status.value}")
+                self._status = status
+                self._cancelled.set()
+                return
+
+            if status == self._status:
+                interval = min(interval * 1.5, self.max_interval)
+            else:
+                interval = self.interval
+            self._status = status
@@ -0,0 +1,225 @@
+import logging
+import os
+import time
+import uuid
+from dataclasses import dataclass
+from typing import List, Optional
+
+from threadmem import RoleMessage, RoleThread
+from threadmem.server.models import V1RoleThread
+
+logger = logging.getLogger(__name__)
+logger.setLevel(int(os.getenv("LOG_LEVEL", logging.DEBUG)))
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count for text, at about four characters per token
+
+    Args:
+        text (str): The text
+
+    Returns:
+        int: Estimated tokens
+    """
+    return (len(text) + 3) // 4
+
+
+@dataclass
+class Turn:
+    """A completed step of the conversation"""
+
+    step: int
+    request: RoleMessage
+    response: RoleMessage
+    action: str
+    note: Optional[RoleMessage] = None
+
+    def messages(self) -> List[RoleMessage]:
+        out = [self.request, self.response]
+        if self.note:
+            out.append(self.note)
+        return out
+
+
+@dataclass
+class StepUsage:
+    """Tokens sent for one action selection request"""
+
+    step: int
+    sent_tokens: int
+    prefix_tokens: int
+    new_tokens: int
+    reported_tokens: Optional[int] = None
+
+
+class StepHistory:
+    """
+    The action selection conversation, laid out so its prefix stays byte-identical between steps.
+
+    Requests are made of a static prefix (the system prompt, the model's reply and the task), a summary
+    of the turns that have been dropped, the most recent turns with their screenshots removed, and the
+    new screenshot. Old turns are only dropped in chunks, once there are more than `max_turns` the
+    oldest are folded into the summary until `keep_turns` remain, so between trims every request starts
+    with exactly the same messages as the one before and provider prompt caching can apply. The summary
+    lists the last `summary_steps` dropped actions, each cut to `action_chars` characters, and only
+    counts the ones before them, so the size of each request stays bounded no matter how many steps the
+    task takes.
+
+    The messages to send are kept in an append-only list of image-free messages, so building a request
+    adds them and the new screenshot message to a fresh thread rather than copying the thread and
+    stripping its images, the list is only rebuilt when the window is trimmed.
+    """
+
+    def __init__(
+        self,
+        prefix: List[RoleMessage],
+        max_turns: int = 10,
+        keep_turns: int = 5,
+        summary_steps: int = 20,
+        action_chars: int = 200,
+    ) -> None:
+        """
+        Initialize the history.
+
+        Args:
+            prefix (List[RoleMessage]): Messages every request starts with.
+            max_turns (int, optional): Max number of recent turns to send. Defaults to 10.
+            keep_turns (int, optional): Number of turns kept when the window is trimmed. Defaults to 5.
+            summary_steps (int, optional): Max number of dropped actions listed in the summary. Defaults to 20.
+            action_chars (int, optional): Max characters of each action listed in the summary. Defaults to 200.
+        """
+        if keep_turns > max_turns:
+            raise ValueError("keep_turns must not be greater than max_turns")
+
+        self.prefix = prefix
+        self.max_turns = max_turns
+        self.keep_turns = keep_turns
+        self.summary_steps = summary_steps
+        self.action_chars = action_chars
+        self.turns: List[Turn] = []
+        self.summary: Optional[RoleMessage] = None
+        self.usage: List[StepUsage] = []
+
+        self._summary_lines: List[str] = []
+        self._num_turns = 0
+        self._last_sent: List[str] = []
+        self._messages: List[RoleMessage] = list(prefix)
+
+    def add_turn(
+        self,
+        request_text: str,
+        response: RoleMessage,
+        action: str,
+        note: Optional[str] = None,
+    ) -> None:
+        """Add a completed step to the history
+
+        Args:
+            request_text (str): Text of the request, the screenshot is not kept.
+            response (RoleMessage): The model's response.
+            action (str): Short description of the action taken, used in the summary once the turn is dropped.
+            note (Optional[str], optional): Feedback for the model on the step, e.g. an error. Defaults to None.
+        """
+        self._num_turns += 1
+        turn = Turn(
+            step=self._num_turns,
+            request=RoleMessage(role="user", text=request_text),
+            response=response,
+            action=action,
+            note=RoleMessage(role="user", text=note) if note else None,
+        )
+        self.turns.append(turn)
+        self._messages.extend(turn.messages())
+
+        if len(self.turns) > self.max_turns:
+            self._trim()
+
+    def messages(self) -> List[RoleMessage]:
+        """Messages to send before the new screenshot
+
+        Returns:
+            List[RoleMessage]: The messages
+        """
+        return list(self._messages)
+
+    def build(self, *msgs: RoleMessage) -> RoleThread:
+        """Build the thread for the next request
+
+        Args:
+            *msgs (RoleMessage): The new messages, usually the one containing the screenshot.
+
+        Returns:
+            RoleThread: The thread to send
+        """
+        # Built from its schema rather than with `add_msg`, which saves the whole
+        # thread to the database on every message. The messages keep their ids
+        # and share their text and images rather than copying them
+        now = time.time()
+        return RoleThread.from_v1(
+            V1RoleThread(
+                id=str(uuid.uuid4()),
+                public=False,
+                created=now,
+                updated=now,
+                messages=[msg.to_v1() for msg in self._messages + list(msgs)],
+            )
+        )
+
+    def record_usage(
+        self, thread: RoleThread, reported_tokens: Optional[int] = None
+    ) -> StepUsage:
+        """Record how many tokens a request re-sent, and how many of them were an unchanged prefix
+
+        Args:
+            thread (RoleThread): The thread that was sent.
+            reported_tokens (Optional[int], optional): Prompt tokens reported by the provider. Defaults to None.
+
+        Returns:
+            StepUsage: Usage for the step
+        """
+        messages = thread.messages()
+        ids = [message.id for message in messages]
+
+        common = 0
+        for sent, last in zip(ids, self._last_sent):
+            if sent != last:
+                break
+            common += 1
+
+        tokens = [estimate_tokens(message.text) for message in messages]
+        usage = StepUsage(
+            step=len(self.usage) + 1,
+            sent_tokens=sum(tokens),
+            prefix_tokens=sum(tokens[:common]),
+            new_tokens=sum(tokens[common:]),
+            reported_tokens=reported_tokens,
+        )
+        self.usage.append(usage)
+        self._last_sent = ids
+        logger.debug(f"step token usage: {usage}")
+        return usage
+
+    def _trim(self) -> None:
+        drop = len(self.turns) - self.keep_turns
+        for turn in self.turns[:drop]:
+            action = turn.action
+            if len(action) > self.action_chars:
+                action = action[: self.action_chars] + "..."
+            self._summary_lines.append(f"step {turn.step}: {action}")
+        self._summary_lines = self._summary_lines[-self.summary_steps :]
+        self.turns = self.turns[drop:]
+
+        # Steps that fell out of the summary are only counted
+        omitted = self.turns[0].step - 1 - len(self._summary_lines)
+        text = "For context, these are the actions you took in earlier steps: "
+        if omitted:
+            text += f"{omitted} steps not listed; "
+        self.summary = RoleMessage(
+            role="user", text=text + "; ".join(self._summary_lines)
+        )
+
+        self._messages = list(self.prefix)
+        self._messages.append(self.summary)
+        for turn in self.turns:
+            self._messages.extend(turn.messages())
+        logger.debug(f"folded {drop} turns into the history summary")
@@ -1,10 +1,179 @@
-import base64
+import binascii
+import hashlib
+import math
+import os
+import threading
+from collections import OrderedDict
 from io import BytesIO
-from typing import List, Tuple
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
 
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 
 
+def image_nbytes(img: Image.Image) -> int:
+    """Approximate size of the pixel buffer backing an image.
+
+    Args:
+        img (Image.Image): The image to measure.
+
+    Returns:
+        int: Number of bytes used by the decoded pixels.
+    """
+    return img.width * img.height * len(img.getbands())
+
+
+def image_hash(img: Image.Image) -> str:
+    """Hash of an image's pixels, identical images hash the same however they are encoded.
+
+    Args:
+        img (Image.Image): The image to hash.
+
+    Returns:
+        str: Hex digest.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{img.mode}:{img.width}x{img.height}:".encode())
+    digest.update(img.tobytes())
+    return digest.hexdigest()
+
+
+class FramePool:
+    """
+    A pool of reusable image buffers.
+
+    Screenshots, composites and debug overlays are allocated at the same handful of sizes on every step,
+    so rather than letting each one be garbage collected and reallocated the `FramePool` keeps released
+    buffers keyed by mode and size and hands them back out on the next `acquire`. Idle buffers are capped
+    per size and in total, so sizes that only come up once, like OCR candidate composites, don't stay
+    around, the least recently released go first. It also tracks how much image memory it is holding so
+    the current and peak usage can be reported.
+    """
+
+    def __init__(
+        self, max_idle: int = 4, max_idle_bytes: int = 64 * 1024 * 1024
+    ) -> None:
+        """
+        Initialize the pool.
+
+        Args:
+            max_idle (int, optional): Max number of idle buffers kept per mode and size. Defaults to 4.
+            max_idle_bytes (int, optional): Max bytes of idle buffers kept across all sizes. Defaults to 64MB.
+        """
+        self.max_idle = max_idle
+        self.max_idle_bytes = max_idle_bytes
+        # Idle buffers by mode and size, least recently released size first
+        self._idle: "OrderedDict[Tuple[str, Tuple[int, int]], List[Image.Image]]" = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+        self._in_use_bytes = 0
+        self._idle_bytes = 0
+        self._peak_bytes = 0
+        self._hits = 0
+        self._misses = 0
+
+    def acquire(
+        self,
+        mode: str,
+        size: Tuple[int, int],
+        color: Optional[Union[int, str, Tuple[int, ...]]] = 0,
+    ) -> Image.Image:
+        """Get a buffer of the given mode and size, reusing an idle one if possible.
+
+        Args:
+            mode (str): Image mode, e.g. 'RGB' or 'RGBA'.
+            size (Tuple[int, int]): Width and height of the buffer.
+            color (Optional[Union[int, str, Tuple[int, ...]]], optional): Color to fill the buffer with,
+                or None to leave the previous contents in place. Defaults to 0.
+
+        Returns:
+            Image.Image: The buffer
+        """
+        key = (mode, size)
+        img = None
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                img = idle.pop()
+                if not idle:
+                    del self._idle[key]
+                self._idle_bytes -= image_nbytes(img)
+                self._hits += 1
+            else:
+                self._misses += 1
+
+        if img is None:
+            img = Image.new(mode, size, 0 if color is None else color)
+        elif color is not None:
+            img.paste(color, (0, 0, size[0], size[1]))
+
+        with self._lock:
+            self._in_use_bytes += image_nbytes(img)
+            self._peak_bytes = max(
+                self._peak_bytes, self._in_use_bytes + self._idle_bytes
+            )
+        return img
+
+    def release(self, img: Image.Image) -> None:
+        """Return a buffer obtained from `acquire` to the pool.
+
+        The caller must not use the image after releasing it.
+
+        Args:
+            img (Image.Image): The buffer to release
+        """
+        key = (img.mode, img.size)
+        nbytes = image_nbytes(img)
+        with self._lock:
+            self._in_use_bytes = max(self._in_use_bytes - nbytes, 0)
+            idle = self._idle.setdefault(key, [])
+            self._idle.move_to_end(key)
+            if len(idle) < self.max_idle:
+                idle.append(img)
+                self._idle_bytes += nbytes
+            elif not idle:
+                del self._idle[key]
+            self._evict()
+
+    def _evict(self) -> None:
+        # Drop the oldest buffers of the least recently released sizes first
+        while self._idle_bytes > self.max_idle_bytes and self._idle:
+            key, idle = next(iter(self._idle.items()))
+            if idle:
+                self._idle_bytes -= image_nbytes(idle.pop(0))
+            if not idle:
+                del self._idle[key]
+
+    def clear(self) -> None:
+        """Drop all idle buffers"""
+        with self._lock:
+            self._idle.clear()
+            self._idle_bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Current pool statistics.
+
+        Returns:
+            Dict[str, int]: Bytes in use, idle, held in total and at peak, plus hit and miss counts.
+        """
+        with self._lock:
+            return {
+                "in_use_bytes": self._in_use_bytes,
+                "idle_bytes": self._idle_bytes,
+                "current_bytes": self._in_use_bytes + self._idle_bytes,
+                "peak_bytes": self._peak_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+            }
+
+
+frame_pool = FramePool(
+    max_idle=int(os.getenv("FRAME_POOL_MAX_IDLE", 4)),
+    max_idle_bytes=int(float(os.getenv("FRAME_POOL_MAX_IDLE_MB", 64)) * 1024 * 1024),
+)
+
+
 class Box:
     """
     Represents a rectangular box with integer coordinates.
@@ -12,13 +181,44 @@ class Box:
     The `Box` class represents a rectangular area defined by its left, top, right, and bottom coordinates. It provides methods for performing common operations on the box, such as calculating its width and height, zooming in on a specific cell within the box, cropping an image to the box's dimensions, and drawing the box on a drawing context.
 
     The `Box` class is used throughout the `surfpizza` module to represent and manipulate rectangular areas, such as when processing and displaying images.
+    Boxes are immutable and hashable so they can be used as cache keys, use `BoxArray` to operate on many boxes at once.
     """
 
+    __slots__ = ("left", "top", "right", "bottom")
+
+    left: int
+    top: int
+    right: int
+    bottom: int
+
     def __init__(self, left: int, top: int, right: int, bottom: int):
-        self.left = left
-        self.top = top
-        self.right = right
-        self.bottom = bottom
+        object.__setattr__(self, "left", int(left))
+        object.__setattr__(self, "top", int(top))
+        object.__setattr__(self, "right", int(right))
+        object.__setattr__(self, "bottom", int(bottom))
+
+    def __setattr__(self, name: str, value) -> None:
+        raise AttributeError("Box is immutable")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError("Box is immutable")
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Box):
+            return NotImplemented
+        return self.as_tuple() == other.as_tuple()
+
+    def __hash__(self) -> int:
+        return hash(self.as_tuple())
+
+    def __repr__(self) -> str:
+        return f"Box({self.left}, {self.top}, {self.right}, {self.bottom})"
+
+    def __reduce__(self):
+        return (Box, self.as_tuple())
+
+    def as_tuple(self) -> Tuple[int, int, int, int]:
+        return (self.left, self.top, self.right, self.bottom)
 
     def width(self) -> int:
         return self.right - self.left
@@ -26,16 +226,19 @@ class Box:
     def height(self) -> int:
         return self.bottom - self.top
 
-    def zoom_in(self, cell_index: int, num_cells: int) -> "Box":
-        cell_width = self.width() // num_cells
-        cell_height = self.height() // num_cells
+    def zoom_in(
+        self, cell_index: int, num_cells: int, rows: Optional[int] = None
+    ) -> "Box":
+        # num_cells is the number of columns when rows is given, cell edges are
+        # rounded down so the last row and column reach the edges of the box
+        rows = num_cells if rows is None else rows
         col = (cell_index - 1) % num_cells
         row = (cell_index - 1) // num_cells
         return Box(
-            self.left + col * cell_width,
-            self.top + row * cell_height,
-            self.left + (col + 1) * cell_width,
-            self.top + (row + 1) * cell_height,
+            self.left + col * self.width() // num_cells,
+            self.top + row * self.height() // rows,
+            self.left + (col + 1) * self.width() // num_cells,
+            self.top + (row + 1) * self.height() // rows,
         )
 
     def center(self) -> Tuple[int, int]:
@@ -63,41 +266,285 @@ class Box:
         )
 
 
+class BoxArray:
+    """
+    A batch of boxes backed by an (N, 4) integer NumPy array of left, top, right, bottom.
+
+    `BoxArray` mirrors the `Box` operations but applies them to every box at once, which keeps grid
+    generation, translation to absolute coordinates and overlap checks out of Python loops.
+    """
+
+    __slots__ = ("data",)
+
+    def __init__(self, data) -> None:
+        """
+        Initialize the array.
+
+        Args:
+            data: Anything convertible to an (N, 4) integer array.
+        """
+        self.data: np.ndarray = np.asarray(data, dtype=np.int64).reshape(-1, 4)
+
+    @classmethod
+    def from_boxes(cls, boxes: Sequence[Box]) -> "BoxArray":
+        return cls([box.as_tuple() for box in boxes])
+
+    @classmethod
+    def grid(
+        cls, box: Box, num_cells: int, rows: Optional[int] = None, overlap: int = 0
+    ) -> "BoxArray":
+        """Split a box into a grid of `num_cells` columns and `rows` rows.
+
+        Cells are ordered column by column, matching `divide_image_into_cells`.
+
+        Args:
+            box (Box): The box to split.
+            num_cells (int): The number of columns, and of rows if `rows` isn't given.
+            rows (Optional[int], optional): The number of rows. Defaults to None.
+            overlap (int, optional): Pixels each cell extends into its neighbours. Defaults to 0.
+
+        Returns:
+            BoxArray: The cells, relative to the box's top left corner.
+        """
+        return cls([(0, 0, box.width(), box.height())]).split(num_cells, rows, overlap)
+
+    def split(
+        self, num_cells: int, rows: Optional[int] = None, overlap: int = 0
+    ) -> "BoxArray":
+        """Split every box into a grid of `num_cells` columns and `rows` rows.
+
+        Cell edges are rounded down, so cells differ in size by at most a pixel and together they
+        cover every pixel of the box, including the remainder of an uneven split.
+
+        Args:
+            num_cells (int): The number of columns, and of rows if `rows` isn't given.
+            rows (Optional[int], optional): The number of rows. Defaults to None.
+            overlap (int, optional): Pixels each cell extends into its neighbours, clamped to the box. Defaults to 0.
+
+        Returns:
+            BoxArray: N * columns * rows cells, grouped by source box and ordered column by column.
+        """
+        cols = num_cells
+        rows = num_cells if rows is None else rows
+        x_edges = (
+            self.data[:, 0:1] + np.arange(cols + 1) * self.widths()[:, None] // cols
+        )
+        y_edges = (
+            self.data[:, 1:2] + np.arange(rows + 1) * self.heights()[:, None] // rows
+        )
+        lefts, rights = x_edges[:, :-1], x_edges[:, 1:]
+        tops, bottoms = y_edges[:, :-1], y_edges[:, 1:]
+        if overlap:
+            lefts = np.maximum(lefts - overlap, self.data[:, 0:1])
+            tops = np.maximum(tops - overlap, self.data[:, 1:2])
+            rights = np.minimum(rights + overlap, self.data[:, 2:3])
+            bottoms = np.minimum(bottoms + overlap, self.data[:, 3:4])
+
+        # column index varies slowest, row index fastest
+        n = len(self)
+        out = np.empty((n, cols, rows, 4), dtype=np.int64)
+        out[..., 0] = lefts[:, :, None]
+        out[..., 1] = tops[:, None, :]
+        out[..., 2] = rights[:, :, None]
+        out[..., 3] = bottoms[:, None, :]
+        return BoxArray(out.reshape(-1, 4))
+
+    def to_absolute(self, parent: Union[Box, "BoxArray"]) -> "BoxArray":
+        """Translate the boxes by the top left corner of their parent box or boxes.
+
+        Args:
+            parent (Union[Box, BoxArray]): A single parent, or one parent per box.
+
+        Returns:
+            BoxArray: The translated boxes
+        """
+        if isinstance(parent, Box):
+            offset = np.array([parent.left, parent.top, parent.left, parent.top])
+        else:
+            offset = parent.data[:, [0, 1, 0, 1]]
+        return BoxArray(self.data + offset)
+
+    def widths(self) -> np.ndarray:
+        return self.data[:, 2] - self.data[:, 0]
+
+    def heights(self) -> np.ndarray:
+        return self.data[:, 3] - self.data[:, 1]
+
+    def areas(self) -> np.ndarray:
+        return np.clip(self.widths(), 0, None) * np.clip(self.heights(), 0, None)
+
+    def centers(self) -> np.ndarray:
+        """Centers of the boxes as an (N, 2) array of x, y"""
+        return np.stack(
+            [
+                (self.data[:, 0] + self.data[:, 2]) // 2,
+                (self.data[:, 1] + self.data[:, 3]) // 2,
+            ],
+            axis=1,
+        )
+
+    def intersection(self, other: "BoxArray") -> np.ndarray:
+        """Pairwise intersection areas.
+
+        Args:
+            other (BoxArray): Boxes to intersect with.
+
+        Returns:
+            np.ndarray: An (N, M) array of intersection areas.
+        """
+        a = self.data[:, None, :]
+        b = other.data[None, :, :]
+        width = np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0])
+        height = np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1])
+        return np.clip(width, 0, None) * np.clip(height, 0, None)
+
+    def iou(self, other: "BoxArray") -> np.ndarray:
+        """Pairwise intersection over union.
+
+        Args:
+            other (BoxArray): Boxes to compare with.
+
+        Returns:
+            np.ndarray: An (N, M) array of IoU values.
+        """
+        inter = self.intersection(other)
+        union = self.areas()[:, None] + other.areas()[None, :] - inter
+        return np.divide(
+            inter, union, out=np.zeros(inter.shape, dtype=float), where=union > 0
+        )
+
+    def contains_points(self, points) -> np.ndarray:
+        """Which boxes contain which points.
+
+        Args:
+            points: An (M, 2) array of x, y coordinates.
+
+        Returns:
+            np.ndarray: An (N, M) boolean array.
+        """
+        pts = np.asarray(points).reshape(-1, 2)
+        x = pts[None, :, 0]
+        y = pts[None, :, 1]
+        return (
+            (self.data[:, 0:1] <= x)
+            & (x < self.data[:, 2:3])
+            & (self.data[:, 1:2] <= y)
+            & (y < self.data[:, 3:4])
+        )
+
+    def contains(self, other: "BoxArray") -> np.ndarray:
+        """Which boxes fully contain which other boxes.
+
+        Args:
+            other (BoxArray): Boxes that may be contained.
+
+        Returns:
+            np.ndarray: An (N, M) boolean array.
+        """
+        a = self.data[:, None, :]
+        b = other.data[None, :, :]
+        return (
+            (a[..., 0] <= b[..., 0])
+            & (a[..., 1] <= b[..., 1])
+            & (a[..., 2] >= b[..., 2])
+            & (a[..., 3] >= b[..., 3])
+        )
+
+    def to_boxes(self) -> List[Box]:
+        return [Box(*row) for row in self.data.tolist()]
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __iter__(self) -> Iterator[Box]:
+        return iter(self.to_boxes())
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return Box(*self.data[index].tolist())
+        return BoxArray(self.data[index])
+
+    def __repr__(self) -> str:
+        return f"BoxArray({self.data.tolist()})"
+
+
+def grid_shape(width: int, height: int, num_cells: int) -> Tuple[int, int]:
+    """Columns and rows to split an area into so its cells are close to square.
+
+    The number of cells stays close to `num_cells` x `num_cells`, a wide screen gets more columns
+    than rows rather than cells that are much wider than they are tall.
+
+    Args:
+        width (int): Width of the area.
+        height (int): Height of the area.
+        num_cells (int): The number of cells per row and column of a square area.
+
+    Returns:
+        Tuple[int, int]: Number of columns and rows.
+    """
+    if width <= 0 or height <= 0:
+        return num_cells, num_cells
+    scale = math.sqrt(width / height)
+    return max(1, round(num_cells * scale)), max(1, round(num_cells / scale))
+
+
+def changed_fraction(
+    before: Image.Image, after: Image.Image, box: Box, threshold: int = 16
+) -> float:
+    """Fraction of the pixels in a box that changed between two images of the same screen.
+
+    Args:
+        before (Image.Image): The earlier image.
+        after (Image.Image): The later image.
+        box (Box): Area to compare, clamped to the images.
+        threshold (int, optional): Smallest difference in any channel that counts as a change. Defaults to 16.
+
+    Returns:
+        float: Fraction of the pixels that changed, 1.0 if the images aren't the same size.
+    """
+    if before.size != after.size:
+        return 1.0
+    box = Box(
+        max(box.left, 0),
+        max(box.top, 0),
+        min(box.right, before.width),
+        min(box.bottom, before.height),
+    )
+    if box.width() <= 0 or box.height() <= 0:
+        return 0.0
+
+    a = np.asarray(box.crop_image(before).convert("RGB"), dtype=np.int16)
+    b = np.asarray(box.crop_image(after).convert("RGB"), dtype=np.int16)
+    return float((np.abs(a - b).max(axis=2) > threshold).mean())
+
+
 def divide_image_into_cells(
-    image: Image.Image, num_cells: int
+    image: Image.Image,
+    num_cells: int,
+    pool: Optional[FramePool] = None,
+    rows: Optional[int] = None,
+    overlap: int = 0,
 ) -> Tuple[Image.Image, List[Image.Image], List[Box]]:
     """Divides an image into a grid of cells, returning both the cropped images and their corresponding Box objects.
 
     Args:
         image (Image.Image): The input image to be divided.
-        num_cells (int): The number of cells per row and column.
+        num_cells (int): The number of columns, and of rows if `rows` isn't given.
+        pool (Optional[FramePool], optional): Pool to allocate the composite from, the caller
+            should release it when done. Defaults to None.
+        rows (Optional[int], optional): The number of rows. Defaults to None.
+        overlap (int, optional): Pixels each cell extends into its neighbours. Defaults to 0.
 
     Returns:
         Tuple[Image.Image, List[Box]]: A composite image, and a list of boxes corresponding to each cell.
     """
     img_width, img_height = image.size
-    cell_width = img_width // num_cells
-    cell_height = img_height // num_cells
-
-    cropped_images: List[Image.Image] = []
-    boxes: List[Box] = []
-    for i in range(num_cells):
-        for j in range(num_cells):
-            box = Box(
-                i * cell_width,
-                j * cell_height,
-                (i + 1) * cell_width if (i + 1) * cell_width < img_width else img_width,
-                (
-                    (j + 1) * cell_height
-                    if (j + 1) * cell_height < img_height
-                    else img_height
-                ),
-            )
-            cropped_image = box.crop_image(image)
-            cropped_images.append(cropped_image)
-            boxes.append(box)
+    boxes = BoxArray.grid(
+        Box(0, 0, img_width, img_height), num_cells, rows, overlap
+    ).to_boxes()
+    cropped_images = [box.crop_image(image) for box in boxes]
 
-    composite = combine_images_vertically(cropped_images)
+    composite = combine_images_vertically(cropped_images, pool=pool)
 
     return composite, cropped_images, boxes
 
@@ -231,8 +678,13 @@ def create_grid_image_by_size(
     return img
 
 
-def combine_images_vertically(images: List[Image.Image]) -> Image.Image:
-    """Combine images vertically and draw a small red circle in the center of each image."""
+def combine_images_vertically(
+    images: List[Image.Image], pool: Optional[FramePool] = None
+) -> Image.Image:
+    """Combine images vertically and draw a small red circle in the center of each image.
+
+    If a pool is given the combined image is allocated from it and should be released by the caller.
+    """
     padding = 10
     line_height = 2
     total_height = sum(image.height + padding * 2 for image in images) + line_height * (
@@ -240,7 +692,10 @@ def combine_images_vertically(images: List[Image.Image]) -> Image.Image:
     )
     max_width = max(image.width for image in images) + 100
 
-    combined_image = Image.new("RGB", (max_width, total_height), "white")
+    if pool:
+        combined_image = pool.acquire("RGB", (max_width, total_height), "white")
+    else:
+        combined_image = Image.new("RGB", (max_width, total_height), "white")
     draw = ImageDraw.Draw(combined_image)
 
     # Attempt to use a larger font; adjust the path as necessary
@@ -344,58 +799,285 @@ def superimpose_images(
     return merged_image
 
 
-def image_to_b64(img: Image.Image, image_format="PNG") -> str:
-    """Converts a PIL Image to a base64-encoded string with MIME type included.
+# Chunk sizes are multiples of 3 raw bytes / 4 encoded characters so every
+# chunk encodes or decodes independently without padding in the middle
+B64_RAW_CHUNK = 3 * 64 * 1024
+B64_ENCODED_CHUNK = 4 * 64 * 1024
+
+# Characters base64 may be wrapped with, e.g. MIME line breaks
+B64_WHITESPACE = b" \t\n\r\v\f"
+
+
+def _b64_encode_into(data: memoryview, prefix: bytes = b"") -> bytearray:
+    """Base64 encode a buffer in chunks into a single preallocated bytearray.
+
+    Args:
+        data (memoryview): The raw bytes to encode.
+        prefix (bytes, optional): Bytes to place before the encoded data. Defaults to b"".
+
+    Returns:
+        bytearray: The prefix followed by the encoded data.
+    """
+    out = bytearray(len(prefix) + 4 * ((len(data) + 2) // 3))
+    out[: len(prefix)] = prefix
+    pos = len(prefix)
+    for start in range(0, len(data), B64_RAW_CHUNK):
+        encoded = binascii.b2a_base64(
+            data[start : start + B64_RAW_CHUNK], newline=False
+        )
+        out[pos : pos + len(encoded)] = encoded
+        pos += len(encoded)
+    return out
+
+
+def _b64_decode_into(
+    data: Union[str, bytes, memoryview], buffer: BytesIO, offset: int = 0
+) -> None:
+    """Base64 decode data in chunks, writing the decoded bytes to a buffer.
+
+    Args:
+        data (Union[str, bytes, memoryview]): Base64 data.
+        buffer (BytesIO): Buffer to write the decoded bytes to.
+        offset (int, optional): Where the base64 payload starts in `data`. Defaults to 0.
+    """
+    if not isinstance(data, str):
+        data = memoryview(data)
+    for start in range(offset, len(data), B64_ENCODED_CHUNK):
+        try:
+            buffer.write(binascii.a2b_base64(data[start : start + B64_ENCODED_CHUNK]))
+        except binascii.Error:
+            # Whitespace put the chunks out of step with the 4 character groups,
+            # what was decoded so far ended on a group so carry on from here
+            _b64_decode_unaligned_into(data, buffer, start)
+            return
+
+
+def _b64_decode_unaligned_into(
+    data: Union[str, memoryview], buffer: BytesIO, offset: int
+) -> None:
+    """Base64 decode data wrapped with whitespace in chunks, carrying incomplete groups to the next chunk.
+
+    Args:
+        data (Union[str, memoryview]): Base64 data.
+        buffer (BytesIO): Buffer to write the decoded bytes to.
+        offset (int): Where to start decoding in `data`.
+    """
+    tail = b""
+    for start in range(offset, len(data), B64_ENCODED_CHUNK):
+        chunk = data[start : start + B64_ENCODED_CHUNK]
+        raw = chunk.encode("ascii") if isinstance(chunk, str) else chunk.tobytes()
+        raw = tail + raw.translate(None, B64_WHITESPACE)
+        end = len(raw) - len(raw) % 4
+        buffer.write(binascii.a2b_base64(raw[:end]))
+        tail = raw[end:]
+    if tail:
+        # Raises on missing padding just like decoding it in one go would
+        buffer.write(binascii.a2b_base64(tail))
+
+
+def _parse_data_uri_header(
+    data: Union[str, bytes, memoryview],
+) -> Tuple[Optional[str], int]:
+    """Find the MIME type and payload offset of a data URI without copying the payload.
+
+    Args:
+        data (Union[str, bytes, memoryview]): A data URI or plain base64 data.
+
+    Returns:
+        Tuple[Optional[str], int]: MIME type if present and the offset the base64 payload starts at.
+    """
+    head = data[:256]
+    if not isinstance(head, str):
+        head = bytes(head).decode("ascii", errors="replace")
+
+    idx = head.find(",")
+    if idx == -1:
+        return None, 0
+
+    mime_type = None
+    if head.startswith("data:"):
+        mime_type = head[len("data:") : idx].split(";")[0] or None
+    return mime_type, idx + 1
+
+
+class DataURI:
+    """
+    A lazily encoded base64 data URI.
+
+    Holds the raw encoded image bytes (e.g. PNG) and only produces the base64 data URI when it is
+    asked for, caching the result. This lets callers pass images around, write them to disk or upload
+    the raw bytes without ever paying for the base64 copy, and already encoded files can be wrapped
+    untouched.
+    """
+
+    __slots__ = ("mime_type", "_raw", "_encoded")
+
+    def __init__(
+        self, raw: Union[bytes, bytearray, memoryview], mime_type: str
+    ) -> None:
+        """
+        Initialize the data URI.
+
+        Args:
+            raw (Union[bytes, bytearray, memoryview]): The raw image bytes.
+            mime_type (str): MIME type of the raw bytes, e.g. 'image/png'.
+        """
+        self.mime_type = mime_type
+        self._raw = memoryview(raw)
+        self._encoded: Optional[bytearray] = None
+
+    @classmethod
+    def from_image(cls, img: Image.Image, image_format: str = "PNG") -> "DataURI":
+        """Encode a PIL Image into a data URI.
+
+        Args:
+            img (Image.Image): The image to encode.
+            image_format (str, optional): Format to save the image in. Defaults to "PNG".
+
+        Returns:
+            DataURI: The data URI
+        """
+        buffer = BytesIO()
+        img.save(buffer, format=image_format)
+        return cls(buffer.getbuffer(), f"image/{image_format.lower()}")
+
+    @classmethod
+    def from_file(cls, filepath: str) -> "DataURI":
+        """Wrap an image file, passing its bytes through without re-encoding.
+
+        Args:
+            filepath (str): Path to the image file.
+
+        Returns:
+            DataURI: The data URI
+        """
+        with Image.open(filepath) as image:
+            image_format = image.format if image.format else "PNG"
+        with open(filepath, "rb") as f:
+            raw = f.read()
+        return cls(raw, f"image/{image_format.lower()}")
+
+    @classmethod
+    def parse(cls, data: Union[str, bytes, memoryview]) -> "DataURI":
+        """Decode a data URI or plain base64 string.
+
+        Args:
+            data (Union[str, bytes, memoryview]): The data URI.
+
+        Returns:
+            DataURI: The data URI
+        """
+        mime_type, offset = _parse_data_uri_header(data)
+        buffer = BytesIO()
+        _b64_decode_into(data, buffer, offset)
+        return cls(buffer.getbuffer(), mime_type or "image/png")
+
+    @property
+    def raw(self) -> memoryview:
+        """The raw image bytes"""
+        return self._raw
+
+    def _encode(self) -> bytearray:
+        if self._encoded is None:
+            prefix = f"data:{self.mime_type};base64,".encode("ascii")
+            self._encoded = _b64_encode_into(self._raw, prefix)
+        return self._encoded
+
+    def encode(self) -> memoryview:
+        """The full data URI as ASCII bytes, encoded on first use.
+
+        Returns:
+            memoryview: A read-only view of the data URI bytes
+        """
+        return memoryview(self._encode()).toreadonly()
+
+    def to_image(self) -> Image.Image:
+        """Decode the raw bytes into a PIL Image.
+
+        Returns:
+            Image.Image: The image
+        """
+        return Image.open(BytesIO(self._raw))
+
+    def __len__(self) -> int:
+        return len(self._raw)
+
+    def __str__(self) -> str:
+        return self._encode().decode("ascii")
+
+
+def image_to_b64_bytes(img: Image.Image, image_format: str = "PNG") -> bytearray:
+    """Converts a PIL Image to a base64-encoded data URI as ASCII bytes.
 
     Args:
         img (Image.Image): The PIL Image object to convert.
         image_format (str): The format to use when saving the image (e.g., 'PNG', 'JPEG').
 
     Returns:
-        str: A base64-encoded string of the image with MIME type.
+        bytearray: A base64-encoded data URI of the image.
     """
     buffer = BytesIO()
     img.save(buffer, format=image_format)
-    image_data = buffer.getvalue()
-    buffer.close()
 
     mime_type = f"image/{image_format.lower()}"
-    base64_encoded_data = base64.b64encode(image_data).decode("utf-8")
-    return f"data:{mime_type};base64,{base64_encoded_data}"
+    with buffer.getbuffer() as view:
+        return _b64_encode_into(view, f"data:{mime_type};base64,".encode("ascii"))
+
+
+def image_to_b64(img: Image.Image, image_format="PNG") -> str:
+    """Converts a PIL Image to a base64-encoded string with MIME type included.
+
+    Args:
+        img (Image.Image): The PIL Image object to convert.
+        image_format (str): The format to use when saving the image (e.g., 'PNG', 'JPEG').
+
+    Returns:
+        str: A base64-encoded string of the image with MIME type.
+    """
+    return image_to_b64_bytes(img, image_format).decode("ascii")
 
 
-def b64_to_image(base64_str: str) -> Image.Image:
+def b64_to_image(base64_str: Union[str, bytes, memoryview]) -> Image.Image:
     """Converts a base64 string to a PIL Image object.
 
     Args:
-        base64_str (str): The base64 string, potentially with MIME type as part of a data URI.
+        base64_str (Union[str, bytes, memoryview]): The base64 string, potentially with MIME type as part of a data URI.
 
     Returns:
         Image.Image: The converted PIL Image object.
     """
-    # Strip the MIME type prefix if present
-    if "," in base64_str:
-        base64_str = base64_str.split(",")[1]
-
-    image_data = base64.b64decode(base64_str)
-    image = Image.open(BytesIO(image_data))
+    _, offset = _parse_data_uri_header(base64_str)
+    buffer = BytesIO()
+    _b64_decode_into(base64_str, buffer, offset)
+    buffer.seek(0)
+    image = Image.open(buffer)
     return image
 
 
-def load_image_base64(filepath: str) -> str:
-    # Load the image from the file path
-    image = Image.open(filepath)
-    buffered = BytesIO()
+def b64_nbytes(base64_str: str) -> int:
+    """Size of the data a base64 string or data URI decodes to, without decoding it.
 
-    # Save image to the buffer
-    image_format = image.format if image.format else "PNG"
-    image.save(buffered, format=image_format)
+    Args:
+        base64_str (str): The base64 string, potentially with MIME type as part of a data URI.
 
-    # Encode the image to base64
-    img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
+    Returns:
+        int: Decoded size in bytes, 0 for a URL to an image stored elsewhere.
+    """
+    if base64_str.startswith("http"):
+        return 0
+    _, offset = _parse_data_uri_header(base64_str)
+    payload = len(base64_str) - offset
+    padding = len(base64_str) - len(base64_str.rstrip("="))
+    return payload * 3 // 4 - padding
 
-    # Prepare the mime type
-    mime_type = f"image/{image_format.lower()}"
 
-    # Return base64 string with mime type
-    return f"data:{mime_type};base64,{img_str}"
+def load_image_base64(filepath: str) -> str:
+    """Loads an image file as a base64 data URI, without re-encoding the image.
+
+    Args:
+        filepath (str): Path to the image file.
+
+    Returns:
+        str: A base64-encoded string of the image with MIME type.
+    """
+    return str(DataURI.from_file(filepath))
@@ -0,0 +1,502 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Final, Iterator, List, Sequence, Tuple
+
+import psutil
+
+logger: Final = logging.getLogger(__name__)
+logger.setLevel(int(os.getenv("LOG_LEVEL", str(logging.DEBUG))))
+
+# Seconds, for timings from a screenshot up to a slow LLM call
+LATENCY_BUCKETS: Final = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+@dataclass
+class MetricFamily:
+    """A metric and its samples, ready to be rendered"""
+
+    name: str
+    kind: str
+    help: str
+    samples: List[Tuple[str, Dict[str, str], float]] = field(default_factory=list)
+
+
+def _labels(names: Sequence[str], values: Dict[str, str]) -> Labels:
+    if set(values) != set(names):
+        raise ValueError(f"expected labels {list(names)}, got {list(values)}")
+    return tuple((name, str(values[name])) for name in names)
+
+
+class Counter:
+    """
+    A value that only goes up, such as the number of steps taken.
+    """
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        """Increase the counter
+
+        Args:
+            amount (float, optional): Amount to increase it by. Defaults to 1.0.
+            **labels (str): Value of each of the counter's labels
+        """
+        if amount < 0:
+            raise ValueError("counters can only increase")
+        key = _labels(self.labels, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        """Current value of the counter
+
+        Args:
+            **labels (str): Value of each of the counter's labels
+
+        Returns:
+            float: The value
+        """
+        with self._lock:
+            return self._values.get(_labels(self.labels, labels), 0.0)
+
+    def collect(self) -> MetricFamily:
+        # The family is named after its samples, parsers treat a counter
+        # whose samples are named differently as an untyped metric
+        name = f"{self.name}_total"
+        with self._lock:
+            samples = [(name, dict(key), value) for key, value in self._values.items()]
+        return MetricFamily(name, "counter", self.help, samples)
+
+
+class Gauge:
+    """
+    A value that goes up and down, such as the number of tasks running.
+    """
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def set(self, value: float, **labels: str) -> None:
+        """Set the gauge
+
+        Args:
+            value (float): The value
+            **labels (str): Value of each of the gauge's labels
+        """
+        with self._lock:
+            self._values[_labels(self.labels, labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        """Increase the gauge
+
+        Args:
+            amount (float, optional): Amount to increase it by. Defaults to 1.0.
+            **labels (str): Value of each of the gauge's labels
+        """
+        key = _labels(self.labels, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        """Decrease the gauge
+
+        Args:
+            amount (float, optional): Amount to decrease it by. Defaults to 1.0.
+            **labels (str): Value of each of the gauge's labels
+        """
+        self.inc(-amount, **labels)
+
+    def value(self, **labels: str) -> float:
+        """Current value of the gauge
+
+        Args:
+            **labels (str): Value of each of the gauge's labels
+
+        Returns:
+            float: The value
+        """
+        with self._lock:
+            return self._values.get(_labels(self.labels, labels), 0.0)
+
+    def collect(self) -> MetricFamily:
+        with self._lock:
+            samples = [
+                (self.name, dict(key), value) for key, value in self._values.items()
+            ]
+        return MetricFamily(self.name, "gauge", self.help, samples)
+
+
+class Histogram:
+    """
+    Counts observations, such as latencies, into buckets, along with their count and sum.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+        labels: Sequence[str] = (),
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.labels = tuple(labels)
+        # Per label set, the count in each bucket, the last being +Inf, and the sum
+        self._values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        """Record an observation
+
+        Args:
+            value (float): The observation
+            **labels (str): Value of each of the histogram's labels
+        """
+        key = _labels(self.labels, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(
+                key, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[index] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observe how many seconds a block takes
+
+        Args:
+            **labels (str): Value of each of the histogram's labels
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels: str) -> int:
+        """Number of observations
+
+        Args:
+            **labels (str): Value of each of the histogram's labels
+
+        Returns:
+            int: The count
+        """
+        with self._lock:
+            values = self._values.get(_labels(self.labels, labels))
+            return sum(values[0]) if values else 0
+
+    def collect(self) -> MetricFamily:
+        family = MetricFamily(self.name, "histogram", self.help)
+        with self._lock:
+            values = [
+                (key, list(counts), total[0])
+                for key, (counts, total) in self._values.items()
+            ]
+
+        for key, counts, total in values:
+            labels = dict(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                family.samples.append(
+                    (
+                        f"{self.name}_bucket",
+                        {**labels, "le": _format_value(bound)},
+                        cumulative,
+                    )
+                )
+            family.samples.append((f"{self.name}_sum", labels, total))
+            family.samples.append((f"{self.name}_count", labels, cumulative))
+        return family
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if value == float("-inf"):
+        return "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class MetricsRegistry:
+    """
+    The metrics of the process, rendered in the Prometheus text exposition format.
+
+    Besides the metrics registered with it, collectors are called on every render for values that
+    are already tracked elsewhere, such as cache statistics, so they are read rather than duplicated.
+    """
+
+    def __init__(self, prefix: str = "surfpizza") -> None:
+        self.prefix = prefix
+        self._metrics: Dict[str, Counter | Gauge | Histogram] = {}
+        self._collectors: List[Callable[[], List[MetricFamily]]] = []
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        """Register a counter
+
+        Args:
+            name (str): Name of the counter, without the prefix or `_total`
+            help (str): What it counts
+            labels (Sequence[str], optional): Names of its labels. Defaults to ().
+
+        Returns:
+            Counter: The counter
+        """
+        return self._register(Counter(f"{self.prefix}_{name}", help, labels))  # type: ignore
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        """Register a gauge
+
+        Args:
+            name (str): Name of the gauge, without the prefix
+            help (str): What it measures
+            labels (Sequence[str], optional): Names of its labels. Defaults to ().
+
+        Returns:
+            Gauge: The gauge
+        """
+        return self._register(Gauge(f"{self.prefix}_{name}", help, labels))  # type: ignore
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+        labels: Sequence[str] = (),
+    ) -> Histogram:
+        """Register a histogram
+
+        Args:
+            name (str): Name of the histogram, without the prefix
+            help (str): What it measures
+            buckets (Sequence[float], optional): Upper bounds of the buckets. Defaults to LATENCY_BUCKETS.
+            labels (Sequence[str], optional): Names of its labels. Defaults to ().
+
+        Returns:
+            Histogram: The histogram
+        """
+        return self._register(  # type: ignore
+            Histogram(f"{self.prefix}_{name}", help, buckets, labels)
+        )
+
+    def collector(
+        self, fn: Callable[[], List[MetricFamily]]
+    ) -> Callable[[], List[MetricFamily]]:
+        """Register a function that reads metrics when they are rendered, can be used as a decorator
+
+        Args:
+            fn (Callable[[], List[MetricFamily]]): The function
+
+        Returns:
+            Callable[[], List[MetricFamily]]: The function
+        """
+        with self._lock:
+            self._collectors.append(fn)
+        return fn
+
+    def collect(self) -> List[MetricFamily]:
+        """Current value of every metric
+
+        Returns:
+            List[MetricFamily]: The metrics
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+
+        families = [metric.collect() for metric in metrics]
+        for collector in collectors:
+            try:
+                families.extend(collector())
+            except Exception as e:
+                logger.warning(f"metrics collector {collector.__name__} failed: {e}")
+        return families
+
+    def render(self) -> str:
+        """Render the metrics in the Prometheus text exposition format
+
+        Returns:
+            str: The metrics
+        """
+        lines = []
+        for family in self.collect():
+            lines.append(f"# HELP {family.name} {_escape(family.help)}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for name, labels, value in family.samples:
+                if labels:
+                    rendered = ",".join(
+                        f'{key}="{_escape(val)}"' for key, val in labels.items()
+                    )
+                    name = f"{name}{{{rendered}}}"
+                lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def _register(
+        self, metric: Counter | Gauge | Histogram
+    ) -> Counter | Gauge | Histogram:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"metric {metric.name} already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+
+registry = MetricsRegistry()
+
+steps = registry.counter("steps", "Agent steps taken")
+clicks = registry.counter("clicks", "Clicks made on grounded objects")
+zoom_depth = registry.histogram(
+    "zoom_depth",
+    "Zoom levels used to ground an object found by zooming",
+    buckets=(1, 2, 3, 4, 5, 6, 8),
+)
+ocr_groundings = registry.counter(
+    "ocr_groundings", "Objects grounded by the OCR pre-filter without zooming"
+)
+llm_calls = registry.counter("llm_calls", "LLM calls", labels=("namespace",))
+llm_latency = registry.histogram(
+    "llm_latency_seconds", "Latency of LLM calls", labels=("namespace",)
+)
+screenshot_latency = registry.histogram(
+    "screenshot_latency_seconds", "Latency of taking a screenshot"
+)
+image_bytes_uploaded = registry.counter(
+    "image_bytes_uploaded",
+    "Bytes of encoded images sent to the task server, with recorded actions or debug messages",
+    labels=("kind",),
+)
+click_retries = registry.counter(
+    "click_retries",
+    "Clicks that changed nothing near their target and were made again",
+    labels=("mode",),
+)
+zoom_tree_cache = registry.counter(
+    "zoom_tree_cache", "Zoom levels reused or built", labels=("result",)
+)
+prefetch_frames = registry.counter(
+    "prefetch_frames",
+    "Screenshots ready from a prefetch or captured late",
+    labels=("result",),
+)
+active_tasks = registry.gauge("active_tasks", "Tasks being solved")
+
+
+@registry.collector
+def _collect_retries() -> List[MetricFamily]:
+    # Imported here so the server can serve metrics without loading the agent's dependencies
+    from .retry import retry_stats
+
+    family = MetricFamily(
+        f"{registry.prefix}_retries_total", "counter", "Retries by kind of error"
+    )
+    seconds = MetricFamily(
+        f"{registry.prefix}_retry_seconds_total",
+        "counter",
+        "Seconds spent on failed attempts and waiting to retry, by kind of error",
+    )
+    for kind, stats in retry_stats.stats().items():
+        family.samples.append((family.name, {"kind": kind}, stats["retries"]))
+        seconds.samples.append((seconds.name, {"kind": kind}, stats["seconds"]))
+    return [family, seconds]
+
+
+@registry.collector
+def _collect_caches() -> List[MetricFamily]:
+    from .img import frame_pool
+    from .store import image_stores
+
+    lookups = MetricFamily(
+        f"{registry.prefix}_cache_lookups_total",
+        "counter",
+        "Lookups of the frame pool and image store, by cache and result",
+    )
+    pool = frame_pool.stats()
+    lookups.samples += [
+        (
+            lookups.name,
+            {"cache": "frame_pool", "result": "hit"},
+            pool["hits"],
+        ),
+        (
+            lookups.name,
+            {"cache": "frame_pool", "result": "miss"},
+            pool["misses"],
+        ),
+    ]
+
+    stored = MetricFamily(
+        f"{registry.prefix}_image_store_bytes",
+        "gauge",
+        "Bytes of images and manifests in the store",
+    )
+    hits = writes = 0
+    for store in image_stores():
+        stats = store.stats()
+        hits += stats["hits"]
+        writes += stats["writes"]
+        stored.samples.append((stored.name, {"root": store.root}, stats["bytes"]))
+    lookups.samples += [
+        (lookups.name, {"cache": "image_store", "result": "hit"}, hits),
+        (lookups.name, {"cache": "image_store", "result": "miss"}, writes),
+    ]
+
+    pooled = MetricFamily(
+        f"{registry.prefix}_frame_pool_bytes", "gauge", "Bytes of frame buffers held"
+    )
+    pooled.samples.append((pooled.name, {}, pool["current_bytes"]))
+    peak = MetricFamily(
+        f"{registry.prefix}_frame_pool_peak_bytes",
+        "gauge",
+        "Most bytes of frame buffers held at once",
+    )
+    peak.samples.append((peak.name, {}, pool["peak_bytes"]))
+    return [lookups, stored, pooled, peak]
+
+
+@registry.collector
+def _collect_process() -> List[MetricFamily]:
+    rss = MetricFamily(
+        f"{registry.prefix}_process_resident_memory_bytes",
+        "gauge",
+        "Resident memory of the process",
+    )
+    rss.samples.append((rss.name, {}, psutil.Process(os.getpid()).memory_info().rss))
+    return [rss]
+
+
+@contextmanager
+def llm_call(namespace: str) -> Iterator[None]:
+    """Count an LLM call and time it
+
+    Args:
+        namespace (str): Namespace of the call, 'system', 'action' or 'zoom'
+    """
+    llm_calls.inc(namespace=namespace)
+    with llm_latency.time(namespace=namespace):
+        yield
@@ -0,0 +1,232 @@
+import logging
+import os
+import re
+import threading
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from PIL import Image
+
+from .img import Box, image_hash
+
+try:
+    import pytesseract
+except ImportError:
+    pytesseract = None
+
+logger = logging.getLogger(__name__)
+logger.setLevel(int(os.getenv("LOG_LEVEL", logging.DEBUG)))
+
+# Text in straight or curly, single or double quotes, straight single quotes have to
+# be outside of words so apostrophes don't count
+QUOTED_RE = re.compile(r"(?<!\w)'([^']+)'(?!\w)|\"([^\"]+)\"|‘([^’]+)’|“([^”]+)”")
+
+# Elements that are clicked on their own text, e.g. "the 'Save' button"
+TEXT_ELEMENT_RE = re.compile(
+    r"\b(buttons?|links?|menu items?|menus?|tabs?|options?|headings?|titles?|words?"
+    r"|text(?!\s*(?:field|box|area|input)))\b",
+    re.IGNORECASE,
+)
+
+# Words that put the quoted text somewhere other than on the element itself, e.g.
+# "the text field labelled 'Email'"
+RELATION_RE = re.compile(
+    r"\b(label(?:l)?ed|next to|beside|near|under|below|above|after|before|for|placeholder"
+    r"|(?:left|right) of(?! the (?:image|screen|page|window)))\b",
+    re.IGNORECASE,
+)
+
+
+def quoted_text(description: str) -> List[str]:
+    """Literal text quoted in a description, e.g. "the button with the text 'Home'"
+
+    Args:
+        description (str): The description
+
+    Returns:
+        List[str]: The quoted text, in order
+    """
+    return [
+        next(group for group in match.groups() if group).strip()
+        for match in QUOTED_RE.finditer(description)
+        if any(group and group.strip() for group in match.groups())
+    ]
+
+
+def names_own_text(description: str) -> bool:
+    """Whether a description quotes the element's own text, so the text can be clicked to click it
+
+    "the button with the text 'Home'" names the button's own text, "a text field labelled 'Email'" quotes
+    a label next to the field, clicking that text would miss the field.
+
+    Args:
+        description (str): The description
+
+    Returns:
+        bool: Whether the quoted text is the text of the element described
+    """
+    return bool(TEXT_ELEMENT_RE.search(description)) and not RELATION_RE.search(
+        description
+    )
+
+
+def _normalize(word: str) -> str:
+    return re.sub(r"[^\w]", "", word.casefold())
+
+
+@dataclass
+class Word:
+    """A word found in an image"""
+
+    text: str
+    box: Box
+    confidence: float
+    line: Tuple[int, int, int]
+
+
+@dataclass
+class TextMatch:
+    """Where some text was found in an image"""
+
+    text: str
+    box: Box
+    confidence: float
+
+
+def match_words(
+    words: List[Word], text: str, min_confidence: float = 80
+) -> List[TextMatch]:
+    """Find every run of consecutive words on a line that spells the text
+
+    Args:
+        words (List[Word]): Words found in the image, in reading order
+        text (str): Text to find, matched ignoring case and punctuation
+        min_confidence (float, optional): Min confidence of every word in a match. Defaults to 80.
+
+    Returns:
+        List[TextMatch]: The matches
+    """
+    target = [_normalize(part) for part in text.split()]
+    target = [part for part in target if part]
+    if not target:
+        return []
+
+    matches = []
+    for start in range(len(words) - len(target) + 1):
+        run = words[start : start + len(target)]
+        if any(word.line != run[0].line for word in run):
+            continue
+        if [_normalize(word.text) for word in run] != target:
+            continue
+        confidence = min(word.confidence for word in run)
+        if confidence < min_confidence:
+            continue
+        matches.append(
+            TextMatch(
+                text=" ".join(word.text for word in run),
+                box=Box(
+                    min(word.box.left for word in run),
+                    min(word.box.top for word in run),
+                    max(word.box.right for word in run),
+                    max(word.box.bottom for word in run),
+                ),
+                confidence=confidence,
+            )
+        )
+    return matches
+
+
+class TextLocator:
+    """
+    Finds literal text in screenshots with local OCR, no network or model calls needed.
+
+    Needs the optional `pytesseract` package and the tesseract binary, if either is missing the locator
+    reports itself unavailable and never finds anything. The words found in the latest screenshot are
+    kept, so several descriptions grounded on the same screen only run OCR once.
+    """
+
+    def __init__(self, min_confidence: float = 80) -> None:
+        """
+        Initialize the locator.
+
+        Args:
+            min_confidence (float, optional): Min OCR confidence of a word to match. Defaults to 80.
+        """
+        self.min_confidence = min_confidence
+        self._available: Optional[bool] = None
+        self._digest: Optional[str] = None
+        self._words: List[Word] = []
+        self._lock = threading.Lock()
+
+    @property
+    def available(self) -> bool:
+        """Whether OCR can run here"""
+        if self._available is None:
+            if pytesseract is None:
+                self._available = False
+            else:
+                try:
+                    pytesseract.get_tesseract_version()
+                    self._available = True
+                except Exception as e:
+                    logger.info(f"OCR pre-filter disabled, tesseract unavailable: {e}")
+                    self._available = False
+        return self._available
+
+    def find(
+        self, img: Image.Image, text: str, digest: Optional[str] = None
+    ) -> List[TextMatch]:
+        """Find text in an image
+
+        Args:
+            img (Image.Image): The image
+            text (str): The text
+            digest (Optional[str], optional): Hash of the image if already known. Defaults to None.
+
+        Returns:
+            List[TextMatch]: Where it was found
+        """
+        if not self.available:
+            return []
+        return match_words(self.words(img, digest), text, self.min_confidence)
+
+    def words(self, img: Image.Image, digest: Optional[str] = None) -> List[Word]:
+        """Words in an image, OCR only runs the first time for each image
+
+        Args:
+            img (Image.Image): The image
+            digest (Optional[str], optional): Hash of the image if already known. Defaults to None.
+
+        Returns:
+            List[Word]: The words, in reading order
+        """
+        digest = digest if digest else image_hash(img)
+        with self._lock:
+            if digest != self._digest:
+                self._words = self._ocr(img)
+                self._digest = digest
+            return self._words
+
+    def _ocr(self, img: Image.Image) -> List[Word]:
+        data = pytesseract.image_to_data(img, output_type=pytesseract.Output.DICT)
+        words = []
+        for i, text in enumerate(data["text"]):
+            confidence = float(data["conf"][i])
+            if not text.strip() or confidence < 0:
+                continue
+            left, top = data["left"][i], data["top"][i]
+            words.append(
+                Word(
+                    text=text,
+                    box=Box(
+                        left, top, left + data["width"][i], top + data["height"][i]
+                    ),
+                    confidence=confidence,
+                    line=(
+                        data["block_num"][i],
+                        data["par_num"][i],
+                        data["line_num"][i],
+                    ),
+                )
+            )
+        return words
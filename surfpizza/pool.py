@@ -0,0 +1,209 @@
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import requests
+from agentdesk.device_v1 import Desktop
+from mllm import RoleMessage
+
+logger = logging.getLogger(__name__)
+logger.setLevel(int(os.getenv("LOG_LEVEL", logging.DEBUG)))
+
+
+class WarmDesktop:
+    """
+    Setup state for a desktop that can be reused by every task that runs on it.
+
+    Holds reusable HTTP sessions for talking to the desktop, the desktop info, the tool schemas
+    sent to the model and the system prompt handshake, so back to back tasks on the same desktop
+    skip those round trips. Each task checks out a session of its own, so tasks running on the
+    desktop at the same time don't share one, and returns it for the next task when it is done.
+    """
+
+    def __init__(self, base_url: str) -> None:
+        self.base_url = base_url
+        self.info: Optional[Dict[str, Any]] = None
+        self.tools: Optional[List[Dict[str, Any]]] = None
+        self.system_prompt: Optional[str] = None
+        self.system_response: Optional[RoleMessage] = None
+        self.last_used = time.time()
+        self.lock = threading.Lock()
+
+        # Tasks using the entry, it is only closed once none are
+        self.users = 0
+        self.retired = False
+        self._sessions: List[requests.Session] = []
+        self._sessions_lock = threading.Lock()
+
+    def acquire_session(self) -> requests.Session:
+        """Check out a session for a task, reusing an idle one if there is one
+
+        Returns:
+            requests.Session: The session
+        """
+        with self._sessions_lock:
+            if self._sessions:
+                return self._sessions.pop()
+        return requests.Session()
+
+    def release_session(self, session: requests.Session) -> None:
+        """Return a session checked out with `acquire_session`, for the next task to reuse
+
+        Args:
+            session (requests.Session): The session
+        """
+        with self._sessions_lock:
+            if not self.retired:
+                self._sessions.append(session)
+                return
+        session.close()
+
+    def get_info(self, desktop: Desktop) -> Dict[str, Any]:
+        """Desktop info, fetched on first use
+
+        Args:
+            desktop (Desktop): The desktop
+
+        Returns:
+            Dict[str, Any]: Desktop info
+        """
+        with self.lock:
+            if self.info is None:
+                self.info = desktop.info()
+            return self.info
+
+    def get_tools(
+        self, build: Callable[[], List[Dict[str, Any]]]
+    ) -> List[Dict[str, Any]]:
+        """Tool schemas, built on first use
+
+        Args:
+            build (Callable[[], List[Dict[str, Any]]]): Builds the schemas
+
+        Returns:
+            List[Dict[str, Any]]: Tool schemas
+        """
+        with self.lock:
+            if self.tools is None:
+                self.tools = build()
+            return self.tools
+
+    def get_system_response(
+        self, prompt: str, handshake: Callable[[str], RoleMessage]
+    ) -> RoleMessage:
+        """The model's reply to the system prompt, only asking again if the prompt changed
+
+        Args:
+            prompt (str): The system prompt
+            handshake (Callable[[str], RoleMessage]): Sends the prompt and returns the reply
+
+        Returns:
+            RoleMessage: The reply
+        """
+        with self.lock:
+            if self.system_response is None or self.system_prompt != prompt:
+                self.system_response = handshake(prompt)
+                self.system_prompt = prompt
+            else:
+                logger.debug(f"reusing system prompt handshake for {self.base_url}")
+            return self.system_response
+
+    def close(self) -> None:
+        with self._sessions_lock:
+            self.retired = True
+            sessions, self._sessions = self._sessions, []
+        for session in sessions:
+            session.close()
+
+
+class DesktopPool:
+    """
+    A pool of `WarmDesktop` entries keyed by desktop base URL.
+
+    Each `get` must be paired with a `release` once the task is done with the entry. Entries no task
+    is using that haven't been used for `idle_timeout` seconds are evicted the next time the pool is
+    accessed, and an entry evicted while in use is only closed once its last task releases it.
+    """
+
+    def __init__(self, idle_timeout: float = 600) -> None:
+        """
+        Initialize the pool.
+
+        Args:
+            idle_timeout (float, optional): Seconds an entry can sit unused before it is evicted. Defaults to 600.
+        """
+        self.idle_timeout = idle_timeout
+        self._entries: Dict[str, WarmDesktop] = {}
+        self._lock = threading.Lock()
+
+    def get(self, desktop: Desktop) -> WarmDesktop:
+        """Get the warm entry for a desktop, creating it if needed, release it when done
+
+        Args:
+            desktop (Desktop): The desktop
+
+        Returns:
+            WarmDesktop: The warm entry
+        """
+        base_url = desktop.base_url
+        with self._lock:
+            self._evict_idle()
+            entry = self._entries.get(base_url)
+            if entry is None:
+                logger.debug(f"creating warm desktop entry for {base_url}")
+                entry = WarmDesktop(base_url)
+                self._entries[base_url] = entry
+            entry.users += 1
+            entry.last_used = time.time()
+            return entry
+
+    def release(self, entry: WarmDesktop) -> None:
+        """Stop using an entry got with `get`
+
+        Args:
+            entry (WarmDesktop): The entry
+        """
+        with self._lock:
+            entry.users -= 1
+            entry.last_used = time.time()
+            close = entry.users == 0 and self._entries.get(entry.base_url) is not entry
+        if close:
+            entry.close()
+
+    def evict(self, base_url: str) -> None:
+        """Drop the entry for a desktop, e.g. when it has been recreated
+
+        Args:
+            base_url (str): Base URL of the desktop
+        """
+        with self._lock:
+            entry = self._entries.pop(base_url, None)
+            close = entry is not None and entry.users == 0
+        if close:
+            entry.close()  # type: ignore
+
+    def clear(self) -> None:
+        """Drop all entries"""
+        with self._lock:
+            entries = [entry for entry in self._entries.values() if entry.users == 0]
+            self._entries.clear()
+        for entry in entries:
+            entry.close()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _evict_idle(self) -> None:
+        now = time.time()
+        for base_url, entry in list(self._entries.items()):
+            if entry.users == 0 and now - entry.last_used > self.idle_timeout:
+                logger.debug(f"evicting idle warm desktop entry for {base_url}")
+                del self._entries[base_url]
+                entry.close()
+
+
+desktop_pool = DesktopPool(
+    idle_timeout=float(os.getenv("DESKTOP_POOL_IDLE_TIMEOUT", 600))
+)
@@ -0,0 +1,128 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+from agentdesk.device_v1 import Desktop
+from PIL import Image
+
+from . import metrics
+from .trace import TraceRecorder
+from .workers import ImageWorkerPool, encode_b64
+
+logger = logging.getLogger(__name__)
+logger.setLevel(int(os.getenv("LOG_LEVEL", logging.DEBUG)))
+
+
+@dataclass
+class Frame:
+    """A screenshot of the desktop, encoded and ready to send"""
+
+    image: Image.Image
+    b64: str
+    mouse: Tuple[int, int]
+    taken_at: float
+
+
+class ScreenshotPrefetcher:
+    """
+    Captures the next screenshot in the background while the current step finishes.
+
+    After an action is taken `schedule` waits for the screen to settle, then takes the screenshot,
+    reads the mouse coordinates and encodes the image on a worker thread, while the step posts its
+    messages and records the action. The next step's `get` then only waits for whatever of that is
+    left, rather than doing it all serially after a fixed sleep.
+    """
+
+    def __init__(
+        self,
+        desktop: Desktop,
+        settle: float = 2.0,
+        workers: Optional[ImageWorkerPool] = None,
+        trace: Optional[TraceRecorder] = None,
+    ) -> None:
+        """
+        Initialize the prefetcher.
+
+        Args:
+            desktop (Desktop): Desktop to capture.
+            settle (float, optional): Seconds to let the screen settle after an action. Defaults to 2.0.
+            workers (Optional[ImageWorkerPool], optional): Pool to encode screenshots in. Defaults to None.
+            trace (Optional[TraceRecorder], optional): Trace to record the screenshots in. Defaults to None.
+        """
+        self.desktop = desktop
+        self.settle = settle
+        self.workers = workers
+        self.trace = trace
+        self.hits = 0
+        self.misses = 0
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="prefetch"
+        )
+        self._pending: Optional[Future] = None
+        self._lock = threading.Lock()
+
+    def schedule(self, delay: Optional[float] = None) -> None:
+        """Start capturing the next frame
+
+        Args:
+            delay (Optional[float], optional): Seconds to wait before capturing. Defaults to the settle time.
+        """
+        delay = self.settle if delay is None else delay
+        with self._lock:
+            if self._pending:
+                self._pending.cancel()
+            self._pending = self._executor.submit(self._capture, delay)
+
+    def get(self) -> Frame:
+        """Get the next frame, capturing it now if it wasn't scheduled
+
+        Returns:
+            Frame: The frame
+        """
+        with self._lock:
+            pending, self._pending = self._pending, None
+
+        if pending:
+            start = time.time()
+            try:
+                frame = pending.result()
+                self.hits += 1
+                metrics.prefetch_frames.inc(result="hit")
+                logger.debug(f"waited {time.time() - start:.3f}s for prefetched frame")
+                return frame
+            except Exception as e:
+                # Capture again on this thread so the error surfaces where the step can retry it
+                logger.warning(f"prefetching frame failed, capturing again: {e}")
+
+        self.misses += 1
+        metrics.prefetch_frames.inc(result="miss")
+        return self._capture(0)
+
+    def close(self) -> None:
+        """Drop any pending capture and stop the worker"""
+        with self._lock:
+            if self._pending:
+                self._pending.cancel()
+            self._pending = None
+        self._executor.shutdown(wait=False)
+
+    def _capture(self, delay: float) -> Frame:
+        if delay > 0:
+            time.sleep(delay)
+        start = time.perf_counter()
+        with metrics.screenshot_latency.time():
+            image = self.desktop.take_screenshots()[0]
+        mouse = self.desktop.mouse_coordinates()
+        if self.trace:
+            self.trace.screenshot(image, mouse, seconds=time.perf_counter() - start)
+        return Frame(
+            image=image,
+            b64=encode_b64(image, self.workers),
+            mouse=mouse,
+            taken_at=time.time(),
+        )
@@ -0,0 +1,310 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from mllm import Prompt
+from PIL import Image
+from skillpacks import EnvState
+from skillpacks.server.models import V1Action
+from taskara import Task
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+from toolfuse.models import V1ToolRef
+
+from . import metrics
+from .img import DataURI, image_hash
+from .retry import is_transient
+from .store import ImageStore, get_image_store
+
+logger = logging.getLogger(__name__)
+logger.setLevel(int(os.getenv("LOG_LEVEL", logging.DEBUG)))
+
+
+@dataclass
+class _Entry:
+    """An upload waiting in the buffer"""
+
+    seq: int
+    kind: str
+    prompt: Optional[Prompt] = None
+    action: Optional[V1Action] = None
+    tool: Optional[V1ToolRef] = None
+    result: Any = None
+    agent_id: Optional[str] = None
+    model: Optional[str] = None
+    image_hashes: List[str] = field(default_factory=list)
+    images: List[Image.Image] = field(default_factory=list)
+
+
+class ActionRecorder:
+    """
+    A buffer for the prompts and actions a task records, uploaded in the background.
+
+    `add_prompt` and `record_action` buffer the entry in memory and return straight away, a background
+    thread then uploads the buffered entries to the task server in batches. Screenshots are saved in
+    the image store by content hash and recently uploaded ones are reused, so an unchanged screen isn't
+    written or converted again. Call `close` when the task is done to flush whatever is left.
+
+    Each entry is also appended to a compact on-disk log, along with whether its upload succeeded, to
+    see what a task recorded and what didn't make it. The log only holds ids and metadata, not the
+    prompts and screenshots, so it can't be replayed and entries not uploaded when the process exits
+    are lost.
+    """
+
+    def __init__(
+        self,
+        task: Task,
+        data_path: str = "./.data",
+        batch_size: int = 8,
+        flush_interval: float = 2.0,
+        store: Optional[ImageStore] = None,
+    ) -> None:
+        """
+        Initialize the recorder and start its uploader.
+
+        Args:
+            task (Task): Task to record to.
+            data_path (str, optional): Path to data. Defaults to "./.data".
+            batch_size (int, optional): Max entries uploaded per batch. Defaults to 8.
+            flush_interval (float, optional): Max seconds an entry waits before being uploaded. Defaults to 2.0.
+            store (Optional[ImageStore], optional): Store to save screenshots in. Defaults to the store for the data path.
+        """
+        self.task = task
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.store = store if store else get_image_store(data_path)
+        self.log_dir = os.path.join(data_path, "uploads", task.id)
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.log_path = os.path.join(self.log_dir, "log.jsonl")
+
+        self._log_lock = threading.Lock()
+        self._log = open(self.log_path, "a", encoding="utf-8")
+        self._queue: "queue.Queue[Optional[_Entry]]" = queue.Queue()
+        self._seq = 0
+        self._converted_images: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()
+        self._max_converted = 4
+        self._closed = False
+
+        self.uploaded = 0
+        self.failed = 0
+
+        self._thread = threading.Thread(
+            target=self._run, name=f"recorder-{task.id}", daemon=True
+        )
+        self._thread.start()
+
+    def add_prompt(self, prompt: Prompt) -> None:
+        """Buffer a prompt for upload
+
+        Args:
+            prompt (Prompt): The prompt
+        """
+        entry = _Entry(seq=self._next_seq(), kind="prompt", prompt=prompt)
+        self._append(entry, {"prompt_id": prompt.id})
+        self._queue.put(entry)
+
+    def record_action(
+        self,
+        images: List[Image.Image],
+        prompt: Prompt,
+        action: V1Action,
+        tool: V1ToolRef,
+        result: Any = None,
+        agent_id: Optional[str] = None,
+        model: Optional[str] = None,
+    ) -> None:
+        """Buffer an action for upload
+
+        Args:
+            images (List[Image.Image]): Screenshots of the state the action was taken in
+            prompt (Prompt): Prompt that selected the action
+            action (V1Action): The action
+            tool (V1ToolRef): Tool the action was taken with
+            result (Any, optional): Result of the action. Defaults to None.
+            agent_id (Optional[str], optional): ID of the agent. Defaults to None.
+            model (Optional[str], optional): Model that selected the action. Defaults to None.
+        """
+        hashes = [image_hash(img) for img in images]
+        entry = _Entry(
+            seq=self._next_seq(),
+            kind="action",
+            prompt=prompt,
+            action=action,
+            tool=tool,
+            result=result,
+            agent_id=agent_id,
+            model=model,
+            image_hashes=hashes,
+            images=images,
+        )
+        self._append(
+            entry,
+            {
+                "prompt_id": prompt.id,
+                "action": action.model_dump(),
+                "tool": tool.model_dump(),
+                "result": result,
+                "agent_id": agent_id,
+                "model": model,
+                "images": hashes,
+            },
+        )
+        self._queue.put(entry)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait for everything buffered so far to be uploaded
+
+        Args:
+            timeout (Optional[float], optional): Max seconds to wait. Defaults to None.
+
+        Returns:
+            bool: Whether the buffer drained in time
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def close(self, timeout: Optional[float] = 60) -> None:
+        """Flush the buffer and stop the uploader
+
+        Args:
+            timeout (Optional[float], optional): Max seconds to wait for the flush. Defaults to 60.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+
+        # The uploader closes the log once it is done, if it is still going it
+        # carries on in the background until the process exits
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning(
+                f"recorder for task {self.task.id} did not flush in time, "
+                f"{self._queue.unfinished_tasks - 1} uploads are still pending"
+            )
+            return
+        logger.debug(
+            f"recorder closed for task {self.task.id}, uploaded {self.uploaded}, failed {self.failed}"
+        )
+
+    def _next_seq(self) -> int:
+        with self._log_lock:
+            self._seq += 1
+            return self._seq
+
+    def _append(self, entry: _Entry, data: Dict[str, Any]) -> None:
+        record = {"seq": entry.seq, "kind": entry.kind, "time": time.time(), **data}
+        line = json.dumps(record, default=str, separators=(",", ":"))
+        with self._log_lock:
+            if self._log.closed:
+                return
+            self._log.write(line + "\n")
+            self._log.flush()
+
+    def _convert_image(self, digest: str, img: Image.Image) -> Tuple[str, int]:
+        # Convert each distinct screenshot once, this is where it is encoded and
+        # possibly uploaded to storage, recent ones are kept as the screen often
+        # doesn't change between steps. Also returns the image bytes this use
+        # uploads, a stored image is only uploaded once but an inline one is
+        # sent along with every action
+        cached = self._converted_images.get(digest)
+        if cached is None:
+            uri = DataURI.from_image(img)
+            converted = EnvState(images=[str(uri)]).images[0]  # type: ignore
+            cached = self._converted_images[digest] = (converted, len(uri.raw))  # type: ignore
+            if len(self._converted_images) > self._max_converted:
+                self._converted_images.popitem(last=False)
+            return cached
+
+        self._converted_images.move_to_end(digest)
+        converted, nbytes = cached
+        return converted, nbytes if converted.startswith("data:") else 0
+
+    def _run(self) -> None:
+        done = False
+        while not done:
+            batch: List[_Entry] = []
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+
+            if item is None:
+                done = True
+            else:
+                batch.append(item)
+
+            # Gather whatever else is buffered, up to a batch
+            while not done and len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    done = True
+                else:
+                    batch.append(item)
+
+            for entry in batch:
+                self._upload_entry(entry)
+            if done:
+                # account for the close marker
+                self._queue.task_done()
+
+        with self._log_lock:
+            self._log.close()
+
+    def _upload_entry(self, entry: _Entry) -> None:
+        try:
+            for digest, img in zip(entry.image_hashes, entry.images):
+                self.store.put(img, self.task.id, f"action_{entry.seq}", digest=digest)
+            self._upload(entry)
+            self.uploaded += 1
+            self._append(entry, {"ack": True})
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"failed to upload {entry.kind} {entry.seq}: {e}")
+            self._append(entry, {"ack": False, "error": str(e)})
+        finally:
+            entry.images = []
+            self._queue.task_done()
+
+    @retry(
+        retry=retry_if_exception(is_transient),
+        wait=wait_exponential(multiplier=0.5, max=10),
+        stop=stop_after_attempt(5),
+        reraise=True,
+    )
+    def _upload(self, entry: _Entry) -> None:
+        if entry.kind == "prompt":
+            self.task.add_prompt(entry.prompt)  # type: ignore
+            return
+
+        converted = [
+            self._convert_image(digest, img)
+            for digest, img in zip(entry.image_hashes, entry.images)
+        ]
+        images: List[str | Image.Image | None] = [img for img, _ in converted]
+
+        metrics.image_bytes_uploaded.inc(
+            sum(nbytes for _, nbytes in converted), kind="action"
+        )
+        self.task.record_action(
+            state=EnvState(images=images),
+            prompt=entry.prompt,
+            action=entry.action,  # type: ignore
+            tool=entry.tool,  # type: ignore
+            result=entry.result,
+            agent_id=entry.agent_id,
+            model=entry.model,
+        )
@@ -0,0 +1,453 @@
+import argparse
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack, contextmanager
+from dataclasses import asdict, dataclass, field
+from types import SimpleNamespace
+from typing import Any, Callable, Deque, Dict, Final, Iterator, List, Optional, Tuple
+
+import requests
+import skillpacks.img
+from agentdesk.device_v1 import Desktop
+from mllm import ChatResponse
+from PIL import Image
+from taskara import TaskStatus
+from threadmem import RoleMessage, RoleThread
+from toolfuse import Tool
+
+from . import metrics
+from .agent import SurfPizza
+from .history import StepHistory
+from .pool import desktop_pool
+from .recorder import ActionRecorder
+from .tool import SemanticDesktop, set_router
+from .trace import TraceBundle, thread_digest
+from .zoom import ZoomTree
+
+logger = logging.getLogger(__name__)
+logger.setLevel(int(os.getenv("LOG_LEVEL", logging.DEBUG)))
+
+# The agent's own work timed during a replay, phases nest so a step includes the others
+TIMED_PHASES: Final[List[Tuple[str, Any, str]]] = [
+    ("step", SurfPizza, "take_action"),
+    ("select_action", SurfPizza, "_select_action"),
+    ("history", StepHistory, "build"),
+    ("ground", SemanticDesktop, "_ground"),
+    ("zoom", ZoomTree, "expand"),
+    ("encode", ZoomTree, "encoded"),
+    ("debug_image", SemanticDesktop, "_debug_image"),
+    ("record", ActionRecorder, "record_action"),
+]
+
+# Held while a replay has the process-wide state patched
+_replay_lock = threading.Lock()
+
+
+class ReplayDivergence(Exception):
+    """The replayed run asked for something the recorded run didn't"""
+
+
+class PhaseTimer:
+    """
+    Adds up the time spent in each phase of a replay, and how many times each was entered.
+    """
+
+    def __init__(self) -> None:
+        self.seconds: Dict[str, float] = {}
+        self.calls: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, phase: str) -> Iterator[None]:
+        """Time a block as part of a phase
+
+        Args:
+            phase (str): Name of the phase
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.seconds[phase] = self.seconds.get(phase, 0.0) + elapsed
+                self.calls[phase] = self.calls.get(phase, 0) + 1
+
+    @contextmanager
+    def timing(self, phase: str, owner: Any, attr: str) -> Iterator[None]:
+        """Time every call of a method as part of a phase, until the block exits
+
+        Args:
+            phase (str): Name of the phase
+            owner (Any): Class of the method
+            attr (str): Name of the method
+        """
+        original = owner.__dict__[attr]
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            with self.span(phase):
+                return original(*args, **kwargs)
+
+        with _patched(owner, attr, timed):
+            yield
+
+
+@dataclass
+class _ReplayPrompt:
+    """Stands in for the prompt of a replayed response"""
+
+    id: str
+
+
+class ReplayRouter:
+    """
+    Answers router requests with the recorded responses, in the order they were recorded per namespace.
+
+    Requests that failed in the recorded run have no response and are skipped, so the replayed request
+    is served whatever the recorded run asked next in that namespace, a re-ask after a bad parse, a retry
+    by the caller or the next step's request. Replays of runs with failed requests can therefore drift
+    from the recording, see `request_mismatches`. If the system prompt handshake was reused from an
+    earlier task it wasn't recorded, and a fixed reply is served for it.
+    """
+
+    def __init__(self, bundle: TraceBundle, timer: PhaseTimer) -> None:
+        self.timer = timer
+        self.calls: Dict[str, int] = {}
+        self.request_mismatches = 0
+        self._responses: Dict[str, Deque[Dict[str, Any]]] = {}
+        for event in bundle.of("llm"):
+            if event.get("response"):
+                self._responses.setdefault(event["namespace"], deque()).append(event)
+        self._lock = threading.Lock()
+
+    def chat(
+        self,
+        thread: RoleThread,
+        namespace: str = "default",
+        expect: Optional[type] = None,
+        **kwargs: Any,
+    ) -> ChatResponse:
+        """Serve the next recorded response for the namespace, see `Router.chat`
+
+        Args:
+            thread (RoleThread): Thread sent
+            namespace (str, optional): Namespace of the request. Defaults to "default".
+            expect (Optional[type], optional): Model to parse the response into. Defaults to None.
+
+        Returns:
+            ChatResponse: The response
+        """
+        with self.timer.span(f"llm_{namespace}"):
+            with self._lock:
+                queue = self._responses.get(namespace)
+                event = queue.popleft() if queue else None
+                count = self.calls[namespace] = self.calls.get(namespace, 0) + 1
+
+            prompt = _ReplayPrompt(id=f"replay-{namespace}-{count}")
+            if event is None:
+                if namespace == "system":
+                    return ChatResponse(
+                        model="replay",
+                        msg=RoleMessage(role="assistant", text="Ready"),
+                        time_elapsed=0.0,
+                        tokens_request=0,
+                        tokens_response=0,
+                        prompt=prompt,  # type: ignore
+                    )
+                raise ReplayDivergence(f"no recorded '{namespace}' response left")
+
+            if thread_digest(thread) != event["request"]["digest"]:
+                with self._lock:
+                    self.request_mismatches += 1
+
+            response = event["response"]
+            parsed = response["parsed"]
+            return ChatResponse(
+                model=response["model"],
+                msg=RoleMessage(role=response["role"], text=response["text"]),
+                time_elapsed=response["time_elapsed"],
+                tokens_request=response["tokens_request"],
+                tokens_response=response["tokens_response"],
+                prompt=prompt,  # type: ignore
+                parsed=(
+                    expect.model_validate(parsed)  # type: ignore
+                    if expect and parsed is not None
+                    else None
+                ),
+            )
+
+
+class ReplayDesktop(Desktop):
+    """
+    A desktop that shows the recorded screenshots, in order, and answers the model's actions with their
+    recorded results, without talking to anything.
+    """
+
+    def __init__(self, bundle: TraceBundle, timer: PhaseTimer) -> None:
+        """
+        Initialize the desktop, skipping the connection a real desktop makes.
+
+        Args:
+            bundle (TraceBundle): Bundle to replay.
+            timer (PhaseTimer): Timer for the replay.
+        """
+        Tool.__init__(self)
+        self.bundle = bundle
+        self.timer = timer
+        self.base_url = f"replay://{os.path.abspath(bundle.path)}"
+        self.screenshots_served = 0
+
+        self._screenshots = deque(bundle.of("screenshot"))
+        self._mouse: Tuple[int, int] = (0, 0)
+        self._last: Optional[Dict[str, Any]] = None
+        self._results: Dict[str, Deque[Dict[str, Any]]] = {}
+        for event in bundle.of("action"):
+            self._results.setdefault(event["name"], deque()).append(event)
+        self._lock = threading.Lock()
+
+        for action in self._actions_list + self._observations_list:
+            action.method = self._stub(action.name)
+
+    def info(self) -> Dict[str, Any]:
+        info = self.bundle.header.get("info")
+        if info:
+            return info
+        first = self.bundle.of("screenshot")[0]
+        width, height = self.bundle.image(first["hash"]).size
+        return {"screen_size": {"x": width, "y": height}}
+
+    def open_url(self, url: str) -> None:
+        pass
+
+    def take_screenshots(self, count: int = 1, delay: float = 0.0) -> List[Image.Image]:
+        with self.timer.span("screenshot"):
+            with self._lock:
+                if self._screenshots:
+                    self._last = self._screenshots.popleft()
+                    if self._last.get("mouse"):
+                        self._mouse = tuple(self._last["mouse"])  # type: ignore
+                elif self._last is None:
+                    raise ReplayDivergence("no recorded screenshots")
+                self.screenshots_served += 1
+                digest = self._last["hash"]
+            return [self.bundle.image(digest)]
+
+    def mouse_coordinates(self) -> Tuple[int, int]:
+        return self._mouse
+
+    def _stub(self, name: str) -> Callable[..., Any]:
+        def stub(*args, **kwargs) -> Any:
+            with self.timer.span("action"):
+                with self._lock:
+                    queue = self._results.get(name)
+                    event = queue.popleft() if queue else None
+                if event and event.get("error"):
+                    raise RuntimeError(event["error"])
+                return event["result"] if event else None
+
+        return stub
+
+
+class ReplaySession(requests.Session):
+    """
+    A session that answers every request to the desktop with an empty success, keeping the clicks sent.
+    """
+
+    def __init__(self, timer: PhaseTimer) -> None:
+        super().__init__()
+        self.timer = timer
+        self.moves: List[Tuple[int, int]] = []
+
+    def request(self, method: str, url: str, *args, **kwargs) -> requests.Response:  # type: ignore
+        with self.timer.span("input"):
+            body = kwargs.get("json") or {}
+            if url.endswith("/v1/move_mouse"):
+                self.moves.append((body["x"], body["y"]))
+            response = requests.Response()
+            response.status_code = 200
+            response.url = url
+            response._content = b"{}"
+            return response
+
+
+class ReplayTask:
+    """
+    Stands in for the task of a replay, keeping its status and dropping everything it is sent.
+    """
+
+    def __init__(self, task_id: str, description: Optional[str]) -> None:
+        self.id = task_id
+        self.description = description
+        self.remote = None
+        self.auth_token = None
+        self._parameters = None
+        self.status = TaskStatus.IN_PROGRESS
+        self.error: Optional[str] = None
+        self.messages = 0
+
+    def post_message(self, *args, **kwargs) -> None:
+        self.messages += 1
+
+    def ensure_thread(self, *args, **kwargs) -> None:
+        pass
+
+    def add_prompt(self, *args, **kwargs) -> None:
+        pass
+
+    def record_action(self, *args, **kwargs) -> None:
+        pass
+
+    def save(self) -> None:
+        pass
+
+
+@dataclass
+class ReplayReport:
+    """How a replay went, and where its time was spent"""
+
+    status: str
+    seconds: float
+    error: Optional[str] = None
+    phases: Dict[str, float] = field(default_factory=dict)
+    calls: Dict[str, int] = field(default_factory=dict)
+    recorded: Dict[str, float] = field(default_factory=dict)
+    screenshots: int = 0
+    request_mismatches: int = 0
+    clicks_match: bool = True
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+@contextmanager
+def _patched(owner: Any, attr: str, value: Any) -> Iterator[None]:
+    original = getattr(owner, attr)
+    setattr(owner, attr, value)
+    try:
+        yield
+    finally:
+        setattr(owner, attr, original)
+
+
+def _offline(*args, **kwargs) -> Any:
+    raise RuntimeError("no storage while replaying")
+
+
+@contextmanager
+def _environ(values: Dict[str, str], drop: List[str]) -> Iterator[None]:
+    previous = {key: os.environ.get(key) for key in list(values) + drop}
+    os.environ.update(values)
+    for key in drop:
+        os.environ.pop(key, None)
+    try:
+        yield
+    finally:
+        for key, value in previous.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+
+def replay(path: str, max_steps: int = 30) -> ReplayReport:
+    """Run a task again from a recorded bundle, as fast as possible and without the network
+
+    The recorded screenshots and responses are fed through the real agent code, with the waits for the
+    screen to settle turned off, and the time spent in each phase of the agent's own work is reported
+    next to the time the recorded run spent on the desktop and the model.
+
+    This is for the command line and tests only. While it runs it swaps out process-wide state, the
+    router, the storage client of `skillpacks.img`, the agent methods it times, the desktop pool and
+    environment variables, so it refuses to run while tasks are being solved in the same process and
+    must never be called from the server.
+
+    Args:
+        path (str): Directory of the bundle, see `TraceRecorder`
+        max_steps (int, optional): Max steps to replay. Defaults to 30.
+
+    Returns:
+        ReplayReport: The report
+
+    Raises:
+        RuntimeError: If tasks are being solved in this process or another replay is running
+    """
+    if metrics.active_tasks.value() > 0:
+        raise RuntimeError(
+            "replay patches process-wide state, can't run next to live tasks"
+        )
+    if not _replay_lock.acquire(blocking=False):
+        raise RuntimeError("another replay is already running in this process")
+    try:
+        return _replay(path, max_steps)
+    finally:
+        _replay_lock.release()
+
+
+def _replay(path: str, max_steps: int) -> ReplayReport:
+    bundle = TraceBundle(path)
+    timer = PhaseTimer()
+    router = ReplayRouter(bundle, timer)
+    desktop = ReplayDesktop(bundle, timer)
+    session = ReplaySession(timer)
+    header = bundle.header
+    task = ReplayTask(
+        f"replay-{header.get('task_id', os.path.basename(path))}",
+        header.get("description"),
+    )
+
+    with ExitStack() as stack:
+        stack.enter_context(
+            _environ(
+                {"STEP_SETTLE_SECONDS": "0", "CLICK_SETTLE_SECONDS": "0"},
+                drop=["TRACE_DIR"],
+            )
+        )
+        # Recorded actions keep their images inline rather than probing for cloud storage
+        stack.enter_context(
+            _patched(skillpacks.img, "storage", SimpleNamespace(Client=_offline))
+        )
+        for phase, owner, attr in TIMED_PHASES:
+            stack.enter_context(timer.timing(phase, owner, attr))
+        set_router(router)  # type: ignore
+        stack.callback(set_router, None)
+        # The run checks out the stub session as its session to the desktop
+        warm = desktop_pool.get(desktop)
+        warm.release_session(session)
+        desktop_pool.release(warm)
+        stack.callback(desktop_pool.evict, desktop.base_url)
+
+        start = time.perf_counter()
+        SurfPizza().solve_task(task, desktop, max_steps)  # type: ignore
+        seconds = time.perf_counter() - start
+
+    recorded_clicks = [
+        (e["parameters"]["x"], e["parameters"]["y"])
+        for e in bundle.of("input")
+        if e["name"] == "click"
+    ]
+    return ReplayReport(
+        status=task.status.value,
+        seconds=seconds,
+        error=task.error,
+        phases=dict(timer.seconds),
+        calls=dict(timer.calls),
+        recorded=bundle.recorded_phases(),
+        screenshots=desktop.screenshots_served,
+        request_mismatches=router.request_mismatches,
+        clicks_match=session.moves == recorded_clicks,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a recorded task run")
+    parser.add_argument("path", help="directory of the bundle to replay")
+    parser.add_argument("--max-steps", type=int, default=30)
+    args = parser.parse_args()
+
+    print(json.dumps(replay(args.path, args.max_steps).to_dict(), indent=2))
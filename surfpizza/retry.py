@@ -0,0 +1,240 @@
+import json
+import logging
+import os
+import threading
+from enum import Enum
+from typing import Callable, Dict, Final
+
+import openai
+import requests
+import urllib3
+from pydantic import ValidationError
+from tenacity import (
+    RetryCallState,
+    RetryError,
+    Retrying,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+logger: Final = logging.getLogger(__name__)
+logger.setLevel(int(os.getenv("LOG_LEVEL", str(logging.DEBUG))))
+
+# HTTP status codes worth retrying after a back off
+RETRYABLE_STATUS_CODES: Final = {408, 425, 429, 500, 502, 503, 504}
+
+# HTTP status codes a proxy or server returns without having handled the request
+UNDELIVERED_STATUS_CODES: Final = {502, 503}
+
+
+class ParseError(Exception):
+    """The model's response couldn't be turned into a usable action"""
+
+
+class ActionError(Exception):
+    """Taking the action selected by the model failed"""
+
+
+class ErrorKind(str, Enum):
+    """What kind of failure an error is, which decides how it is retried"""
+
+    PARSE = "parse"
+    TRANSPORT = "transport"
+    ACTION = "action"
+    OTHER = "other"
+
+
+def unwrap_error(e: BaseException) -> BaseException:
+    """The error that caused a tenacity `RetryError`, e.g. the one the router raises once it gives up
+
+    Args:
+        e (BaseException): The error
+
+    Returns:
+        BaseException: The error of the last attempt, or the error itself if it isn't a `RetryError`
+    """
+    while isinstance(e, RetryError):
+        cause = e.last_attempt.exception()
+        if cause is None:
+            break
+        e = cause
+    return e
+
+
+def classify_error(e: BaseException) -> ErrorKind:
+    """Classify an error to decide how to retry it
+
+    Parse errors are worth re-asking the model about with the same screenshot, transport errors are
+    worth retrying after a back off, and action errors shouldn't cause the model to be asked again.
+    Errors wrapped in a tenacity `RetryError` are classified by the error of their last attempt.
+
+    Args:
+        e (BaseException): The error
+
+    Returns:
+        ErrorKind: The kind of error
+    """
+    e = unwrap_error(e)
+    if isinstance(e, ActionError):
+        return ErrorKind.ACTION
+
+    if isinstance(e, (ParseError, ValidationError, json.JSONDecodeError)):
+        return ErrorKind.PARSE
+
+    if isinstance(e, requests.HTTPError):
+        status = e.response.status_code if e.response is not None else None
+        if status in RETRYABLE_STATUS_CODES:
+            return ErrorKind.TRANSPORT
+        return ErrorKind.OTHER
+
+    if isinstance(
+        e,
+        (
+            requests.ConnectionError,
+            requests.Timeout,
+            ConnectionError,
+            TimeoutError,
+            openai.APIConnectionError,
+            openai.RateLimitError,
+            openai.InternalServerError,
+        ),
+    ):
+        return ErrorKind.TRANSPORT
+
+    if getattr(e, "status_code", None) in RETRYABLE_STATUS_CODES:
+        return ErrorKind.TRANSPORT
+
+    return ErrorKind.OTHER
+
+
+def is_transient(e: BaseException) -> bool:
+    """Whether an error is a transport error that is worth retrying after a back off
+
+    Args:
+        e (BaseException): The error
+
+    Returns:
+        bool: Whether it is transient
+    """
+    return classify_error(e) == ErrorKind.TRANSPORT
+
+
+def is_undelivered(e: BaseException) -> bool:
+    """Whether an error shows the request never reached the server, so it is safe to send again
+
+    A timeout or a dropped connection after the request was sent may come after the server already acted
+    on it, only failing to connect and the statuses in `UNDELIVERED_STATUS_CODES` mean it didn't.
+
+    Args:
+        e (BaseException): The error
+
+    Returns:
+        bool: Whether the request is known not to have been delivered
+    """
+    e = unwrap_error(e)
+    if isinstance(e, requests.HTTPError):
+        status = e.response.status_code if e.response is not None else None
+        return status in UNDELIVERED_STATUS_CODES
+
+    if isinstance(e, (requests.ConnectTimeout, ConnectionRefusedError)):
+        return True
+
+    if isinstance(e, requests.ConnectionError):
+        # requests wraps the urllib3 error, a new connection failing to open is
+        # a subclass of its connect timeout
+        reason = getattr(e.args[0], "reason", None) if e.args else None
+        return isinstance(reason, urllib3.exceptions.ConnectTimeoutError)
+
+    return False
+
+
+def retrying_transient(
+    retries: int,
+    max_wait: float = 10,
+    retry_if: Callable[[BaseException], bool] = is_transient,
+) -> Retrying:
+    """Retry a block on transport errors after a back off, recording the retries
+
+    Args:
+        retries (int): Retries to make after the first attempt
+        max_wait (float, optional): Longest back off in seconds. Defaults to 10.
+        retry_if (Callable[[BaseException], bool], optional): Which errors to retry, use `is_undelivered`
+            for requests that aren't safe to send twice. Defaults to `is_transient`.
+
+    Returns:
+        Retrying: Tenacity retrying to iterate over, reraising the last error
+    """
+    return Retrying(
+        retry=retry_if_exception(retry_if),
+        wait=wait_random_exponential(multiplier=1, max=max_wait),
+        stop=stop_after_attempt(retries + 1),
+        before_sleep=record_retry,
+        reraise=True,
+    )
+
+
+class RetryStats:
+    """
+    Counts retries by kind of error, along with the time and LLM calls they cost.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, float]] = {
+            kind.value: {"retries": 0, "seconds": 0.0, "llm_calls": 0}
+            for kind in ErrorKind
+        }
+
+    def record(self, kind: ErrorKind, seconds: float, llm_calls: int = 0) -> None:
+        """Record a retry
+
+        Args:
+            kind (ErrorKind): Kind of error retried
+            seconds (float): Time spent on the failed attempt and waiting before the retry
+            llm_calls (int, optional): LLM calls made by the failed attempt. Defaults to 0.
+        """
+        with self._lock:
+            stats = self._stats[kind.value]
+            stats["retries"] += 1
+            stats["seconds"] += seconds
+            stats["llm_calls"] += llm_calls
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Retry counts, seconds and LLM calls by kind of error
+
+        Returns:
+            Dict[str, Dict[str, float]]: The stats
+        """
+        with self._lock:
+            return {kind: dict(stats) for kind, stats in self._stats.items()}
+
+
+retry_stats = RetryStats()
+
+
+def record_retry(retry_state: RetryCallState) -> None:
+    """Tenacity `before_sleep` hook that logs the retry and records its cost
+
+    Args:
+        retry_state (RetryCallState): State of the retry
+    """
+    error = retry_state.outcome.exception() if retry_state.outcome else None
+    kind = classify_error(error) if error else ErrorKind.OTHER
+    sleep = retry_state.next_action.sleep if retry_state.next_action else 0.0
+
+    # idle_for already includes the upcoming sleep, what is left is time spent in
+    # attempts, of which earlier attempts were recorded on previous retries
+    busy = (
+        (retry_state.outcome_timestamp or retry_state.start_time)
+        - retry_state.start_time
+        - (retry_state.idle_for - sleep)
+    )
+    attempt = busy - getattr(retry_state, "recorded_busy", 0.0)
+    retry_state.recorded_busy = busy  # type: ignore
+
+    retry_stats.record(kind, attempt + sleep)
+    logger.info(
+        f"retrying {retry_state.fn.__name__ if retry_state.fn else 'call'} "
+        f"after {kind.value} error in {sleep:.2f}s, attempt {retry_state.attempt_number}: {error}"
+    )
@@ -1,15 +1,19 @@
+import asyncio
 import logging
 import os
 import sys
+import threading
+import traceback
 from contextlib import asynccontextmanager
 from typing import Final
 
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from surfkit.server.routes import task_router
+from fastapi.responses import JSONResponse, PlainTextResponse
 
-from .agent import Agent
+from .metrics import registry
+from .startup import startup_timer
 
 # Configure logging
 logger: Final = logging.getLogger("surfpizza")
@@ -27,12 +31,48 @@ logger.propagate = False
 ALLOW_ORIGINS = os.getenv("ALLOW_ORIGINS", "*").split(",")
 ALLOW_METHODS = os.getenv("ALLOW_METHODS", "*").split(",")
 ALLOW_HEADERS = os.getenv("ALLOW_HEADERS", "*").split(",")
+# Load the agent in the background so the port is bound while surfkit imports
+LAZY_STARTUP = os.getenv("SERVER_LAZY_STARTUP", "true") == "true"
+STARTUP_WAIT_TIMEOUT = float(os.getenv("SERVER_STARTUP_WAIT_TIMEOUT", "120"))
+
+_agent_ready = threading.Event()
+
+
+def load_agent(app: FastAPI) -> None:
+    """Import the agent and surfkit's task routes, initialize the agent and mount the routes
+
+    If this fails the server stays up to report the error, `/health` answers 503 with the status
+    'failed' so the orchestrator restarts it, and every other request fails straight away with a 500.
+
+    Args:
+        app (FastAPI): App to mount the routes on
+    """
+    try:
+        with startup_timer.phase("import_agent"):
+            from surfkit.server.routes import task_router
+
+            from .agent import Agent
+
+        # Initialize the agent type before the routes come live
+        Agent.init()
+
+        with startup_timer.phase("mount_routes"):
+            app.include_router(task_router(Agent))
+
+        startup_timer.mark_ready()
+    except Exception as e:
+        traceback.print_exc()
+        startup_timer.mark_failed(str(e))
+    finally:
+        _agent_ready.set()
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Initialize the agent type before the server comes live
-    Agent.init()
+    if LAZY_STARTUP:
+        threading.Thread(target=load_agent, args=(app,), daemon=True).start()
+    else:
+        load_agent(app)
     yield
 
 
@@ -46,7 +86,52 @@ app.add_middleware(
     allow_headers=ALLOW_HEADERS,
 )
 
-app.include_router(task_router(Agent))
+
+@app.middleware("http")
+async def wait_for_agent(request: Request, call_next):
+    # Hold requests that arrive while the agent is still loading rather than 404ing them
+    if request.url.path in ("/health", "/startup", "/metrics"):
+        return await call_next(request)
+
+    if not _agent_ready.is_set():
+        await asyncio.to_thread(_agent_ready.wait, STARTUP_WAIT_TIMEOUT)
+    if startup_timer.failed:
+        return JSONResponse(
+            status_code=500,
+            content={"status": "failed", "error": startup_timer.error},
+        )
+    if not startup_timer.ready:
+        return JSONResponse(status_code=503, content={"status": "starting"})
+    return await call_next(request)
+
+
+@app.get("/health")
+async def health():
+    if startup_timer.failed:
+        return JSONResponse(
+            status_code=503,
+            content={"status": "failed", "error": startup_timer.error},
+        )
+    if not startup_timer.ready:
+        return JSONResponse(status_code=503, content={"status": "starting"})
+    return {"status": "ok"}
+
+
+@app.get("/startup")
+async def startup():
+    return {
+        "ready": startup_timer.ready,
+        "error": startup_timer.error,
+        "timings": startup_timer.report(),
+    }
+
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(
+        registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
 
 if __name__ == "__main__":
     port = os.getenv("SERVER_PORT", "9090")
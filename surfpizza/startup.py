@@ -0,0 +1,96 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Final, Iterator, Optional
+
+import psutil
+
+logger: Final = logging.getLogger("surfpizza")
+
+
+class StartupTimer:
+    """
+    Records how long each phase of server startup takes.
+
+    Phases are timed with the `phase` context manager and the whole startup is measured both from
+    when this module was imported and from when the process was created, so the interpreter boot
+    and import time that happen before any of our code runs are visible too.
+    """
+
+    def __init__(self) -> None:
+        self.started = time.time()
+        try:
+            self.process_started: Optional[float] = psutil.Process(
+                os.getpid()
+            ).create_time()
+        except psutil.Error:
+            self.process_started = None
+        self.ready_at: Optional[float] = None
+        self.error: Optional[str] = None
+        self._phases: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Time a phase of startup.
+
+        Args:
+            name (str): Name of the phase
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._phases[name] = self._phases.get(name, 0.0) + elapsed
+            logger.debug(f"startup phase '{name}' took {elapsed:.3f}s")
+
+    def mark_ready(self) -> None:
+        """Mark the server as ready to take requests and log the report"""
+        self.ready_at = time.time()
+        logger.info(f"startup timings: {self.report()}")
+
+    def mark_failed(self, error: str) -> None:
+        """Mark startup as failed
+
+        Args:
+            error (str): Why startup failed
+        """
+        self.error = error
+        logger.error(f"startup failed: {error}, timings: {self.report()}")
+
+    @property
+    def ready(self) -> bool:
+        return self.ready_at is not None
+
+    @property
+    def failed(self) -> bool:
+        return self.error is not None
+
+    def report(self) -> Dict[str, Optional[float]]:
+        """Startup timing report in seconds.
+
+        Returns:
+            Dict[str, Optional[float]]: Duration of every phase, plus the time from module import and
+                from process creation until the server was ready.
+        """
+        with self._lock:
+            out: Dict[str, Optional[float]] = {
+                name: round(elapsed, 4) for name, elapsed in self._phases.items()
+            }
+        ready_at = self.ready_at
+        out["import_to_ready"] = (
+            round(ready_at - self.started, 4) if ready_at is not None else None
+        )
+        out["process_to_ready"] = (
+            round(ready_at - self.process_started, 4)
+            if ready_at is not None and self.process_started is not None
+            else None
+        )
+        return out
+
+
+startup_timer = StartupTimer()
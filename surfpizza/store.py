@@ -0,0 +1,386 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+from typing import Any, Callable, Dict, Final, List, Optional, Tuple
+
+from PIL import Image
+
+from .img import image_hash
+
+logger = logging.getLogger(__name__)
+logger.setLevel(int(os.getenv("LOG_LEVEL", logging.DEBUG)))
+
+# Temporary files older than this are left over from a crash, younger ones may
+# still be being written by another process sharing the store
+TMP_GRACE_SECONDS: Final = 600
+
+# Extension and PIL format for each supported blob format
+FORMATS = {
+    "png": ("png", "PNG"),
+    "webp": ("webp", "WEBP"),
+    "jpeg": ("jpg", "JPEG"),
+}
+
+
+class ImageStore:
+    """
+    A content-addressed store for the images the agent saves to disk.
+
+    Images are keyed by a hash of their pixels and written once as a blob under `blobs/`, so the same
+    screen saved by several clicks or tasks only takes up space once. Every save is also appended to a
+    per-task manifest under `manifests/`, recording the name it was saved under and any metadata, so the
+    artifacts of a task can still be looked up. Blobs and manifests are kept under `quota_bytes` together
+    by evicting whichever was least recently used, so the manifests of old tasks go along with their
+    blobs.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        quota_bytes: int = 512 * 1024 * 1024,
+        image_format: str = "png",
+        quality: Optional[int] = None,
+    ) -> None:
+        """
+        Initialize the store, indexing any blobs already on disk.
+
+        Args:
+            root (str): Directory to store in.
+            quota_bytes (int, optional): Max total size of the blobs and manifests. Defaults to 512MB.
+            image_format (str, optional): Format new blobs are written in, one of 'png', 'webp' or 'jpeg'. Defaults to "png".
+            quality (Optional[int], optional): Quality for lossy formats, webp is lossless if not set. Defaults to None.
+        """
+        if image_format not in FORMATS:
+            raise ValueError(f"unknown image format {image_format}")
+
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.image_format = image_format
+        self.quality = quality
+
+        self.blob_dir = os.path.join(root, "blobs")
+        self.manifest_dir = os.path.join(root, "manifests")
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.manifest_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # Path, size and last use of each blob, and size and last write of each
+        # manifest, least recently used first
+        self._index: "OrderedDict[str, Tuple[str, int, float]]" = OrderedDict()
+        self._manifests: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.writes = 0
+        self.evictions = 0
+        self._load_index()
+
+    def put(
+        self,
+        img: Image.Image,
+        task_id: str,
+        name: str,
+        digest: Optional[str] = None,
+        **meta: Any,
+    ) -> str:
+        """Save an image, only writing it if the store doesn't already have it
+
+        Args:
+            img (Image.Image): The image
+            task_id (str): Task to add it to the manifest of
+            name (str): Name to record it under in the manifest
+            digest (Optional[str], optional): Hash of the image if already known. Defaults to None.
+            **meta (Any): Extra fields for the manifest entry
+
+        Returns:
+            str: Hash of the image
+        """
+        if digest is None:
+            digest = image_hash(img)
+        return self._put(digest, lambda: self._write(digest, img), task_id, name, meta)
+
+    def put_encoded(
+        self, data: bytes, task_id: str, name: str, digest: str, **meta: Any
+    ) -> str:
+        """Save an image already encoded as PNG, writing the bytes as they are if the store keeps PNGs
+
+        Args:
+            data (bytes): The PNG bytes
+            task_id (str): Task to add it to the manifest of
+            name (str): Name to record it under in the manifest
+            digest (str): Hash of the image's pixels, see `image_hash`
+            **meta (Any): Extra fields for the manifest entry
+
+        Returns:
+            str: Hash of the image
+        """
+        if self.image_format != "png":
+            with Image.open(BytesIO(data)) as img:
+                return self.put(img, task_id, name, digest=digest, **meta)
+        return self._put(
+            digest, lambda: self._write_bytes(digest, data), task_id, name, meta
+        )
+
+    def path(self, digest: str) -> Optional[str]:
+        """Path of a blob
+
+        Args:
+            digest (str): Hash of the image
+
+        Returns:
+            Optional[str]: The path, or None if the store doesn't have it
+        """
+        with self._lock:
+            entry = self._touch(digest)
+        return entry[0] if entry else None
+
+    def get(self, digest: str) -> Optional[Image.Image]:
+        """Load an image
+
+        Args:
+            digest (str): Hash of the image
+
+        Returns:
+            Optional[Image.Image]: The image, or None if the store doesn't have it
+        """
+        path = self.path(digest)
+        if not path:
+            return None
+        try:
+            with Image.open(path) as img:
+                img.load()
+                return img
+        except FileNotFoundError:
+            return None
+
+    def manifest(self, task_id: str) -> List[Dict[str, Any]]:
+        """Everything saved for a task, in order
+
+        Args:
+            task_id (str): ID of the task
+
+        Returns:
+            List[Dict[str, Any]]: Manifest entries, each with the name, hash and time it was saved
+        """
+        path = self._manifest_path(task_id)
+        if not os.path.exists(path):
+            return []
+        with open(path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def stats(self) -> Dict[str, int]:
+        """Size and activity of the store
+
+        Returns:
+            Dict[str, int]: Number of blobs and manifests, the bytes they take up, the quota, dedupe hits,
+                writes and evictions
+        """
+        with self._lock:
+            return {
+                "blobs": len(self._index),
+                "manifests": len(self._manifests),
+                "bytes": self._bytes,
+                "quota_bytes": self.quota_bytes,
+                "hits": self.hits,
+                "writes": self.writes,
+                "evictions": self.evictions,
+            }
+
+    def _put(
+        self,
+        digest: str,
+        write: Callable[[], Tuple[str, int]],
+        task_id: str,
+        name: str,
+        meta: Dict[str, Any],
+    ) -> str:
+        with self._lock:
+            existing = self._touch(digest)
+            if existing:
+                self.hits += 1
+
+        if existing:
+            try:
+                os.utime(existing[0])
+            except OSError:
+                pass
+        else:
+            path, size = write()
+            with self._lock:
+                if digest not in self._index:
+                    self._index[digest] = (path, size, time.time())
+                    self._bytes += size
+                    self.writes += 1
+
+        # Evicts once the manifest entry is written too
+        self._append_manifest(task_id, {"name": name, "hash": digest, **meta})
+        return digest
+
+    def _touch(self, digest: str) -> Optional[Tuple[str, int, float]]:
+        entry = self._index.get(digest)
+        if entry:
+            entry = self._index[digest] = (entry[0], entry[1], time.time())
+            self._index.move_to_end(digest)
+        return entry
+
+    def _blob_path(self, digest: str) -> str:
+        ext, _ = FORMATS[self.image_format]
+        blob_dir = os.path.join(self.blob_dir, digest[:2])
+        os.makedirs(blob_dir, exist_ok=True)
+        return os.path.join(blob_dir, f"{digest}.{ext}")
+
+    def _write_bytes(self, digest: str, data: bytes) -> Tuple[str, int]:
+        path = self._blob_path(digest)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return path, len(data)
+
+    def _write(self, digest: str, img: Image.Image) -> Tuple[str, int]:
+        _, pil_format = FORMATS[self.image_format]
+        path = self._blob_path(digest)
+
+        params: Dict[str, Any] = {}
+        if pil_format == "JPEG":
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            params["quality"] = self.quality or 85
+        elif pil_format == "WEBP":
+            if self.quality is None:
+                params["lossless"] = True
+            else:
+                params["quality"] = self.quality
+
+        # Write to a temporary file first so a crash never leaves a partial blob
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        img.save(tmp_path, format=pil_format, **params)
+        os.replace(tmp_path, path)
+        return path, os.path.getsize(path)
+
+    def _evict(self) -> None:
+        # Always keep the newest blob and manifest, even if they are bigger than the quota
+        while self._bytes > self.quota_bytes:
+            blob = next(iter(self._index.items())) if len(self._index) > 1 else None
+            manifest = (
+                next(iter(self._manifests.items()))
+                if len(self._manifests) > 1
+                else None
+            )
+            if blob and (manifest is None or blob[1][2] <= manifest[1][1]):
+                digest, (path, size, _) = blob
+                del self._index[digest]
+                what = f"image {digest}"
+            elif manifest:
+                task_id, (size, _) = manifest
+                del self._manifests[task_id]
+                path = self._manifest_path(task_id)
+                what = f"manifest of task {task_id}"
+            else:
+                break
+
+            self._bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            logger.debug(f"evicted {what} from the store")
+
+    def _load_index(self) -> None:
+        now = time.time()
+        blobs = []
+        for dirpath, _, filenames in os.walk(self.blob_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                    if filename.endswith(".tmp"):
+                        if now - stat.st_mtime > TMP_GRACE_SECONDS:
+                            os.remove(path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                blobs.append(
+                    (stat.st_mtime, filename.split(".")[0], path, stat.st_size)
+                )
+
+        manifests = []
+        for filename in os.listdir(self.manifest_dir):
+            if not filename.endswith(".jsonl"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.manifest_dir, filename))
+            except FileNotFoundError:
+                continue
+            manifests.append((stat.st_mtime, filename[: -len(".jsonl")], stat.st_size))
+
+        # Oldest first, blobs are touched when reused so this is least recently used
+        for mtime, digest, path, size in sorted(blobs):
+            self._index[digest] = (path, size, mtime)
+            self._bytes += size
+        for mtime, task_id, size in sorted(manifests):
+            self._manifests[task_id] = (size, mtime)
+            self._bytes += size
+        self._evict()
+
+    def _manifest_path(self, task_id: str) -> str:
+        return os.path.join(self.manifest_dir, f"{task_id}.jsonl")
+
+    def _append_manifest(self, task_id: str, entry: Dict[str, Any]) -> None:
+        record = {"time": time.time(), **entry}
+        line = json.dumps(record, default=str, separators=(",", ":"))
+        with self._lock:
+            with open(self._manifest_path(task_id), "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+                size = f.tell()
+            previous = self._manifests.pop(task_id, None)
+            self._manifests[task_id] = (size, record["time"])
+            self._bytes += size - (previous[0] if previous else 0)
+            self._evict()
+
+
+_stores: Dict[str, ImageStore] = {}
+_stores_lock = threading.Lock()
+
+
+def image_stores() -> List[ImageStore]:
+    """The image stores created so far
+
+    Returns:
+        List[ImageStore]: The stores
+    """
+    with _stores_lock:
+        return list(_stores.values())
+
+
+def get_image_store(data_path: str = "./.data") -> ImageStore:
+    """Get the image store for a data path, creating it on first use
+
+    The store is configured from the environment, `IMAGE_STORE_QUOTA_MB`, `IMAGE_STORE_FORMAT` and
+    `IMAGE_STORE_QUALITY`.
+
+    Args:
+        data_path (str, optional): Path to data. Defaults to "./.data".
+
+    Returns:
+        ImageStore: The store
+    """
+    root = os.path.abspath(os.path.join(data_path, "store"))
+    with _stores_lock:
+        store = _stores.get(root)
+        if store is None:
+            quality = os.getenv("IMAGE_STORE_QUALITY")
+            store = ImageStore(
+                root,
+                quota_bytes=int(
+                    float(os.getenv("IMAGE_STORE_QUOTA_MB", 512)) * 1024 * 1024
+                ),
+                image_format=os.getenv("IMAGE_STORE_FORMAT", "png"),
+                quality=int(quality) if quality else None,
+            )
+            _stores[root] = store
+        return store
@@ -1,8 +1,9 @@
-import hashlib
 import logging
 import os
+import threading
 import time
-from typing import List, Optional, Tuple
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
 
 import requests
 from agentdesk.device_v1 import Desktop
@@ -12,27 +13,101 @@ from pydantic import BaseModel, Field
 from rich.console import Console
 from rich.json import JSON
 from taskara import Task
-from toolfuse import Tool, action
+from toolfuse import Action, Tool, action
 
+from . import metrics
+from .cancel import CancelWatcher
 from .img import (
     Box,
+    b64_nbytes,
     b64_to_image,
-    divide_image_into_cells,
-    image_to_b64,
+    changed_fraction,
+    combine_images_vertically,
+    frame_pool,
 )
+from .ocr import TextLocator, names_own_text, quoted_text
+from .recorder import ActionRecorder
+from .retry import is_transient, is_undelivered, retrying_transient
+from .store import get_image_store
+from .trace import TraceRecorder, TraceRouter
+from .workers import encode_b64, get_image_workers
+from .zoom import ZoomNode, ZoomTree, ZoomTreeCache
 
-router = Router.from_env()
 console = Console()
 
+_router: Optional[Router] = None
+_router_lock = threading.Lock()
+
+
+def get_router() -> Router:
+    """Get the shared LLM router, creating it from the environment on first use
+
+    Returns:
+        Router: The router
+    """
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = Router.from_env()
+    return _router
+
+
+def set_router(router: Optional[Router]) -> None:
+    """Replace the shared LLM router, e.g. with a stub when replaying a trace
+
+    Args:
+        router (Optional[Router]): The router, or None to create it from the environment again
+    """
+    global _router
+    with _router_lock:
+        _router = router
+
+
 logger = logging.getLogger(__name__)
 logger.setLevel(int(os.getenv("LOG_LEVEL", logging.DEBUG)))
 
 
+class ZoomSelection(BaseModel):
+    """Zoom selection model"""
+
+    number: int = Field(
+        ...,
+        description="Number of the cell containing the element we wish to select",
+    )
+
+
+class MultiZoomSelection(BaseModel):
+    """Zoom selection model for several elements"""
+
+    numbers: List[int] = Field(
+        ...,
+        description="Number of the cell containing each element we wish to select, in the order they were given",
+    )
+
+
+@dataclass
+class _ZoomGroup:
+    """Objects being zoomed into together"""
+
+    targets: List[int]
+    node: ZoomNode
+    boxes: List[Box]
+    thread: RoleThread
+
+
 class SemanticDesktop(Tool):
     """A semantic desktop replaces click actions with semantic description rather than coordinates"""
 
     def __init__(
-        self, task: Task, desktop: Desktop, data_path: str = "./.data"
+        self,
+        task: Task,
+        desktop: Desktop,
+        data_path: str = "./.data",
+        session: Optional[requests.Session] = None,
+        recorder: Optional[ActionRecorder] = None,
+        cancel: Optional[CancelWatcher] = None,
+        trace: Optional[TraceRecorder] = None,
     ) -> None:
         """
         Initialize and open a URL in the application.
@@ -41,15 +116,68 @@ class SemanticDesktop(Tool):
             task: Agent task. Defaults to None.
             desktop: Desktop instance to wrap.
             data_path (str, optional): Path to data. Defaults to "./.data".
+            session (requests.Session, optional): HTTP session to reuse for requests to the desktop. Defaults to None.
+            recorder (ActionRecorder, optional): Recorder to buffer prompt uploads in, they are uploaded directly if not set. Defaults to None.
+            cancel (CancelWatcher, optional): Watcher for the task being cancelled, checked between zoom levels. Defaults to None.
+            trace (TraceRecorder, optional): Trace to record screenshots, requests and clicks in. Defaults to None.
         """
         super().__init__(wraps=desktop)
         self.desktop = desktop
+        self.session = session if session else requests.Session()
 
         self.data_path = data_path
-        self.img_path = os.path.join(self.data_path, "images", task.id)
-        os.makedirs(self.img_path, exist_ok=True)
+        self.store = get_image_store(data_path)
+        self._clicks = 0
+        self.zoom_trees = ZoomTreeCache()
+        self.workers = get_image_workers()
+        self.ocr = TextLocator(
+            min_confidence=float(os.getenv("OCR_MIN_CONFIDENCE", 80))
+        )
 
         self.task = task
+        self.recorder = recorder
+        self.cancel = cancel
+        self.trace = trace
+        self.router = TraceRouter(get_router(), trace) if trace else get_router()
+
+    def use(self, action: Action, *args: Any, **kwargs: Any) -> Any:
+        """Take an action, retrying actions of the wrapped desktop that are safe to send again
+
+        The semantic actions find their targets with the model first, only the input they send to the
+        desktop is retried, so a flaky desktop doesn't cause the targets to be found again. Observations
+        are retried on any transport error, other actions like typing or scrolling only if they never
+        reached the desktop, as one that timed out may already have been taken.
+
+        Args:
+            action (Action): The action
+            *args (Any): Its arguments
+            **kwargs (Any): Its keyword arguments
+
+        Returns:
+            Any: What the action returned
+        """
+        if getattr(action.method, "__self__", None) is self:
+            return super().use(action, *args, **kwargs)
+
+        read_only = getattr(action.method, "_is_observation", False)
+        for attempt in retrying_transient(
+            int(os.getenv("ACTION_RETRIES", 1)),
+            retry_if=is_transient if read_only else is_undelivered,
+        ):
+            with attempt:
+                return super().use(action, *args, **kwargs)
+
+    def post_debug(self, msg: str, images: List[str]) -> None:
+        """Post a message with images to the task's debug thread, counting the image bytes sent
+
+        Args:
+            msg (str): The message
+            images (List[str]): The images, as base64 data URIs
+        """
+        self.task.post_message(role="assistant", msg=msg, thread="debug", images=images)
+        metrics.image_bytes_uploaded.inc(
+            sum(b64_nbytes(img) for img in images), kind="debug"
+        )
 
     @action
     def click_object(self, description: str, type: str, button: str = "left") -> None:
@@ -62,141 +190,476 @@ class SemanticDesktop(Tool):
                 'double' for a double click. If you need to launch an application from the desktop choose 'double'
             button (str, optional): Mouse button to click. Options are 'left' or 'right'. Defaults to 'left'.
         """
+        self._click_all([description], type, button)
+
+    @action
+    def click_objects(
+        self, descriptions: List[str], type: str, button: str = "left"
+    ) -> None:
+        """Click on several objects on the screen one after the other with nothing else in between, for
+        example several checkboxes or the items of a menu path, this is much faster than clicking on each of
+        them separately. Don't use it for text fields, each has to be typed in before clicking the next
+
+        Args:
+            descriptions (List[str]): The descriptions of the objects in the order to click them, each including
+                its general location, for example "the menu item with the text 'Edit' in the top-left of the image"
+            type (str): Type of click, can be 'single' for a single click or
+                'double' for a double click
+            button (str, optional): Mouse button to click. Options are 'left' or 'right'. Defaults to 'left'.
+        """
+        if not descriptions:
+            raise ValueError("descriptions must not be empty")
+        self._click_all(descriptions, type, button)
+
+    def _click_all(self, descriptions: List[str], type: str, button: str) -> None:
+        """Ground the described objects on the current screen, then click them in order
+
+        Args:
+            descriptions (List[str]): Descriptions of the objects
+            type (str): Type of click, 'single' or 'double'
+            button (str): Mouse button to click
+        """
         if type != "single" and type != "double":
             raise ValueError("type must be 'single' or 'double'")
 
-        logging.debug("clicking icon with description ", description)
-
-        max_depth = int(os.getenv("MAX_DEPTH", 3))
-        color_text = os.getenv("COLOR_TEXT", "yellow")
-        color_circle = os.getenv("COLOR_CIRCLE", "red")
-        num_cells = int(os.getenv("NUM_CELLS", 3))
+        logging.debug("clicking icons with descriptions ", descriptions)
+
+        # The screenshot is only ever read, crops and composites are new images,
+        # so we can hold on to it for the final debug image without copying. If the
+        # screen hasn't changed since the last click its zoom levels are reused
+        screenshot = self._screenshot()
+        tree = self.zoom_trees.get(
+            screenshot,
+            int(os.getenv("NUM_CELLS", 3)),
+            aspect_aware=os.getenv("GRID_ASPECT_AWARE", "true").lower() == "true",
+            overlap=int(os.getenv("GRID_OVERLAP", 0)),
+            workers=self.workers,
+        )
+        screenshot = tree.root.img
+        screenshot_b64 = tree.encoded(tree.root)
+        self.post_debug(
+            f"Clicking '{type}' on objects {descriptions}", [screenshot_b64]
+        )
 
-        click_hash = hashlib.md5(description.encode()).hexdigest()[:5]
+        targets = self._ground(descriptions, tree)
+        clicks = [boxes[-1].center() for boxes in targets]
+        for (click_x, click_y), description in zip(clicks, descriptions):
+            logger.info(f"'{description}' is at exact coords {click_x}, {click_y}")
+        self.task.post_message(
+            role="assistant",
+            msg=f"Clicking coordinates {clicks}",
+            thread="debug",
+        )
 
-        class ZoomSelection(BaseModel):
-            """Zoom selection model"""
+        debug_img = frame_pool.acquire(screenshot.mode, screenshot.size, None)
+        debug_img.paste(screenshot)
+        for boxes, click in zip(targets, clicks):
+            debug_img = self._debug_image(debug_img, boxes, click)
+        debug_b64 = encode_b64(debug_img, self.workers)
+        frame_pool.release(debug_img)
+        logger.debug(f"image memory: {frame_pool.stats()}")
+        self.post_debug("Final debug img", [debug_b64])
+
+        # Each click is verified against the screen right before it, the grounding
+        # took long enough for the screenshot it was done on to be out of date
+        verify = os.getenv("CLICK_VERIFY", "refine").lower()
+        before: Optional[Image.Image] = None
+        for boxes, (click_x, click_y), description in zip(
+            targets, clicks, descriptions
+        ):
+            if self.cancel:
+                self.cancel.check()
+            if verify != "off" and before is None:
+                before = self._screenshot()
+            self._click_coords(x=click_x, y=click_y, type=type, button=button)
+            metrics.clicks.inc()
+            if verify != "off":
+                before = self._verify_click(
+                    tree, before, boxes, description, verify, type, button  # type: ignore
+                )
+        return
 
-            number: int = Field(
-                ...,
-                description="Number of the cell containing the element we wish to select",
-            )
+    def _screenshot(self) -> Image.Image:
+        """Take a screenshot of the desktop
 
-        current_img = self.desktop.take_screenshots()[0]
-        original_img = current_img.copy()
-        img_width, img_height = current_img.size
+        Returns:
+            Image.Image: The screenshot
+        """
+        start = time.perf_counter()
+        with metrics.screenshot_latency.time():
+            screenshot = self.desktop.take_screenshots()[0]
+        if self.trace:
+            self.trace.screenshot(screenshot, seconds=time.perf_counter() - start)
+        return screenshot
+
+    def _verify_click(
+        self,
+        tree: ZoomTree,
+        before: Image.Image,
+        boxes: List[Box],
+        description: str,
+        mode: str,
+        type: str,
+        button: str,
+    ) -> Optional[Image.Image]:
+        """Check that a click changed the screen around its target, clicking again if it most likely missed
+
+        A click that changes nothing near its target most likely missed or was dropped. That is caught
+        here from one screenshot rather than by the model a whole step later. With `mode` 'refine' the
+        target is zoomed into one level further with a single request, and the refined point is only
+        clicked if it differs from the one clicked, so a click whose effect is delayed or shows up
+        elsewhere isn't sent twice. If refining fails the click is left as it was. With 'reclick' the same
+        point is clicked again.
 
-        initial_box = Box(0, 0, img_width, img_height)
-        bounding_boxes = [initial_box]
+        Args:
+            tree (ZoomTree): Zoom tree of the screenshot the target was found in
+            before (Image.Image): Screenshot taken right before the click
+            boxes (List[Box]): Boxes leading to the target, from the whole screen to the final one
+            description (str): Description of the target
+            mode (str): How to click again, 'refine' or 'reclick'
+            type (str): Type of click, 'single' or 'double'
+            button (str): Mouse button to click
 
-        thread = RoleThread()
+        Returns:
+            Optional[Image.Image]: The screenshot taken after the click, or None if the target was clicked
+                again and the screen has to be captured again
+        """
+        margin = int(os.getenv("CLICK_VERIFY_MARGIN", 20))
+        min_change = float(os.getenv("CLICK_VERIFY_MIN_CHANGE", 0.005))
 
+        box = boxes[-1]
+        region = Box(
+            box.left - margin, box.top - margin, box.right + margin, box.bottom + margin
+        )
+        after = self._screenshot()
+        changed = changed_fraction(before, after, region)
+        if changed >= min_change:
+            logger.debug(f"click on '{description}' changed {changed:.1%} around it")
+            return after
+
+        clicked = box.center()
+        x, y = clicked
+        if mode == "refine":
+            node = tree.node(box)
+            if node and min(node.img.size) > 1:
+                # The click already happened, a failed refinement mustn't fail it
+                try:
+                    cells = tree.expand(node)
+                    numbers = self._select_cells(
+                        RoleThread(),
+                        [description],
+                        tree.encoded(tree.root),
+                        node.composite_b64,  # type: ignore
+                        len(cells),
+                    )
+                except Exception as e:
+                    logger.warning(f"failed to refine click on '{description}': {e}")
+                    return after
+                x, y = cells[numbers[0]].box.center()
+            if (x, y) == clicked:
+                logger.info(
+                    f"click on '{description}' changed nothing, refining it didn't move it"
+                )
+                return after
+
+        metrics.click_retries.inc(mode=mode)
+        logger.info(f"click on '{description}' changed nothing, clicking {x}, {y}")
         self.task.post_message(
             role="assistant",
-            msg=f"Clicking '{type}' on object '{description}'",
+            msg=f"Click on '{description}' changed nothing, clicking again at {x}, {y}",
             thread="debug",
-            images=[image_to_b64(current_img)],
         )
+        self._click_coords(x=x, y=y, type=type, button=button)
+        return None
 
-        for i in range(max_depth):
-            logger.info(f"zoom depth {i}")
-            current_img.save(
-                os.path.join(self.img_path, f"{click_hash}_current_{i}.png")
-            )
+    def _ground(self, descriptions: List[str], tree: ZoomTree) -> List[List[Box]]:
+        """Find the described objects by repeatedly zooming into the cell that contains them
 
-            screenshot_b64 = image_to_b64(current_img)
-            self.task.post_message(
-                role="assistant",
-                msg=f"Zooming into image with depth {i}",
-                thread="debug",
-                images=[screenshot_b64],
-            )
+        Objects are zoomed into together, one request for all of them per cell, and only split up once
+        the model puts them in different cells, so objects in the same area of the screen share requests.
+        The cells and composites come from the zoom tree of the screenshot, so they are only built once.
+
+        Args:
+            descriptions (List[str]): Descriptions of the objects
+            tree (ZoomTree): Zoom tree of the screenshot to find them in
 
-            # -- If you want dots
-            # current_dim = current_img.size
-            # grid_img = create_grid_image_by_num_cells(
-            #     image_width=current_dim[0],
-            #     image_height=current_dim[1],
-            #     color_circle=color_circle,
-            #     color_text=color_text,
-            #     num_cells=4,
-            # )
-            # merged_image = superimpose_images(current_img.copy(), grid_img)
-            # merged_image_b64 = image_to_b64(merged_image)
-
-            composite, cropped_imgs, boxes = divide_image_into_cells(
-                current_img, num_cells=num_cells
+        Returns:
+            List[List[Box]]: For each object, the boxes zoomed into, from the whole screen to the final cell
+        """
+        max_depth = int(os.getenv("MAX_DEPTH", 3))
+        min_zoom_size = int(os.getenv("MIN_ZOOM_SIZE", 0))
+        color_text = os.getenv("COLOR_TEXT", "yellow")
+        color_circle = os.getenv("COLOR_CIRCLE", "red")
+
+        self._clicks += 1
+        click_name = f"click_{self._clicks}"
+
+        screenshot_b64 = tree.encoded(tree.root)
+
+        # Objects described by quoted text may be found without zooming
+        found: Dict[int, List[Box]] = {}
+        if os.getenv("OCR_PREFILTER", "true").lower() == "true":
+            for target, description in enumerate(descriptions):
+                boxes = self._ground_text(description, tree)
+                if boxes:
+                    found[target] = boxes
+                    metrics.ocr_groundings.inc()
+
+        remaining = [t for t in range(len(descriptions)) if t not in found]
+        groups = []
+        if remaining:
+            groups.append(
+                _ZoomGroup(
+                    targets=remaining,
+                    node=tree.root,
+                    boxes=[tree.root.box],
+                    thread=RoleThread(),
+                )
             )
-            debug_img = self._debug_image(current_img.copy(), boxes)
 
+        for i in range(max_depth):
+            next_groups: List[_ZoomGroup] = []
+            for group in groups:
+                # Don't keep zooming for a task that has been cancelled
+                if self.cancel:
+                    self.cancel.check()
+
+                # Cells small enough to click accurately don't need any more levels
+                node = group.node
+                if max(node.box.width(), node.box.height()) <= min_zoom_size:
+                    next_groups.append(group)
+                    continue
+
+                logger.info(f"zoom depth {i} for targets {group.targets}")
+                group_descriptions = [descriptions[t] for t in group.targets]
+
+                self.post_debug(
+                    f"Zooming into image with depth {i}", [tree.encoded(node)]
+                )
+
+                # -- If you want dots
+                # current_dim = current_img.size
+                # grid_img = create_grid_image_by_num_cells(
+                #     image_width=current_dim[0],
+                #     image_height=current_dim[1],
+                #     color_circle=color_circle,
+                #     color_text=color_text,
+                #     num_cells=4,
+                # )
+                # merged_image = superimpose_images(current_img.copy(), grid_img)
+                # merged_image_b64 = image_to_b64(merged_image)
+
+                # Images are only saved when the level is first built for the screenshot
+                def save(digest: str, png: bytes) -> None:
+                    self.store.put(
+                        node.img,
+                        self.task.id,
+                        f"{click_name}_current_{i}",
+                        descriptions=group_descriptions,
+                        depth=i,
+                    )
+                    # The composite is stored as already encoded for the prompt
+                    self.store.put_encoded(
+                        png,
+                        self.task.id,
+                        f"{click_name}_merged_{i}",
+                        digest=digest,
+                        descriptions=group_descriptions,
+                        depth=i,
+                    )
+
+                cells = tree.expand(node, on_composite=save)
+                composite_b64: str = node.composite_b64  # type: ignore
+
+                self.post_debug(f"Composite for depth {i}", [composite_b64])
+
+                numbers = self._select_cells(
+                    group.thread,
+                    group_descriptions,
+                    screenshot_b64,
+                    composite_b64,
+                    len(cells),
+                )
+
+                # Targets that are in the same cell keep being zoomed into together
+                selected: Dict[int, List[int]] = {}
+                for target, number in zip(group.targets, numbers):
+                    selected.setdefault(number, []).append(target)
+
+                for number, targets in selected.items():
+                    next_groups.append(
+                        _ZoomGroup(
+                            targets=targets,
+                            node=cells[number],
+                            boxes=group.boxes + [cells[number].box],
+                            thread=(
+                                group.thread if len(selected) == 1 else RoleThread()
+                            ),
+                        )
+                    )
+            groups = next_groups
+
+        out: List[List[Box]] = [found.get(t, []) for t in range(len(descriptions))]
+        for group in groups:
+            for target in group.targets:
+                out[target] = group.boxes
+                metrics.zoom_depth.observe(len(group.boxes) - 1)
+        return out
+
+    def _ground_text(self, description: str, tree: ZoomTree) -> Optional[List[Box]]:
+        """Find an object by the text quoted in its description with local OCR
+
+        Only used when the quoted text is the object's own text, like the text of a button or link, a
+        quoted label next to a text field would be clicked instead of the field. A single confident match
+        is then used as is, a few candidates are sent to the model in one request to pick from, otherwise
+        the object is left to be found by zooming.
+
+        Args:
+            description (str): Description of the object
+            tree (ZoomTree): Zoom tree of the screenshot to find it in
+
+        Returns:
+            Optional[List[Box]]: The boxes leading to the object, or None if it wasn't found
+        """
+        texts = quoted_text(description)
+        if len(texts) != 1 or not self.ocr.available:
+            return None
+        if not names_own_text(description):
+            logger.debug(f"'{texts[0]}' isn't the text of '{description}' itself")
+            return None
+
+        screenshot = tree.root.img
+        matches = self.ocr.find(screenshot, texts[0], digest=tree.digest)
+        max_candidates = int(os.getenv("OCR_MAX_CANDIDATES", 6))
+        if not matches or len(matches) > max_candidates:
+            logger.debug(f"found {len(matches)} OCR matches for '{texts[0]}'")
+            return None
+
+        if len(matches) == 1:
             self.task.post_message(
                 role="assistant",
-                msg=f"Composite for depth {i}",
+                msg=f"Found '{texts[0]}' with OCR at {matches[0].box}",
                 thread="debug",
-                images=[image_to_b64(composite)],
             )
-            composite.save(os.path.join(self.img_path, f"{click_hash}_merged_{i}.png"))
-            composite_b64 = image_to_b64(composite)
+            return [tree.root.box, matches[0].box]
+
+        # Show the model each candidate with some of its surroundings
+        context = int(os.getenv("OCR_CONTEXT", 40))
+        regions = [
+            Box(
+                max(match.box.left - context, 0),
+                max(match.box.top - context, 0),
+                min(match.box.right + context, screenshot.width),
+                min(match.box.bottom + context, screenshot.height),
+            )
+            for match in matches
+        ]
+        composite = combine_images_vertically(
+            [region.crop_image(screenshot) for region in regions], pool=frame_pool
+        )
+        composite_b64 = encode_b64(composite, self.workers)
+        frame_pool.release(composite)
+        self.post_debug(f"OCR candidates for '{texts[0]}'", [composite_b64])
+
+        number = self._select_cells(
+            RoleThread(),
+            [description],
+            tree.encoded(tree.root),
+            composite_b64,
+            len(regions),
+        )[0]
+        return [tree.root.box, regions[number], matches[number].box]
+
+    def _select_cells(
+        self,
+        thread: RoleThread,
+        descriptions: List[str],
+        screenshot_b64: str,
+        composite_b64: str,
+        num_boxes: int,
+    ) -> List[int]:
+        """Ask the model which cell of the composite each object is in
+
+        Args:
+            thread (RoleThread): Thread of the zoom so far
+            descriptions (List[str]): Descriptions of the objects
+            screenshot_b64 (str): The screenshot encoded
+            composite_b64 (str): The composite encoded
+            num_boxes (int): Number of cells in the composite
 
+        Returns:
+            List[int]: The cell number for each object
+        """
+        if len(descriptions) == 1:
+            expect = ZoomSelection
             prompt = (
                 "You are an experienced AI trained to find the elements on the screen."
                 "I am going to send you two images, the first image is a screenshot of the web application, and on the "
                 "second image I have taken the same screenshot sliced it into cells with a number next to each cell "
                 "to help you to find required elements. "
-                f"Please select the number of the cell which contains '{description}' "
+                f"Please select the number of the cell which contains '{descriptions[0]}' "
                 f"Please return you response as raw JSON following the schema {ZoomSelection.model_json_schema()} "
                 "Be concise and only return the raw json, for example if the image you wanted to select had a number 3 next to it "
                 'you would return {"number": 3}'
             )
-            msg = RoleMessage(
-                role="user",
-                text=prompt,
-                images=[screenshot_b64, composite_b64],
-            )
-            thread.add_msg(msg)
-
-            response = router.chat(
-                thread, namespace="zoom", expect=ZoomSelection, agent_id="SurfPizza"
+        else:
+            expect = MultiZoomSelection
+            listed = " ".join(f"{n + 1}. '{d}'" for n, d in enumerate(descriptions))
+            prompt = (
+                "You are an experienced AI trained to find the elements on the screen."
+                "I am going to send you two images, the first image is a screenshot of the web application, and on the "
+                "second image I have taken the same screenshot sliced it into cells with a number next to each cell "
+                "to help you to find required elements. "
+                f"Please select the number of the cell which contains each of these elements: {listed} "
+                f"Please return you response as raw JSON following the schema {MultiZoomSelection.model_json_schema()} "
+                "with one number per element in the same order. Be concise and only return the raw json, for example "
+                'if the first element was in the cell numbered 3 and the second in the cell numbered 5 you would return {"numbers": [3, 5]}'
             )
-            if not response.parsed:
-                raise SystemError("No response parsed from zoom")
 
-            logger.info(f"zoom response {response}")
+        msg = RoleMessage(
+            role="user",
+            text=prompt,
+            images=[screenshot_b64, composite_b64],
+        )
+        thread.add_msg(msg)
 
-            self.task.add_prompt(response.prompt)
+        # Only this request is retried on transport errors, not the zoom levels before it
+        for attempt in retrying_transient(int(os.getenv("ZOOM_RETRIES", 2))):
+            with attempt, metrics.llm_call("zoom"):
+                response = self.router.chat(
+                    thread, namespace="zoom", expect=expect, agent_id="SurfPizza"
+                )
+        if not response.parsed:
+            raise SystemError("No response parsed from zoom")
 
-            zoom_resp = response.parsed
-            self.task.post_message(
-                role="assistant",
-                msg=f"Selection {zoom_resp.model_dump_json()}",
-                thread="debug",
-            )
-            console.print(JSON(zoom_resp.model_dump_json()))
+        logger.info(f"zoom response {response}")
 
-            current_img = cropped_imgs[zoom_resp.number]
-            current_box = boxes[zoom_resp.number]
-            absolute_box = current_box.to_absolute(bounding_boxes[-1])
-            bounding_boxes.append(absolute_box)
+        if self.recorder:
+            self.recorder.add_prompt(response.prompt)
+        else:
+            self.task.add_prompt(response.prompt)
 
-        click_x, click_y = bounding_boxes[-1].center()
-        logger.info(f"clicking exact coords {click_x}, {click_y}")
+        zoom_resp = response.parsed
         self.task.post_message(
             role="assistant",
-            msg=f"Clicking coordinates {click_x}, {click_y}",
+            msg=f"Selection {zoom_resp.model_dump_json()}",
             thread="debug",
         )
+        console.print(JSON(zoom_resp.model_dump_json()))
 
-        debug_img = self._debug_image(
-            original_img.copy(), bounding_boxes, (click_x, click_y)
+        numbers = (
+            [zoom_resp.number]
+            if isinstance(zoom_resp, ZoomSelection)
+            else zoom_resp.numbers
         )
-        self.task.post_message(
-            role="assistant",
-            msg="Final debug img",
-            thread="debug",
-            images=[image_to_b64(debug_img)],
-        )
-        self._click_coords(x=click_x, y=click_y, type=type, button=button)
-        return
+        if len(numbers) != len(descriptions):
+            raise SystemError(
+                f"Expected {len(descriptions)} cell numbers from zoom, got {len(numbers)}"
+            )
+        for number in numbers:
+            if number < 0 or number >= num_boxes:
+                raise SystemError(f"Cell number {number} from zoom doesn't exist")
+        return numbers
 
     def _click_coords(
         self, x: int, y: int, type: str = "single", button: str = "left"
@@ -212,30 +675,51 @@ class SemanticDesktop(Tool):
             button (str, optional): Button to click. Defaults to "left".
         """
         # TODO: fix click cords in agentd
+        settle = float(os.getenv("CLICK_SETTLE_SECONDS", 2.0))
+        start = time.perf_counter()
         logging.debug("moving mouse")
         body = {"x": int(x), "y": int(y)}
-        resp = requests.post(f"{self.desktop.base_url}/v1/move_mouse", json=body)
-        resp.raise_for_status()
-        time.sleep(2)
+        self._post("/v1/move_mouse", body)
+        time.sleep(settle)
 
         if type == "single":
             logging.debug("clicking")
-            resp = requests.post(
-                f"{self.desktop.base_url}/v1/click", json={"button": button}
-            )
-            resp.raise_for_status()
-            time.sleep(2)
+            self._post("/v1/click", {"button": button})
+            time.sleep(settle)
         elif type == "double":
             logging.debug("double clicking")
-            resp = requests.post(
-                f"{self.desktop.base_url}/v1/double_click", json={"button": button}
-            )
-            resp.raise_for_status()
-            time.sleep(2)
+            self._post("/v1/double_click", {"button": button})
+            time.sleep(settle)
         else:
             raise ValueError(f"unkown click type {type}")
+
+        if self.trace:
+            self.trace.input(
+                "click",
+                seconds=time.perf_counter() - start,
+                x=int(x),
+                y=int(y),
+                type=type,
+                button=button,
+            )
         return
 
+    def _post(self, path: str, body: Dict[str, Any]) -> None:
+        """Send input to the desktop, retrying it only if it never reached the desktop
+
+        Input is not safe to send twice, a click that timed out may already have been made.
+
+        Args:
+            path (str): Path of the desktop endpoint
+            body (Dict[str, Any]): JSON body of the request
+        """
+        for attempt in retrying_transient(
+            int(os.getenv("ACTION_RETRIES", 1)), retry_if=is_undelivered
+        ):
+            with attempt:
+                resp = self.session.post(f"{self.desktop.base_url}{path}", json=body)
+                resp.raise_for_status()
+
     def _debug_image(
         self,
         img: Image.Image,
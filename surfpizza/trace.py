@@ -0,0 +1,310 @@
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from mllm import ChatResponse, Router
+from PIL import Image
+from threadmem import RoleThread
+
+from .store import ImageStore
+
+logger = logging.getLogger(__name__)
+logger.setLevel(int(os.getenv("LOG_LEVEL", logging.DEBUG)))
+
+
+def _json_safe(value: Any) -> Any:
+    return json.loads(json.dumps(value, default=str))
+
+
+def thread_digest(thread: RoleThread) -> str:
+    """Hash of the text and images of every message in a thread, to tell if two requests are the same
+
+    Args:
+        thread (RoleThread): The thread
+
+    Returns:
+        str: The hash
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for msg in thread.messages():
+        h.update(msg.role.encode())
+        h.update(msg.text.encode())
+        for img in msg.images:
+            h.update(img.encode() if isinstance(img, str) else repr(img).encode())
+    return h.hexdigest()
+
+
+class TraceRecorder:
+    """
+    Records everything a task run takes from the outside world into a local bundle it can be replayed from.
+
+    The bundle is a directory with `trace.jsonl`, one event per line in the order they happened, and the
+    screenshots in an image store under `images`, where a screen that didn't change between captures is
+    only kept once. Events are the screenshots with the mouse position, each router request with its
+    response, and the actions and clicks made, each with how long it took in the recorded run.
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        Initialize the recorder.
+
+        Args:
+            path (str): Directory to write the bundle to.
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.images = ImageStore(os.path.join(path, "images"), quota_bytes=sys.maxsize)
+        self.started = time.time()
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._file = open(os.path.join(path, "trace.jsonl"), "a", encoding="utf-8")
+
+    def start(self, task_id: str, description: Optional[str], **meta: Any) -> None:
+        """Record the start of the run
+
+        Args:
+            task_id (str): ID of the task
+            description (Optional[str]): Description of the task
+            **meta (Any): Extra fields, e.g. the desktop info
+        """
+        self._write("start", task_id=task_id, description=description, **meta)
+
+    def screenshot(
+        self,
+        img: Image.Image,
+        mouse: Optional[Tuple[int, int]] = None,
+        seconds: float = 0.0,
+    ) -> None:
+        """Record a screenshot
+
+        Args:
+            img (Image.Image): The screenshot
+            mouse (Optional[Tuple[int, int]], optional): Mouse position read with it. Defaults to None.
+            seconds (float, optional): How long capturing it took. Defaults to 0.0.
+        """
+        digest = self.images.put(img, "trace", "screenshot")
+        self._write(
+            "screenshot",
+            hash=digest,
+            mouse=list(mouse) if mouse else None,
+            seconds=seconds,
+        )
+
+    def llm(
+        self,
+        namespace: str,
+        thread: RoleThread,
+        response: Optional[ChatResponse],
+        seconds: float,
+        error: Optional[str] = None,
+    ) -> None:
+        """Record a router request and its response
+
+        Args:
+            namespace (str): Namespace of the request
+            thread (RoleThread): Thread sent
+            response (Optional[ChatResponse]): The response, None if the request failed
+            seconds (float): How long the request took
+            error (Optional[str], optional): Why the request failed. Defaults to None.
+        """
+        messages = thread.messages()
+        fields: Dict[str, Any] = {
+            "namespace": namespace,
+            "request": {
+                "digest": thread_digest(thread),
+                "messages": len(messages),
+                "images": sum(len(msg.images) for msg in messages),
+                "text": messages[-1].text if messages else "",
+            },
+            "seconds": seconds,
+        }
+        if error is not None:
+            fields["error"] = error
+        if response is not None:
+            fields["response"] = {
+                "model": response.model,
+                "role": response.msg.role,
+                "text": response.msg.text,
+                "parsed": (
+                    response.parsed.model_dump(mode="json")
+                    if response.parsed is not None
+                    else None
+                ),
+                "time_elapsed": response.time_elapsed,
+                "tokens_request": response.tokens_request,
+                "tokens_response": response.tokens_response,
+            }
+        self._write("llm", **fields)
+
+    def action(
+        self,
+        name: str,
+        parameters: Dict[str, Any],
+        result: Any = None,
+        seconds: float = 0.0,
+        error: Optional[str] = None,
+    ) -> None:
+        """Record an action selected by the model
+
+        Args:
+            name (str): Name of the action
+            parameters (Dict[str, Any]): Its parameters
+            result (Any, optional): What it returned. Defaults to None.
+            seconds (float, optional): How long it took. Defaults to 0.0.
+            error (Optional[str], optional): Why it failed. Defaults to None.
+        """
+        self._write(
+            "action",
+            name=name,
+            parameters=_json_safe(parameters),
+            result=_json_safe(result),
+            seconds=seconds,
+            error=error,
+        )
+
+    def input(self, name: str, seconds: float = 0.0, **parameters: Any) -> None:
+        """Record input sent to the desktop, e.g. a click
+
+        Args:
+            name (str): Kind of input
+            seconds (float, optional): How long sending it took. Defaults to 0.0.
+            **parameters (Any): Its parameters
+        """
+        self._write(
+            "input", name=name, parameters=_json_safe(parameters), seconds=seconds
+        )
+
+    def close(self, status: Optional[str] = None) -> None:
+        """Record the end of the run and close the bundle
+
+        Args:
+            status (Optional[str], optional): Final status of the task. Defaults to None.
+        """
+        with self._lock:
+            if self._file.closed:
+                return
+        self._write("end", status=status, seconds=time.time() - self.started)
+        with self._lock:
+            self._file.close()
+
+    def _write(self, event: str, **fields: Any) -> None:
+        with self._lock:
+            if self._file.closed:
+                return
+            self._seq += 1
+            entry = {
+                "seq": self._seq,
+                "event": event,
+                "t": time.time() - self.started,
+                **fields,
+            }
+            self._file.write(json.dumps(entry, default=str) + "\n")
+            self._file.flush()
+
+
+class TraceRouter:
+    """
+    Wraps a router to record every request made through it and its response in a trace.
+    """
+
+    def __init__(self, router: Router, trace: TraceRecorder) -> None:
+        self.router = router
+        self.trace = trace
+
+    def chat(
+        self, thread: RoleThread, namespace: str = "default", **kwargs: Any
+    ) -> ChatResponse:
+        """Send a request, see `Router.chat`
+
+        Args:
+            thread (RoleThread): Thread to send
+            namespace (str, optional): Namespace of the request. Defaults to "default".
+
+        Returns:
+            ChatResponse: The response
+        """
+        start = time.perf_counter()
+        try:
+            response = self.router.chat(thread, namespace=namespace, **kwargs)
+        except Exception as e:
+            self.trace.llm(
+                namespace, thread, None, time.perf_counter() - start, error=str(e)
+            )
+            raise
+        self.trace.llm(namespace, thread, response, time.perf_counter() - start)
+        return response
+
+
+class TraceBundle:
+    """
+    A bundle written by `TraceRecorder`, loaded to be replayed.
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        Load a bundle.
+
+        Args:
+            path (str): Directory of the bundle.
+        """
+        self.path = path
+        self.images = ImageStore(os.path.join(path, "images"), quota_bytes=sys.maxsize)
+        with open(os.path.join(path, "trace.jsonl"), encoding="utf-8") as f:
+            self.events: List[Dict[str, Any]] = [
+                json.loads(line) for line in f if line.strip()
+            ]
+
+    @property
+    def header(self) -> Dict[str, Any]:
+        """The start event"""
+        return next((e for e in self.events if e["event"] == "start"), {})
+
+    def of(self, event: str) -> List[Dict[str, Any]]:
+        """Events of one kind, in order
+
+        Args:
+            event (str): Kind of event, e.g. 'screenshot' or 'llm'
+
+        Returns:
+            List[Dict[str, Any]]: The events
+        """
+        return [e for e in self.events if e["event"] == event]
+
+    def image(self, digest: str) -> Image.Image:
+        """Load a recorded screenshot
+
+        Args:
+            digest (str): Hash of the screenshot
+
+        Returns:
+            Image.Image: The screenshot
+        """
+        img = self.images.get(digest)
+        if img is None:
+            raise ValueError(f"screenshot {digest} missing from bundle {self.path}")
+        return img
+
+    def recorded_phases(self) -> Dict[str, float]:
+        """Seconds the recorded run spent on each kind of outside call
+
+        Returns:
+            Dict[str, float]: Seconds by phase, with the whole run as 'total'
+        """
+        phases: Dict[str, float] = {}
+        for e in self.events:
+            if e["event"] == "llm":
+                phase = f"llm_{e['namespace']}"
+            elif e["event"] in ("screenshot", "action", "input"):
+                phase = e["event"]
+            else:
+                continue
+            phases[phase] = phases.get(phase, 0.0) + e.get("seconds", 0.0)
+        end = next((e for e in self.events if e["event"] == "end"), None)
+        if end:
+            phases["total"] = end["seconds"]
+        return phases
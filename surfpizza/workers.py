@@ -0,0 +1,213 @@
+import logging
+import math
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from multiprocessing import shared_memory
+from typing import Optional, Tuple
+
+from PIL import Image
+
+from .img import DataURI, divide_image_into_cells, image_hash, image_to_b64
+
+logger = logging.getLogger(__name__)
+logger.setLevel(int(os.getenv("LOG_LEVEL", logging.DEBUG)))
+
+
+def cpu_limit() -> int:
+    """Number of CPUs this process can use, honouring a cgroup CPU quota such as a pod's CPU limit
+
+    Returns:
+        int: Number of CPUs, at least 1
+    """
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            return max(1, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+
+    try:
+        return max(1, len(os.sched_getaffinity(0)))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _write_pixels(img: Image.Image, buf: memoryview) -> None:
+    data = img.tobytes()
+    buf[: len(data)] = data
+
+
+def _attach(name: str, mode: str, size: Tuple[int, int]) -> Image.Image:
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        nbytes = size[0] * size[1] * len(Image.new(mode, (1, 1)).getbands())
+        view = shm.buf[:nbytes]
+        try:
+            return Image.frombytes(mode, size, view)
+        finally:
+            view.release()
+    finally:
+        shm.close()
+
+
+def _encode(name: str, mode: str, size: Tuple[int, int], image_format: str) -> bytes:
+    img = _attach(name, mode, size)
+    buffer = BytesIO()
+    img.save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def _render_composite(
+    name: str,
+    mode: str,
+    size: Tuple[int, int],
+    num_cells: int,
+    rows: Optional[int],
+    overlap: int,
+) -> Tuple[str, bytes]:
+    img = _attach(name, mode, size)
+    composite, _, _ = divide_image_into_cells(
+        img, num_cells, rows=rows, overlap=overlap
+    )
+    buffer = BytesIO()
+    composite.save(buffer, format="PNG")
+    return image_hash(composite), buffer.getvalue()
+
+
+class ImageWorkerPool:
+    """
+    A pool of processes for the CPU heavy image work, encoding and building composites.
+
+    Images are handed to the workers through shared memory rather than being pickled, and only the
+    encoded bytes come back. Running this work in other processes keeps it from holding the GIL the
+    server and the other tasks need. If a worker dies the pool is restarted, and the work that failed
+    is done in-process instead.
+    """
+
+    def __init__(self, workers: int) -> None:
+        """
+        Initialize the pool, worker processes are started on first use.
+
+        Args:
+            workers (int): Number of worker processes.
+        """
+        self.workers = workers
+        self.restarts = 0
+        self._lock = threading.Lock()
+        self._executor = self._new_executor()
+
+    def encode(self, img: Image.Image, image_format: str = "PNG") -> bytes:
+        """Encode an image in a worker
+
+        Args:
+            img (Image.Image): The image
+            image_format (str, optional): Format to encode in. Defaults to "PNG".
+
+        Returns:
+            bytes: The encoded image
+        """
+        return self._run(_encode, img, image_format)
+
+    def render_composite(
+        self,
+        img: Image.Image,
+        num_cells: int,
+        rows: Optional[int] = None,
+        overlap: int = 0,
+    ) -> Tuple[str, bytes]:
+        """Build and encode the composite of an image's cells in a worker, see `divide_image_into_cells`
+
+        Args:
+            img (Image.Image): The image
+            num_cells (int): The number of columns, and of rows if `rows` isn't given
+            rows (Optional[int], optional): The number of rows. Defaults to None.
+            overlap (int, optional): Pixels each cell extends into its neighbours. Defaults to 0.
+
+        Returns:
+            Tuple[str, bytes]: Hash of the composite's pixels and the composite encoded as PNG
+        """
+        return self._run(_render_composite, img, num_cells, rows, overlap)
+
+    def close(self) -> None:
+        """Stop the workers"""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def _restart(self, broken: ProcessPoolExecutor) -> None:
+        with self._lock:
+            # Several calls fail together when a worker dies, only the first restarts the pool
+            if self._executor is not broken:
+                return
+            broken.shutdown(wait=False, cancel_futures=True)
+            self._executor = self._new_executor()
+            self.restarts += 1
+
+    def _run(self, fn, img: Image.Image, *args):
+        if img.mode not in ("RGB", "RGBA", "L"):
+            img = img.convert("RGB")
+        nbytes = img.size[0] * img.size[1] * len(img.getbands())
+        shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        try:
+            if nbytes:
+                _write_pixels(img, shm.buf)
+            executor = self._executor
+            try:
+                return executor.submit(fn, shm.name, img.mode, img.size, *args).result()
+            except BrokenProcessPool:
+                # A worker died, e.g. killed for using too much memory. Start a new pool
+                # for the next calls and do this one here, the pixels are still shared
+                logger.warning("image worker pool broke, restarting it")
+                self._restart(executor)
+                return fn(shm.name, img.mode, img.size, *args)
+        finally:
+            shm.close()
+            shm.unlink()
+
+
+def encode_b64(img: Image.Image, workers: Optional[ImageWorkerPool] = None) -> str:
+    """Encode an image as a base64 PNG data URI, in a worker if there is a pool
+
+    Args:
+        img (Image.Image): The image
+        workers (Optional[ImageWorkerPool], optional): Pool to encode in. Defaults to None.
+
+    Returns:
+        str: The data URI
+    """
+    if workers is None:
+        return image_to_b64(img)
+    return str(DataURI(workers.encode(img), "image/png"))
+
+
+_workers: Optional[ImageWorkerPool] = None
+_workers_lock = threading.Lock()
+
+
+def get_image_workers() -> Optional[ImageWorkerPool]:
+    """Get the image worker pool, creating it on first use
+
+    The number of workers is `IMAGE_WORKERS`, defaulting to one less than the CPUs available to the
+    process, with no pool and the work done in-process when that is 0.
+
+    Returns:
+        Optional[ImageWorkerPool]: The pool, or None if image work runs in-process
+    """
+    global _workers
+    if _workers is None:
+        with _workers_lock:
+            if _workers is None:
+                workers = int(os.getenv("IMAGE_WORKERS", cpu_limit() - 1))
+                if workers <= 0:
+                    return None
+                logger.info(f"starting image worker pool with {workers} workers")
+                _workers = ImageWorkerPool(workers)
+    return _workers
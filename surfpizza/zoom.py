@@ -0,0 +1,220 @@
+import logging
+import os
+import threading
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Callable, Dict, List, Optional
+
+from PIL import Image
+
+from .img import (
+    Box,
+    BoxArray,
+    DataURI,
+    combine_images_vertically,
+    frame_pool,
+    grid_shape,
+    image_hash,
+)
+from . import metrics
+from .workers import ImageWorkerPool, encode_b64
+
+logger = logging.getLogger(__name__)
+logger.setLevel(int(os.getenv("LOG_LEVEL", logging.DEBUG)))
+
+
+@dataclass
+class ZoomNode:
+    """A box of a screenshot that can be zoomed into, with its cells once it has been divided"""
+
+    box: Box
+    img: Image.Image
+    b64: Optional[str] = None
+    composite_b64: Optional[str] = None
+    children: Optional[List["ZoomNode"]] = None
+
+
+class ZoomTree:
+    """
+    The zoom levels of a single screenshot.
+
+    Each node is a box of the screenshot, in absolute coordinates, and dividing it builds its composite
+    and its cells once. Groundings on the same screenshot then reuse the nodes, and their encodings,
+    that earlier groundings already built, rather than dividing and encoding them again. Given a worker
+    pool, composites are built and images encoded in the workers.
+    """
+
+    def __init__(
+        self,
+        frame: Image.Image,
+        digest: str,
+        num_cells: int,
+        aspect_aware: bool = False,
+        overlap: int = 0,
+        workers: Optional[ImageWorkerPool] = None,
+    ) -> None:
+        """
+        Initialize the tree.
+
+        Args:
+            frame (Image.Image): The screenshot.
+            digest (str): Hash of the screenshot.
+            num_cells (int): The number of cells per row and column each node is divided into.
+            aspect_aware (bool, optional): Whether to pick columns and rows from each node's aspect ratio,
+                see `grid_shape`. Defaults to False.
+            overlap (int, optional): Pixels each cell extends into its neighbours. Defaults to 0.
+            workers (Optional[ImageWorkerPool], optional): Pool to do image work in. Defaults to None.
+        """
+        self.digest = digest
+        self.num_cells = num_cells
+        self.aspect_aware = aspect_aware
+        self.overlap = overlap
+        self.workers = workers
+        self.root = ZoomNode(box=Box(0, 0, frame.width, frame.height), img=frame)
+        self.hits = 0
+        self.misses = 0
+
+        self._nodes: Dict[Box, ZoomNode] = {self.root.box: self.root}
+        self._lock = threading.Lock()
+
+    def node(self, box: Box) -> Optional[ZoomNode]:
+        """Get a node that has already been built
+
+        Args:
+            box (Box): Box of the node, in absolute coordinates
+
+        Returns:
+            Optional[ZoomNode]: The node
+        """
+        return self._nodes.get(box)
+
+    def encoded(self, node: ZoomNode) -> str:
+        """The image of a node encoded, encoding it on first use
+
+        Args:
+            node (ZoomNode): The node
+
+        Returns:
+            str: The encoded image
+        """
+        if node.b64 is None:
+            node.b64 = encode_b64(node.img, self.workers)
+        return node.b64
+
+    def expand(
+        self,
+        node: ZoomNode,
+        on_composite: Optional[Callable[[str, bytes], None]] = None,
+    ) -> List[ZoomNode]:
+        """Divide a node into its cells, only building them the first time
+
+        Args:
+            node (ZoomNode): The node
+            on_composite (Callable[[str, bytes], None], optional): Called with the hash of the composite
+                and the composite encoded as PNG when it is built. Defaults to None.
+
+        Returns:
+            List[ZoomNode]: The cells, numbered as in the composite
+        """
+        with self._lock:
+            if node.children is not None:
+                self.hits += 1
+                metrics.zoom_tree_cache.inc(result="hit")
+                return node.children
+            self.misses += 1
+            metrics.zoom_tree_cache.inc(result="miss")
+
+            cols, rows = self.num_cells, self.num_cells
+            if self.aspect_aware:
+                cols, rows = grid_shape(node.img.width, node.img.height, self.num_cells)
+            boxes = BoxArray.grid(
+                Box(0, 0, node.img.width, node.img.height), cols, rows, self.overlap
+            ).to_boxes()
+            cropped_imgs = [box.crop_image(node.img) for box in boxes]
+
+            if self.workers:
+                digest, png = self.workers.render_composite(
+                    node.img, cols, rows, self.overlap
+                )
+            else:
+                composite = combine_images_vertically(cropped_imgs, pool=frame_pool)
+                try:
+                    digest = image_hash(composite)
+                    buffer = BytesIO()
+                    composite.save(buffer, format="PNG")
+                    png = buffer.getvalue()
+                finally:
+                    frame_pool.release(composite)
+
+            node.composite_b64 = str(DataURI(png, "image/png"))
+            if on_composite:
+                on_composite(digest, png)
+
+            children = []
+            for img, box in zip(cropped_imgs, boxes):
+                absolute = box.to_absolute(node.box)
+                child = self._nodes.get(absolute)
+                if child is None:
+                    child = ZoomNode(box=absolute, img=img)
+                    self._nodes[absolute] = child
+                children.append(child)
+            node.children = children
+            return children
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+
+class ZoomTreeCache:
+    """
+    Holds the zoom tree of the latest screenshot.
+
+    Getting the tree for a screenshot reuses the current one if the screen hasn't changed, and drops
+    it for a new one as soon as it has.
+    """
+
+    def __init__(self) -> None:
+        self._tree: Optional[ZoomTree] = None
+        self._lock = threading.Lock()
+
+    def get(
+        self,
+        frame: Image.Image,
+        num_cells: int,
+        aspect_aware: bool = False,
+        overlap: int = 0,
+        workers: Optional[ImageWorkerPool] = None,
+    ) -> ZoomTree:
+        """Get the zoom tree for a screenshot
+
+        Args:
+            frame (Image.Image): The screenshot
+            num_cells (int): The number of cells per row and column each node is divided into
+            aspect_aware (bool, optional): Whether to pick columns and rows from each node's aspect ratio. Defaults to False.
+            overlap (int, optional): Pixels each cell extends into its neighbours. Defaults to 0.
+            workers (Optional[ImageWorkerPool], optional): Pool to do image work in. Defaults to None.
+
+        Returns:
+            ZoomTree: The tree
+        """
+        digest = image_hash(frame)
+        with self._lock:
+            tree = self._tree
+            if (
+                tree
+                and tree.digest == digest
+                and tree.num_cells == num_cells
+                and tree.aspect_aware == aspect_aware
+                and tree.overlap == overlap
+            ):
+                logger.debug(f"reusing zoom tree with {len(tree)} nodes for {digest}")
+                return tree
+            self._tree = ZoomTree(
+                frame, digest, num_cells, aspect_aware, overlap, workers
+            )
+            return self._tree
+
+    def clear(self) -> None:
+        """Drop the current tree"""
+        with self._lock:
+            self._tree = None
@@ -0,0 +1,62 @@
+import time
+
+import pytest
+from taskara import TaskStatus
+
+from surfpizza.cancel import CancelWatcher, TaskCancelled
+
+
+class FakeTask:
+    """Stands in for a remote task, returning a status per poll."""
+
+    def __init__(self, statuses: list, remote: str = "http://tasks"):
+        self.id = "task-1"
+        self.remote = remote
+        self.auth_token = None
+        self.status = TaskStatus.IN_PROGRESS
+        self.statuses = statuses
+
+    def _remote_request(self, addr, method, endpoint, auth_token=None):
+        assert endpoint == "/v1/tasks/task-1"
+        status = self.statuses.pop(0) if len(self.statuses) > 1 else self.statuses[0]
+        if isinstance(status, Exception):
+            raise status
+        return {"id": self.id, "status": status}
+
+
+def wait_for(condition, timeout: float = 5.0) -> bool:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_watcher_flags_cancellation():
+    """Test that a remote cancellation is picked up in the background and stops work."""
+    task = FakeTask(
+        ["in progress", ConnectionError("down"), "in progress", "canceling"]
+    )
+    watcher = CancelWatcher(task, interval=0.01, max_interval=0.05).start()  # type: ignore
+
+    assert wait_for(lambda: watcher.cancelled)
+    assert watcher.status == TaskStatus.CANCELING
+    assert watcher.polls == 3
+    with pytest.raises(TaskCancelled):
+        watcher.check()
+    watcher.stop()
+
+
+def test_watcher_checks_local_tasks_in_process():
+    """Test that local tasks aren't polled but their status is still checked."""
+    task = FakeTask(["canceling"], remote=None)  # type: ignore
+    watcher = CancelWatcher(task, interval=0.01).start()  # type: ignore
+
+    time.sleep(0.05)
+    assert watcher.polls == 0
+    watcher.check()
+
+    task.status = TaskStatus.CANCELED
+    assert watcher.cancelled
+    watcher.stop()
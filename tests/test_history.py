@@ -0,0 +1,93 @@
+from threadmem import RoleMessage
+
+from surfpizza.history import StepHistory
+
+
+def make_history(max_turns: int = 4, keep_turns: int = 2) -> StepHistory:
+    prefix = [
+        RoleMessage(role="user", text="system prompt"),
+        RoleMessage(role="assistant", text="ready"),
+        RoleMessage(role="user", text="your task"),
+    ]
+    return StepHistory(prefix, max_turns=max_turns, keep_turns=keep_turns)
+
+
+def take_step(history: StepHistory, step: int) -> None:
+    thread = history.build(RoleMessage(role="user", text=f"screenshot {step}"))
+    history.record_usage(thread)
+    history.add_turn(
+        f"screenshot {step}",
+        RoleMessage(role="assistant", text=f"action {step}"),
+        f"click {step}",
+    )
+
+
+def test_history_window_is_bounded():
+    """Test that old turns are folded into a summary once the window is full."""
+    history = make_history()
+    for step in range(1, 6):
+        take_step(history, step)
+
+    assert [turn.step for turn in history.turns] == [4, 5]
+    assert history.summary is not None
+    assert "step 1: click 1" in history.summary.text
+    assert "step 3: click 3" in history.summary.text
+    assert len(history.messages()) == 3 + 1 + 4
+
+
+def test_history_summary_is_bounded():
+    """Test that the summary stays the same size however many long actions are dropped."""
+    history = StepHistory(
+        [RoleMessage(role="user", text="your task")],
+        max_turns=4,
+        keep_turns=2,
+        summary_steps=5,
+        action_chars=50,
+    )
+    sizes = []
+    for step in range(1, 201):
+        history.add_turn(
+            f"screenshot {step}",
+            RoleMessage(role="assistant", text=f"action {step}"),
+            f"type_text {{'text': '{'lorem ipsum ' * 100}'}}",
+        )
+        if history.summary:
+            sizes.append(len(history.summary.text))
+
+    assert history.summary is not None
+    assert "193 steps not listed" in history.summary.text
+    assert "step 198: type_text" in history.summary.text
+    assert max(sizes) < 500
+    assert max(sizes[-50:]) - min(sizes[-50:]) <= 2
+
+
+def test_history_prefix_is_stable_between_trims():
+    """Test that each request starts with the messages of the one before."""
+    history = make_history(max_turns=10, keep_turns=5)
+    for step in range(1, 4):
+        take_step(history, step)
+
+    first, second, third = history.usage
+    assert first.prefix_tokens == 0
+    # everything but the new screenshot and the previous turn is reused
+    assert second.new_tokens < second.sent_tokens
+    assert third.prefix_tokens > second.prefix_tokens
+
+
+def test_history_build_only_appends_new_message():
+    """Test that building a request sends the stored messages and the new one, sharing their contents."""
+    history = make_history()
+    take_step(history, 1)
+
+    msg = RoleMessage(
+        role="user", text="screenshot 2", images=["data:image/png;base64,AA=="]
+    )
+    thread = history.build(msg)
+    messages = thread.messages()
+    assert [m.id for m in messages] == [m.id for m in history.messages()] + [msg.id]
+    assert messages[-1].images[0] is msg.images[0]
+    assert all(a.text is b.text for a, b in zip(messages, history.messages()))
+
+    # building again, e.g. on a retry, doesn't change the history
+    history.build(msg)
+    assert len(history.messages()) == 5
@@ -1,10 +1,24 @@
+import base64
+import pickle
+from io import BytesIO
+
 import pytest
 from PIL import Image
 from surfpizza.img import (
+    changed_fraction,
     create_grid_image_by_num_cells,
+    divide_image_into_cells,
+    grid_shape,
     zoom_in,
     superimpose_images,
     Box,
+    B64_ENCODED_CHUNK,
+    BoxArray,
+    DataURI,
+    FramePool,
+    b64_to_image,
+    image_to_b64,
+    load_image_base64,
 )  # Adjust the import according to your module structure
 
 
@@ -63,3 +77,180 @@ def test_superimpose_images():
     superimposed_img = superimpose_images(base_img, layer_img)
     assert superimposed_img.size == base_img.size
     # Further checks could verify pixel values to ensure correct superimposition.
+
+
+def test_frame_pool_reuses_buffers():
+    """Test that released buffers are handed back out and memory is tracked."""
+    pool = FramePool(max_idle=2)
+    img = pool.acquire("RGB", (10, 10), "white")
+    assert pool.stats()["in_use_bytes"] == 300
+    img.paste((0, 0, 0), (0, 0, 5, 5))
+    pool.release(img)
+
+    reused = pool.acquire("RGB", (10, 10), "white")
+    assert reused is img
+    assert reused.getpixel((0, 0)) == (255, 255, 255)
+
+    stats = pool.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["peak_bytes"] == 300
+
+
+def test_frame_pool_caps_idle_buffers():
+    """Test that the pool only keeps max_idle buffers per size."""
+    pool = FramePool(max_idle=1)
+    first = pool.acquire("RGBA", (4, 4))
+    second = pool.acquire("RGBA", (4, 4))
+    pool.release(first)
+    pool.release(second)
+    assert pool.stats()["idle_bytes"] == 64
+    assert pool.stats()["in_use_bytes"] == 0
+
+
+def test_frame_pool_caps_idle_bytes_across_sizes():
+    """Test that idle buffers of sizes not seen again are evicted, least recently released first."""
+    pool = FramePool(max_idle=4, max_idle_bytes=3 * 400)
+    for width in range(10, 15):
+        pool.release(pool.acquire("RGBA", (width, 10)))
+    assert pool.stats()["idle_bytes"] <= 3 * 400
+    assert len(pool._idle) == 2
+
+    # The most recently released sizes are the ones kept
+    pool.acquire("RGBA", (14, 10))
+    assert pool.stats()["hits"] == 1
+    pool.acquire("RGBA", (10, 10))
+    assert pool.stats()["hits"] == 1
+
+
+def test_image_b64_round_trip():
+    """Test that an image survives encoding and decoding as a data URI."""
+    img = create_test_image(64, 48, (1, 2, 3, 255))
+    data_uri = image_to_b64(img)
+    assert data_uri.startswith("data:image/png;base64,")
+
+    decoded = b64_to_image(data_uri)
+    assert decoded.size == (64, 48)
+    assert decoded.getpixel((10, 10)) == (1, 2, 3, 255)
+
+    # Plain base64 and bytes input are accepted too
+    assert b64_to_image(data_uri.split(",")[1]).size == (64, 48)
+    assert b64_to_image(data_uri.encode()).size == (64, 48)
+
+
+def test_b64_to_image_accepts_wrapped_base64():
+    """Test that base64 wrapped with line breaks decodes even when it spans several chunks."""
+    img = Image.effect_noise((512, 512), 64).convert("RGB")
+    png = BytesIO()
+    img.save(png, format="PNG")
+    wrapped = base64.encodebytes(png.getvalue())
+    assert len(wrapped) > 2 * B64_ENCODED_CHUNK
+
+    for data in (wrapped, wrapped.decode(), b"data:image/png;base64," + wrapped):
+        decoded = b64_to_image(data)
+        assert decoded.tobytes() == img.tobytes()
+
+
+def test_data_uri_is_lazy_and_matches_image_to_b64():
+    """Test that a DataURI only encodes on demand and matches image_to_b64."""
+    img = create_test_image(32, 32)
+    data_uri = DataURI.from_image(img)
+    assert data_uri._encoded is None
+    assert str(data_uri) == image_to_b64(img)
+    assert bytes(data_uri.encode()) == image_to_b64(img).encode()
+
+    parsed = DataURI.parse(str(data_uri))
+    assert parsed.mime_type == "image/png"
+    assert bytes(parsed.raw) == bytes(data_uri.raw)
+
+
+def test_load_image_base64_passes_file_through(tmp_path):
+    """Test that an already encoded file is not re-encoded."""
+    path = tmp_path / "img.png"
+    create_test_image(16, 16).save(path)
+
+    data_uri = load_image_base64(str(path))
+    assert data_uri.startswith("data:image/png;base64,")
+    assert bytes(DataURI.parse(data_uri).raw) == path.read_bytes()
+
+
+def test_box_is_immutable_and_hashable():
+    """Test that boxes can be used as cache keys."""
+    box = Box(0, 0, 10, 20)
+    with pytest.raises(AttributeError):
+        box.left = 5
+    assert box == Box(0, 0, 10, 20)
+    assert len({box, Box(0, 0, 10, 20), Box(1, 0, 10, 20)}) == 2
+    assert pickle.loads(pickle.dumps(box)) == box
+    assert not hasattr(box, "__dict__")
+
+
+def test_box_array_grid_matches_divide_image_into_cells():
+    """Test that the vectorised grid matches the per-cell boxes."""
+    img = create_test_image(301, 203)
+    _, _, boxes = divide_image_into_cells(img, 3)
+    grid = BoxArray.grid(Box(0, 0, 301, 203), 3)
+    assert grid.to_boxes() == boxes
+    assert grid[4] == Box(100, 67, 200, 135)
+
+
+def test_box_array_batch_operations():
+    """Test translation, centers, containment and IoU on box arrays."""
+    boxes = BoxArray([(0, 0, 10, 10), (5, 5, 15, 15)])
+    moved = boxes.to_absolute(Box(100, 200, 300, 400))
+    assert moved.to_boxes() == [Box(100, 200, 110, 210), Box(105, 205, 115, 215)]
+    assert moved.centers().tolist() == [[105, 205], [110, 210]]
+
+    assert boxes.intersection(boxes).tolist() == [[100, 25], [25, 100]]
+    iou = boxes.iou(boxes)
+    assert iou[0, 0] == 1.0
+    assert iou[0, 1] == pytest.approx(25 / 175)
+
+    assert boxes.contains_points([(1, 1), (12, 12)]).tolist() == [
+        [True, False],
+        [False, True],
+    ]
+    assert BoxArray([(0, 0, 20, 20)]).contains(boxes).tolist() == [[True, True]]
+
+    cells = boxes.split(2)
+    assert len(cells) == 8
+    assert cells[7] == Box(10, 10, 15, 15)
+
+
+def test_grid_covers_remainder_and_overlaps():
+    """Test that uneven grids cover every pixel and that overlap is clamped to the box."""
+    grid = BoxArray.grid(Box(0, 0, 100, 50), 3, rows=2)
+    assert len(grid) == 6
+    assert grid.areas().sum() == 100 * 50
+    assert grid[5] == Box(66, 25, 100, 50)
+
+    overlapped = BoxArray.grid(Box(0, 0, 100, 50), 3, rows=2, overlap=5)
+    assert overlapped[0] == Box(0, 0, 38, 30)
+    assert overlapped[5] == Box(61, 20, 100, 50)
+
+    assert Box(0, 0, 100, 100).zoom_in(3, 3) == Box(66, 0, 100, 33)
+
+
+def test_grid_shape_follows_aspect_ratio():
+    """Test that wide areas get more columns than rows."""
+    assert grid_shape(900, 900, 3) == (3, 3)
+    assert grid_shape(1920, 1080, 3) == (4, 2)
+    assert grid_shape(3440, 1440, 3) == (5, 2)
+    assert grid_shape(1080, 1920, 3) == (2, 4)
+
+    _, cells, boxes = divide_image_into_cells(create_test_image(1920, 1080), 4, rows=2)
+    assert [cell.size for cell in cells] == [(480, 540)] * 8
+    assert boxes[-1] == Box(1440, 540, 1920, 1080)
+
+
+def test_changed_fraction():
+    """Test that only the changed pixels inside the box count, clamped to the image."""
+    before = Image.new("RGB", (100, 100), "white")
+    after = before.copy()
+    after.paste((0, 0, 0), (0, 0, 10, 10))
+    after.paste((250, 250, 250), (50, 50, 100, 100))
+
+    assert changed_fraction(before, after, Box(0, 0, 20, 20)) == 0.25
+    assert changed_fraction(before, after, Box(-10, -10, 10, 10)) == 1.0
+    assert changed_fraction(before, after, Box(40, 40, 100, 100)) == 0.0
+    assert changed_fraction(before, after.resize((50, 50)), Box(0, 0, 20, 20)) == 1.0
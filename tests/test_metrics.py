@@ -0,0 +1,65 @@
+import pytest
+
+from surfpizza.metrics import MetricsRegistry, registry
+
+
+def test_render_exposition_format():
+    """Test that counters, gauges and histograms render in the Prometheus text format."""
+    metrics = MetricsRegistry(prefix="test")
+    calls = metrics.counter("llm_calls", "LLM calls", labels=("namespace",))
+    active = metrics.gauge("active_tasks", "Tasks being solved")
+    latency = metrics.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+
+    calls.inc(namespace="zoom")
+    calls.inc(2, namespace="zoom")
+    active.inc()
+    active.inc()
+    active.dec()
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(5)
+
+    lines = metrics.render().splitlines()
+    assert "# TYPE test_llm_calls_total counter" in lines
+    assert 'test_llm_calls_total{namespace="zoom"} 3' in lines
+    assert "test_active_tasks 1" in lines
+    assert 'test_latency_seconds_bucket{le="0.1"} 1' in lines
+    assert 'test_latency_seconds_bucket{le="1"} 2' in lines
+    assert 'test_latency_seconds_bucket{le="+Inf"} 3' in lines
+    assert "test_latency_seconds_sum 5.55" in lines
+    assert "test_latency_seconds_count 3" in lines
+
+
+def test_default_registry_collects_process_stats():
+    """Test that the default registry reports the stats tracked elsewhere."""
+    text = registry.render()
+    assert "surfpizza_process_resident_memory_bytes" in text
+    assert 'surfpizza_retries_total{kind="transport"}' in text
+    assert 'surfpizza_cache_lookups_total{cache="frame_pool",result="hit"}' in text
+    assert "surfpizza_frame_pool_peak_bytes " in text
+
+
+def test_render_parses_with_prometheus_client():
+    """Test that every family parses with its declared type, samples included."""
+    parser = pytest.importorskip("prometheus_client.parser")
+    metrics = MetricsRegistry(prefix="test")
+    metrics.counter("steps", "Steps").inc(2)
+    metrics.histogram("latency_seconds", "Latency", buckets=(1.0,)).observe(0.5)
+
+    parsed = {
+        family.name: family
+        for family in parser.text_string_to_metric_families(metrics.render())
+    }
+    assert parsed["test_steps"].type == "counter"
+    assert [(s.name, s.value) for s in parsed["test_steps"].samples] == [
+        ("test_steps_total", 2.0)
+    ]
+    assert parsed["test_latency_seconds"].type == "histogram"
+    assert len(parsed["test_latency_seconds"].samples) == 4
+
+    # The default registry, collectors included, has no untyped families
+    families = list(parser.text_string_to_metric_families(registry.render()))
+    assert families and all(family.type != "unknown" for family in families)
+    assert {"surfpizza_retries", "surfpizza_cache_lookups"} <= {
+        family.name for family in families
+    }
@@ -0,0 +1,60 @@
+from surfpizza.img import Box
+from surfpizza.ocr import (
+    TextLocator,
+    Word,
+    match_words,
+    names_own_text,
+    quoted_text,
+)
+
+
+def word(text, left, line=(1, 1, 1), confidence=95.0):
+    return Word(
+        text=text,
+        box=Box(left, 10, left + 40, 30),
+        confidence=confidence,
+        line=line,
+    )
+
+
+def test_quoted_text():
+    """Test that quoted literal text is pulled out of descriptions, ignoring apostrophes."""
+    assert quoted_text(
+        "a round dark blue icon with the text 'Home' in the top-right of the image"
+    ) == ["Home"]
+    assert quoted_text('the user\'s "Sign in" button') == ["Sign in"]
+    assert quoted_text("the user's profile picture") == []
+    assert quoted_text("the ‘Save’ and “Cancel” buttons") == ["Save", "Cancel"]
+
+
+def test_names_own_text():
+    """Test that only quotes of the element's own text are told apart from quoted labels."""
+    assert names_own_text("the 'Save' button in the top-right of the image")
+    assert names_own_text("the link with the text 'Home'")
+    assert names_own_text("the 'File' menu")
+    assert not names_own_text("a white text field labelled 'Email'")
+    assert not names_own_text("the checkbox to the left of 'Remember me'")
+    assert not names_own_text("the search box with the placeholder 'Search'")
+
+
+def test_match_words():
+    """Test that phrases are matched on consecutive words of a line."""
+    words = [
+        word("Sign", 0),
+        word("in", 50),
+        word("Sign", 0, line=(1, 1, 2)),
+        word("up", 50, line=(1, 1, 2)),
+        word("sign", 200, line=(1, 1, 2)),
+        word("In!", 250, line=(1, 1, 2), confidence=40.0),
+    ]
+    matches = match_words(words, "Sign in")
+    assert [m.box for m in matches] == [Box(0, 10, 90, 30)]
+    assert len(match_words(words, "sign in", min_confidence=30)) == 2
+    assert match_words(words, "Home") == []
+
+
+def test_locator_unavailable_finds_nothing():
+    """Test that the locator falls back to finding nothing without OCR."""
+    locator = TextLocator()
+    locator._available = False
+    assert locator.find(None, "Home") == []  # type: ignore
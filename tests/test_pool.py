@@ -0,0 +1,114 @@
+import threading
+import time
+
+import pytest
+import requests
+from agentdesk.device_v1 import Desktop
+from toolfuse import Tool
+
+import surfpizza.agent as agent
+from surfpizza.agent import SurfPizza
+from surfpizza.pool import DesktopPool
+from surfpizza.replay import ReplayTask
+
+
+class FakeDesktop:
+    """Stands in for a desktop, counting info calls."""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.info_calls = 0
+
+    def info(self) -> dict:
+        self.info_calls += 1
+        return {"screen_size": {"x": 1280, "y": 720}}
+
+
+def test_pool_reuses_setup_for_same_desktop():
+    """Test that desktop info and tool schemas are only fetched once per desktop."""
+    pool = DesktopPool()
+    desktop = FakeDesktop("http://desktop-1")
+
+    warm = pool.get(desktop)
+    assert warm.get_info(desktop)["screen_size"]["x"] == 1280
+    assert warm.get_tools(lambda: [{"name": "click_object"}])
+
+    again = pool.get(desktop)
+    assert again is warm
+    again.get_info(desktop)
+    assert again.get_tools(lambda: []) == [{"name": "click_object"}]
+    assert desktop.info_calls == 1
+
+    assert pool.get(FakeDesktop("http://desktop-2")) is not warm
+    assert len(pool) == 2
+
+
+def test_pool_evicts_idle_entries():
+    """Test that entries unused for longer than the idle timeout are dropped."""
+    pool = DesktopPool(idle_timeout=60)
+    desktop = FakeDesktop("http://desktop-1")
+    warm = pool.get(desktop)
+    pool.release(warm)
+    warm.last_used = time.time() - 120
+
+    assert pool.get(desktop) is not warm
+    assert warm.retired
+    assert len(pool) == 1
+
+
+def test_pool_keeps_entries_in_use():
+    """Test that tasks on the same desktop get their own sessions and entries in use aren't closed."""
+    pool = DesktopPool(idle_timeout=60)
+    desktop = FakeDesktop("http://desktop-1")
+
+    first = pool.get(desktop)
+    second = pool.get(desktop)
+    assert first is second and first.users == 2
+    a, b = first.acquire_session(), second.acquire_session()
+    assert a is not b
+
+    # An idle entry still in use isn't evicted
+    first.last_used = time.time() - 120
+    assert pool.get(FakeDesktop("http://desktop-2")) is not first
+    assert pool.get(desktop) is first
+    pool.release(first)
+
+    # Sessions are reused once released
+    first.release_session(a)
+    assert first.acquire_session() is a
+
+    # Evicted while in use, the entry is only closed by its last release
+    pool.evict(desktop.base_url)
+    assert not first.retired
+    pool.release(first)
+    pool.release(first)
+    assert first.retired and first.users == 0
+    first.release_session(b)
+    assert first.acquire_session() is not b
+
+
+class BrokenDesktop(Desktop):
+    """Stands in for a desktop that can't be reached."""
+
+    def __init__(self):
+        Tool.__init__(self)
+        self.base_url = "http://broken"
+
+    def info(self) -> dict:
+        raise requests.ConnectionError("desktop is down")
+
+
+def test_solve_task_releases_setup_that_fails(tmp_path, monkeypatch):
+    """Test that whatever a task acquired is released when its setup fails part way."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("TRACE_DIR", str(tmp_path / "traces"))
+    pool = DesktopPool()
+    monkeypatch.setattr(agent, "desktop_pool", pool)
+
+    task = ReplayTask("task-1", "click the button")
+    with pytest.raises(requests.ConnectionError):
+        SurfPizza().solve_task(task, BrokenDesktop())  # type: ignore
+
+    warm = pool.get(BrokenDesktop())
+    assert warm.users == 1 and len(warm._sessions) == 1
+    assert not [t for t in threading.enumerate() if t.name == "recorder-task-1"]
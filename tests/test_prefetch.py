@@ -0,0 +1,58 @@
+import time
+
+from PIL import Image
+
+from surfpizza.img import b64_to_image
+from surfpizza.prefetch import ScreenshotPrefetcher
+
+
+class FakeDesktop:
+    """Stands in for a desktop, counting screenshots."""
+
+    def __init__(self, fail: int = 0):
+        self.screenshots = 0
+        self.fail = fail
+
+    def take_screenshots(self):
+        self.screenshots += 1
+        if self.fail:
+            self.fail -= 1
+            raise ConnectionError("desktop unavailable")
+        return [Image.new("RGB", (32, 16), (self.screenshots, 0, 0))]
+
+    def mouse_coordinates(self):
+        return (5, 6)
+
+
+def test_prefetch_captures_in_background():
+    """Test that a scheduled frame is captured while the caller does other work."""
+    desktop = FakeDesktop()
+    frames = ScreenshotPrefetcher(desktop, settle=0.05)  # type: ignore
+
+    frames.schedule()
+    time.sleep(0.2)
+    assert desktop.screenshots == 1
+
+    start = time.time()
+    frame = frames.get()
+    assert time.time() - start < 0.05
+    assert frame.mouse == (5, 6)
+    assert b64_to_image(frame.b64).getpixel((0, 0)) == (1, 0, 0)
+    assert frames.hits == 1
+
+    # Without a scheduled capture the frame is taken straight away
+    assert frames.get().image.getpixel((0, 0)) == (2, 0, 0)
+    assert frames.misses == 1
+    frames.close()
+
+
+def test_prefetch_recaptures_after_failure():
+    """Test that a failed prefetch is captured again when the frame is needed."""
+    desktop = FakeDesktop(fail=1)
+    frames = ScreenshotPrefetcher(desktop, settle=0)  # type: ignore
+
+    frames.schedule()
+    frame = frames.get()
+    assert frame.image.getpixel((0, 0)) == (2, 0, 0)
+    assert frames.hits == 0 and frames.misses == 1
+    frames.close()
@@ -0,0 +1,128 @@
+import json
+import time
+from io import BytesIO
+
+from PIL import Image
+from skillpacks.server.models import V1Action
+from toolfuse.models import V1ToolRef
+
+from surfpizza import metrics
+from surfpizza.img import image_hash
+from surfpizza.recorder import ActionRecorder
+
+
+class FakePrompt:
+    """Stands in for a prompt, only the id is logged."""
+
+    def __init__(self, id: str):
+        self.id = id
+
+
+class FakeTask:
+    """Stands in for a task, recording what is uploaded."""
+
+    def __init__(self, id: str = "task-1", fail: bool = False, delay: float = 0.0):
+        self.id = id
+        self.fail = fail
+        self.delay = delay
+        self.prompts = []
+        self.actions = []
+
+    def add_prompt(self, prompt):
+        time.sleep(self.delay)
+        if self.fail:
+            raise ValueError("bad prompt")
+        self.prompts.append(prompt)
+
+    def record_action(self, **kwargs):
+        self.actions.append(kwargs)
+
+
+def read_log(recorder: ActionRecorder) -> list:
+    with open(recorder.log_path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_recorder_uploads_and_acknowledges(tmp_path):
+    """Test that buffered prompts and actions are uploaded in order and acknowledged in the log."""
+    task = FakeTask()
+    recorder = ActionRecorder(task, data_path=str(tmp_path), flush_interval=0.05)  # type: ignore
+    uploaded = metrics.image_bytes_uploaded.value(kind="action")
+
+    img = Image.new("RGB", (16, 16), "red")
+    recorder.add_prompt(FakePrompt("p1"))  # type: ignore
+    for _ in range(2):
+        recorder.record_action(
+            images=[img],
+            prompt=FakePrompt("p1"),  # type: ignore
+            action=V1Action(name="click_object", parameters={"description": "ok"}),
+            tool=V1ToolRef(module="surfpizza.tool", type="SemanticDesktop"),
+            agent_id="SurfPizza",
+        )
+    recorder.close(timeout=10)
+
+    assert [p.id for p in task.prompts] == ["p1"]
+    assert len(task.actions) == 2
+    assert task.actions[0]["action"].name == "click_object"
+    assert recorder.uploaded == 3 and recorder.failed == 0
+
+    # Without storage the screenshot is sent inline with both actions, counted decoded
+    png = BytesIO()
+    img.save(png, format="PNG")
+    assert metrics.image_bytes_uploaded.value(kind="action") - uploaded == 2 * len(
+        png.getvalue()
+    )
+
+    log = read_log(recorder)
+    assert [r["seq"] for r in log if "ack" not in r] == [1, 2, 3]
+    assert all(r["ack"] for r in log if "ack" in r)
+
+    # The unchanged screenshot is only stored once
+    manifest = recorder.store.manifest(task.id)
+    assert [e["name"] for e in manifest] == ["action_2", "action_3"]
+    assert {e["hash"] for e in manifest} == {image_hash(img)}
+    assert recorder.store.stats()["writes"] == 1
+
+
+def test_recorder_logs_failed_uploads(tmp_path):
+    """Test that an upload that can't be retried is marked as failed without stopping the recorder."""
+    task = FakeTask(fail=True)
+    recorder = ActionRecorder(task, data_path=str(tmp_path), flush_interval=0.05)  # type: ignore
+
+    recorder.add_prompt(FakePrompt("p1"))  # type: ignore
+    assert recorder.flush(timeout=10)
+    recorder.close(timeout=10)
+
+    assert recorder.failed == 1
+    acks = [r for r in read_log(recorder) if "ack" in r]
+    assert acks == [
+        {
+            "seq": 1,
+            "kind": "prompt",
+            "time": acks[0]["time"],
+            "ack": False,
+            "error": "bad prompt",
+        }
+    ]
+
+
+def test_recorder_close_times_out(tmp_path):
+    """Test that uploads still going when close times out finish and are logged."""
+    task = FakeTask(delay=0.5)
+    recorder = ActionRecorder(task, data_path=str(tmp_path), flush_interval=0.05)  # type: ignore
+
+    recorder.add_prompt(FakePrompt("p1"))  # type: ignore
+    recorder.close(timeout=0.01)
+    assert recorder._thread.is_alive()
+
+    recorder._thread.join(10)
+    assert [p.id for p in task.prompts] == ["p1"]
+    assert [r["ack"] for r in read_log(recorder) if "ack" in r] == [True]
+
+
+def test_image_hash_depends_on_content():
+    """Test that image hashes only match for identical images."""
+    a = Image.new("RGB", (8, 8), "red")
+    assert image_hash(a) == image_hash(a.copy())
+    assert image_hash(a) != image_hash(Image.new("RGB", (8, 8), "blue"))
+    assert image_hash(a) != image_hash(Image.new("RGB", (8, 4), "red"))
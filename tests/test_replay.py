@@ -0,0 +1,91 @@
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image
+from skillpacks.server.models import V1ActionSelection
+from threadmem import RoleMessage, RoleThread
+
+from surfpizza import metrics
+from surfpizza.replay import replay
+from surfpizza.tool import ZoomSelection
+from surfpizza.trace import TraceRecorder
+
+
+def _response(parsed):
+    return SimpleNamespace(
+        model="test-model",
+        msg=RoleMessage(role="assistant", text=parsed.model_dump_json()),
+        parsed=parsed,
+        time_elapsed=1.0,
+        tokens_request=100,
+        tokens_response=10,
+    )
+
+
+def _select(name, **parameters):
+    return V1ActionSelection.model_validate(
+        {
+            "observation": "a page",
+            "reason": "it is next",
+            "expectation": "the page changes",
+            "action": {"name": name, "parameters": parameters},
+        }
+    )
+
+
+def test_replay_runs_recorded_task_offline(tmp_path, monkeypatch):
+    """Test that a recorded run replays through the agent without a desktop or model."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("MAX_DEPTH", "3")
+    monkeypatch.setenv("NUM_CELLS", "3")
+    monkeypatch.setenv("OCR_PREFILTER", "false")
+    monkeypatch.setenv("CLICK_VERIFY", "off")
+
+    # A run that clicks a button in the middle of the screen and then finishes
+    path = str(tmp_path / "bundle")
+    trace = TraceRecorder(path)
+    trace.start("task-1", "click the button")
+    screen = Image.new("RGB", (270, 270), "white")
+    thread = RoleThread()
+    trace.screenshot(screen, (5, 5), seconds=0.5)
+    trace.llm(
+        "action",
+        thread,
+        _response(_select("click_object", description="button", type="single")),  # type: ignore
+        seconds=2.0,
+    )
+    trace.screenshot(screen, seconds=0.5)
+    for _ in range(3):
+        trace.llm("zoom", thread, _response(ZoomSelection(number=4)), seconds=1.0)  # type: ignore
+    trace.input("click", seconds=4.0, x=135, y=135, type="single", button="left")
+    trace.action("click_object", {"description": "button", "type": "single"})
+    trace.screenshot(screen, (135, 135), seconds=0.5)
+    trace.llm("action", thread, _response(_select("result", value="done")), seconds=2.0)  # type: ignore
+    trace.close("finished")
+
+    with open(os.path.join(path, "trace.jsonl")) as f:
+        assert len([json.loads(line) for line in f]) == 12
+    assert len(os.listdir(os.path.join(path, "images", "blobs"))) == 1
+
+    report = replay(path)
+
+    assert report.status == "finished", report.error
+    assert report.clicks_match
+    assert report.screenshots == 3
+    assert report.calls["llm_action"] == 2 and report.calls["llm_zoom"] == 3
+    assert report.calls["step"] == 2 and report.calls["zoom"] == 3
+    assert report.recorded["llm_zoom"] == 3.0
+    assert report.seconds < report.recorded["total"] + 10
+    assert "TRACE_DIR" not in os.environ and "CLICK_SETTLE_SECONDS" not in os.environ
+
+
+def test_replay_refuses_to_run_next_to_live_tasks(tmp_path):
+    """Test that a replay won't patch process-wide state while a task is being solved."""
+    metrics.active_tasks.inc()
+    try:
+        with pytest.raises(RuntimeError):
+            replay(str(tmp_path / "bundle"))
+    finally:
+        metrics.active_tasks.dec()
@@ -0,0 +1,113 @@
+import json
+
+import pytest
+import requests
+import urllib3
+from tenacity import (
+    RetryError,
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_none,
+)
+
+from surfpizza.retry import (
+    ActionError,
+    ErrorKind,
+    ParseError,
+    RetryStats,
+    classify_error,
+    is_undelivered,
+    record_retry,
+    retry_stats,
+)
+
+
+def http_error(status: int) -> requests.HTTPError:
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(response=response)
+
+
+def test_classify_error():
+    """Test that errors are sorted into how they should be retried."""
+    assert classify_error(ParseError("bad")) == ErrorKind.PARSE
+    assert classify_error(json.JSONDecodeError("bad", "", 0)) == ErrorKind.PARSE
+    assert classify_error(ActionError("bad")) == ErrorKind.ACTION
+    assert classify_error(requests.ConnectionError()) == ErrorKind.TRANSPORT
+    assert classify_error(http_error(503)) == ErrorKind.TRANSPORT
+    assert classify_error(http_error(404)) == ErrorKind.OTHER
+    assert classify_error(ValueError("bad")) == ErrorKind.OTHER
+
+
+def test_is_undelivered():
+    """Test that only errors from before a request reached the server count as undelivered."""
+    refused = urllib3.exceptions.NewConnectionError(None, "refused")  # type: ignore
+    assert is_undelivered(
+        requests.ConnectionError(
+            urllib3.exceptions.MaxRetryError(None, "/v1/click", reason=refused)  # type: ignore
+        )
+    )
+    assert is_undelivered(requests.ConnectTimeout())
+    assert is_undelivered(http_error(503))
+    assert not is_undelivered(requests.ReadTimeout())
+    assert not is_undelivered(requests.ConnectionError("connection reset"))
+    assert not is_undelivered(http_error(500))
+    assert not is_undelivered(http_error(504))
+
+
+def test_record_retry_counts_transport_retries():
+    """Test that the tenacity hook records retries by kind."""
+    before = retry_stats.stats()["transport"]["retries"]
+    calls = []
+
+    @retry(
+        retry=retry_if_exception(lambda e: True),
+        wait=wait_none(),
+        stop=stop_after_attempt(3),
+        before_sleep=record_retry,
+    )
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise requests.ConnectionError()
+        return "ok"
+
+    assert flaky() == "ok"
+    assert retry_stats.stats()["transport"]["retries"] == before + 2
+
+
+def test_retry_stats():
+    """Test that retry costs accumulate."""
+    stats = RetryStats()
+    stats.record(ErrorKind.PARSE, 1.5, llm_calls=1)
+    stats.record(ErrorKind.PARSE, 0.5, llm_calls=1)
+    assert stats.stats()["parse"] == {"retries": 2, "seconds": 2.0, "llm_calls": 2}
+    assert stats.stats()["action"]["retries"] == 0
+
+
+def test_classify_router_errors(monkeypatch):
+    """Test that errors the router raises once it gives up are classified by their cause."""
+    import litellm
+    from mllm import RoleThread, Router
+    from skillpacks.server.models import V1ActionSelection
+
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    router = Router("gpt-4o")
+    thread = RoleThread()
+    thread.post("user", "select an action")
+
+    router.router.completion = lambda model, messages, **kwargs: litellm.completion(  # type: ignore
+        model=model, messages=messages, mock_response="not json"
+    )
+    with pytest.raises(RetryError) as bad_json:
+        router.chat(thread, expect=V1ActionSelection, retries=1)
+    assert classify_error(bad_json.value) == ErrorKind.PARSE
+
+    def rate_limited(model, messages, **kwargs):
+        raise litellm.RateLimitError("slow down", llm_provider="openai", model=model)
+
+    router.router.completion = rate_limited  # type: ignore
+    with pytest.raises(RetryError) as limited:
+        router.chat(thread, expect=V1ActionSelection, retries=1)
+    assert classify_error(limited.value) == ErrorKind.TRANSPORT
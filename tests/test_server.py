@@ -0,0 +1,98 @@
+import asyncio
+import threading
+import time
+
+import httpx
+import pytest
+
+import surfpizza.server as server
+from surfpizza.agent import SurfPizza
+from surfpizza.startup import StartupTimer
+
+
+@pytest.fixture(autouse=True)
+def fresh_startup(monkeypatch):
+    """Every test starts from a server that hasn't loaded the agent yet."""
+    monkeypatch.setattr(server, "startup_timer", StartupTimer())
+    monkeypatch.setattr(server, "_agent_ready", threading.Event())
+
+
+def client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=server.app), base_url="http://test"  # type: ignore
+    )
+
+
+def test_lazy_startup_holds_requests_until_ready(monkeypatch):
+    """Test that the port answers while the agent loads and other requests wait for it."""
+    monkeypatch.setattr(SurfPizza, "init", classmethod(lambda cls: None))
+    loading = threading.Event()
+    load_agent = server.load_agent
+
+    def slow_load_agent(app):
+        loading.wait(10)
+        load_agent(app)
+
+    monkeypatch.setattr(server, "load_agent", slow_load_agent)
+
+    async def run():
+        async with server.lifespan(server.app), client() as c:
+            health = await c.get("/health")
+            assert health.status_code == 503
+            assert health.json() == {"status": "starting"}
+            assert (await c.get("/startup")).json()["ready"] is False
+            assert (await c.get("/metrics")).status_code == 200
+
+            # Held until the agent is loaded, then handled by the app
+            threading.Timer(0.2, loading.set).start()
+            start = time.time()
+            assert (await c.get("/no-such-route")).status_code == 404
+            assert time.time() - start >= 0.2
+
+            assert (await c.get("/health")).json() == {"status": "ok"}
+            startup = (await c.get("/startup")).json()
+            assert startup["ready"] is True and startup["error"] is None
+            assert startup["timings"]["import_agent"] is not None
+
+    asyncio.run(run())
+
+
+def test_requests_time_out_while_starting(monkeypatch):
+    """Test that a request held for longer than the startup wait is answered with a 503."""
+    monkeypatch.setattr(server, "STARTUP_WAIT_TIMEOUT", 0.1)
+
+    # Without the lifespan the agent never loads
+    async def run():
+        async with client() as c:
+            response = await c.get("/no-such-route")
+            assert response.status_code == 503
+            assert response.json() == {"status": "starting"}
+
+    asyncio.run(run())
+
+
+def test_failed_startup_is_reported(monkeypatch):
+    """Test that an agent that fails to load is reported as failed and requests fail fast."""
+
+    def init(cls):
+        raise RuntimeError("no model keys")
+
+    monkeypatch.setattr(SurfPizza, "init", classmethod(init))
+    monkeypatch.setattr(server, "STARTUP_WAIT_TIMEOUT", 60)
+
+    async def run():
+        async with server.lifespan(server.app), client() as c:
+            assert await asyncio.to_thread(server._agent_ready.wait, 10)
+
+            health = await c.get("/health")
+            assert health.status_code == 503
+            assert health.json() == {"status": "failed", "error": "no model keys"}
+
+            start = time.time()
+            response = await c.get("/no-such-route")
+            assert response.status_code == 500
+            assert response.json()["status"] == "failed"
+            assert time.time() - start < 5
+            assert (await c.get("/startup")).json()["error"] == "no model keys"
+
+    asyncio.run(run())
@@ -0,0 +1,119 @@
+import os
+from io import BytesIO
+
+from PIL import Image
+
+from surfpizza.img import image_hash
+from surfpizza.store import ImageStore
+
+
+def test_store_dedupes_by_content(tmp_path):
+    """Test that identical images are written once and every save is recorded in the manifest."""
+    store = ImageStore(str(tmp_path))
+    img = Image.new("RGB", (32, 32), "red")
+
+    digest = store.put(img, "task-1", "click_1_current_0", depth=0)
+    assert store.put(img.copy(), "task-1", "click_2_current_0", depth=0) == digest
+    assert store.put(img, "task-2", "action_1") == digest
+    assert digest == image_hash(img)
+
+    stats = store.stats()
+    assert stats["blobs"] == 1 and stats["writes"] == 1 and stats["hits"] == 2
+
+    manifest = store.manifest("task-1")
+    assert [e["name"] for e in manifest] == ["click_1_current_0", "click_2_current_0"]
+    assert manifest[0]["depth"] == 0
+    assert store.manifest("missing") == []
+
+    loaded = store.get(digest)
+    assert loaded is not None and image_hash(loaded) == digest
+
+
+def test_store_evicts_least_recently_used(tmp_path):
+    """Test that the blobs are kept under the quota by evicting the least recently used."""
+    imgs = [Image.effect_noise((64, 64), 50 + i).convert("RGB") for i in range(3)]
+    store = ImageStore(str(tmp_path), quota_bytes=1)
+    size = os.path.getsize(store.path(store.put(imgs[0], "t", "a")))  # type: ignore
+    store.quota_bytes = size * 2 + size // 2
+
+    store.put(imgs[1], "t", "b")
+    store.put(imgs[0], "t", "a again")
+    store.put(imgs[2], "t", "c")
+
+    assert store.get(image_hash(imgs[1])) is None
+    assert store.get(image_hash(imgs[0])) is not None
+    assert store.stats()["evictions"] == 1
+
+    # The index is rebuilt from disk
+    reopened = ImageStore(str(tmp_path), quota_bytes=store.quota_bytes)
+    assert reopened.stats()["blobs"] == 2
+
+
+def test_store_compact_formats(tmp_path):
+    """Test that blobs can be written in compact formats."""
+    img = Image.new("RGBA", (16, 16), (255, 0, 0, 128))
+
+    webp = ImageStore(str(tmp_path / "webp"), image_format="webp")
+    path = webp.path(webp.put(img, "t", "a"))
+    assert path is not None and path.endswith(".webp")
+    assert image_hash(webp.get(image_hash(img))) == image_hash(img)  # type: ignore
+
+    jpeg = ImageStore(str(tmp_path / "jpeg"), image_format="jpeg", quality=50)
+    path = jpeg.path(jpeg.put(img, "t", "a"))
+    assert path is not None and path.endswith(".jpg")
+
+
+def test_store_prunes_manifests_with_blobs(tmp_path):
+    """Test that manifests count against the quota and those of old tasks are evicted."""
+    img = Image.new("RGB", (8, 8), "red")
+    store = ImageStore(str(tmp_path), quota_bytes=10**6)
+    blob = os.path.getsize(store.path(store.put(img, "task-0", "a")))  # type: ignore
+    manifest = os.path.getsize(os.path.join(store.manifest_dir, "task-0.jsonl"))
+    assert store.stats()["bytes"] == blob + manifest
+
+    store.quota_bytes = blob + 3 * manifest + manifest // 2
+    for i in range(1, 5):
+        store.put(img, f"task-{i}", "a")
+
+    # The shared blob is in use, the oldest manifests go instead
+    assert store.stats()["blobs"] == 1 and store.stats()["manifests"] == 3
+    assert store.manifest("task-0") == [] and store.manifest("task-1") == []
+    assert [e["name"] for e in store.manifest("task-4")] == ["a"]
+
+    reopened = ImageStore(str(tmp_path), quota_bytes=store.quota_bytes)
+    assert reopened.stats()["bytes"] == store.stats()["bytes"]
+
+
+def test_store_keeps_recent_temp_files(tmp_path):
+    """Test that only temporary files left over from a crash are removed on load."""
+    ImageStore(str(tmp_path))
+    blob_dir = tmp_path / "blobs" / "ab"
+    blob_dir.mkdir()
+    writing = blob_dir / "abcd.png.1.tmp"
+    stale = blob_dir / "abef.png.1.tmp"
+    writing.write_bytes(b"partial")
+    stale.write_bytes(b"partial")
+    os.utime(stale, (0, 0))
+
+    store = ImageStore(str(tmp_path))
+    assert writing.exists() and not stale.exists()
+    assert store.stats()["blobs"] == 0
+
+
+def test_store_put_encoded(tmp_path):
+    """Test that encoded images are stored as they are and dedupe with the same pixels."""
+    img = Image.new("RGB", (16, 16), "blue")
+    buffer = BytesIO()
+    img.save(buffer, format="PNG")
+    digest = image_hash(img)
+
+    store = ImageStore(str(tmp_path))
+    assert store.put_encoded(buffer.getvalue(), "t", "merged", digest=digest) == digest
+    assert store.put(img, "t", "again") == digest
+    with open(store.path(digest), "rb") as f:  # type: ignore
+        assert f.read() == buffer.getvalue()
+    assert store.stats()["writes"] == 1
+
+    webp = ImageStore(str(tmp_path / "webp"), image_format="webp")
+    webp.put_encoded(buffer.getvalue(), "t", "merged", digest=digest)
+    assert image_hash(webp.get(digest).convert("RGB")) == digest  # type: ignore
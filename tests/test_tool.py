@@ -0,0 +1,344 @@
+import base64
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image
+from toolfuse import Tool
+
+import surfpizza.tool as tool
+from surfpizza import metrics
+from surfpizza.img import Box, image_to_b64
+from surfpizza.tool import MultiZoomSelection, SemanticDesktop, ZoomSelection
+
+
+class FakeDesktop(Tool):
+    """Stands in for a desktop, returning the same screenshot."""
+
+    base_url = "http://desktop"
+
+    def take_screenshots(self):
+        return [Image.new("RGB", (270, 270), "white")]
+
+
+@pytest.fixture(autouse=True)
+def no_click_verify(monkeypatch):
+    """Clicks are stubbed out in these tests so the screen never changes, only verify when asked."""
+    monkeypatch.setenv("CLICK_VERIFY", "off")
+
+
+class FakeTask:
+    """Stands in for a task, dropping messages and prompts."""
+
+    id = "task-1"
+
+    def post_message(self, *args, **kwargs):
+        pass
+
+    def add_prompt(self, prompt):
+        pass
+
+
+class FakeRouter:
+    """Stands in for the router, answering zoom requests from a script."""
+
+    def __init__(self, answers: list):
+        self.answers = answers
+        self.calls = []
+
+    def chat(self, thread, namespace, expect, agent_id):
+        self.calls.append(expect)
+        answer = self.answers.pop(0)
+        parsed = (
+            ZoomSelection(number=answer)
+            if expect is ZoomSelection
+            else MultiZoomSelection(numbers=answer)
+        )
+        return SimpleNamespace(parsed=parsed, prompt=None)
+
+
+def test_click_objects_grounds_targets_together(tmp_path, monkeypatch):
+    """Test that targets in the same cell share zoom requests until they split up."""
+    monkeypatch.setenv("MAX_DEPTH", "3")
+    monkeypatch.setenv("NUM_CELLS", "3")
+    router = FakeRouter([[0, 0, 4], [0, 8], 4, 4, 4, 4])
+    monkeypatch.setattr(tool, "get_router", lambda: router)
+
+    semdesk = SemanticDesktop(
+        task=FakeTask(), desktop=FakeDesktop(), data_path=str(tmp_path)  # type: ignore
+    )
+    clicks = []
+    monkeypatch.setattr(
+        semdesk, "_click_coords", lambda x, y, type, button: clicks.append((x, y))
+    )
+
+    semdesk.click_objects(["name field", "email field", "submit"], type="single")
+
+    # Depth 0 grounds all three at once, then the two fields are grounded together
+    # until they split up, 6 requests instead of 9
+    assert (
+        router.calls == [MultiZoomSelection, MultiZoomSelection] + [ZoomSelection] * 4
+    )
+    assert clicks == [(15, 15), (75, 75), (135, 135)]
+
+
+def test_click_object_reuses_zoom_levels_of_unchanged_screen(tmp_path, monkeypatch):
+    """Test that zoom levels built for a screenshot are reused until the screen changes."""
+    monkeypatch.setenv("MAX_DEPTH", "2")
+    monkeypatch.setenv("NUM_CELLS", "3")
+    router = FakeRouter([4, 0, 4, 8])
+    monkeypatch.setattr(tool, "get_router", lambda: router)
+
+    semdesk = SemanticDesktop(
+        task=FakeTask(), desktop=FakeDesktop(), data_path=str(tmp_path)  # type: ignore
+    )
+    monkeypatch.setattr(semdesk, "_click_coords", lambda x, y, type, button: None)
+
+    semdesk.click_object("first", type="single")
+    tree = semdesk.zoom_trees.get(
+        FakeDesktop().take_screenshots()[0], 3, aspect_aware=True
+    )
+    assert (tree.hits, tree.misses) == (0, 2)
+
+    # The same screen again reuses both levels, only the final cells differ
+    semdesk.click_object("second", type="single")
+    assert (tree.hits, tree.misses) == (2, 2)
+    assert len(tree) == 1 + 9 + 9
+
+    # A changed screen gets a new tree
+    monkeypatch.setattr(
+        FakeDesktop,
+        "take_screenshots",
+        lambda self: [Image.new("RGB", (270, 270), "black")],
+    )
+    router.answers = [0, 0]
+    semdesk.click_object("third", type="single")
+    assert (
+        semdesk.zoom_trees.get(
+            Image.new("RGB", (270, 270), "black"), 3, aspect_aware=True
+        )
+        is not tree
+    )
+
+
+def test_click_object_stops_zooming_at_min_size(tmp_path, monkeypatch):
+    """Test that cells at or below the min zoom size aren't zoomed into further."""
+    monkeypatch.setenv("MAX_DEPTH", "3")
+    monkeypatch.setenv("NUM_CELLS", "3")
+    monkeypatch.setenv("MIN_ZOOM_SIZE", "30")
+    router = FakeRouter([4, 4])
+    monkeypatch.setattr(tool, "get_router", lambda: router)
+
+    semdesk = SemanticDesktop(
+        task=FakeTask(), desktop=FakeDesktop(), data_path=str(tmp_path)  # type: ignore
+    )
+    clicks = []
+    monkeypatch.setattr(
+        semdesk, "_click_coords", lambda x, y, type, button: clicks.append((x, y))
+    )
+
+    semdesk.click_object("target", type="single")
+    assert len(router.calls) == 2
+    assert clicks == [(135, 135)]
+
+
+class FakeLocator:
+    """Stands in for OCR, finding text at fixed boxes."""
+
+    available = True
+
+    def __init__(self, boxes: list):
+        self.boxes = boxes
+
+    def find(self, img, text, digest=None):
+        return [SimpleNamespace(text=text, box=box) for box in self.boxes]
+
+
+def test_click_object_uses_ocr_matches(tmp_path, monkeypatch):
+    """Test that quoted text found by OCR skips zooming, and several candidates take one request."""
+    monkeypatch.setenv("MAX_DEPTH", "3")
+    router = FakeRouter([1])
+    monkeypatch.setattr(tool, "get_router", lambda: router)
+
+    semdesk = SemanticDesktop(
+        task=FakeTask(), desktop=FakeDesktop(), data_path=str(tmp_path)  # type: ignore
+    )
+    clicks = []
+    monkeypatch.setattr(
+        semdesk, "_click_coords", lambda x, y, type, button: clicks.append((x, y))
+    )
+
+    semdesk.ocr = FakeLocator([Box(10, 10, 50, 30)])  # type: ignore
+    semdesk.click_object("the link with the text 'Home'", type="single")
+    assert router.calls == []
+
+    semdesk.ocr = FakeLocator([Box(10, 10, 50, 30), Box(100, 200, 140, 220)])  # type: ignore
+    semdesk.click_object("the link with the text 'Home'", type="single")
+    assert router.calls == [ZoomSelection]
+
+    assert clicks == [(30, 20), (120, 210)]
+
+    # A quoted label isn't the field, so the field is found by zooming
+    semdesk.ocr = FakeLocator([Box(10, 10, 50, 30)])  # type: ignore
+    router.answers = [4, 4, 4]
+    semdesk.click_object("the text field labelled 'Email'", type="single")
+    assert len(router.calls) == 4
+    assert clicks[-1] != (30, 20)
+
+
+class ChangingDesktop(FakeDesktop):
+    """Stands in for a desktop whose screen changes once the mouse is clicked."""
+
+    def __init__(self):
+        super().__init__()
+        self.clicked = False
+
+    def take_screenshots(self):
+        return [Image.new("RGB", (270, 270), "black" if self.clicked else "white")]
+
+
+def test_click_verification(tmp_path, monkeypatch):
+    """Test that a click that changes nothing is refined and made again, and one that does isn't."""
+    monkeypatch.setenv("MAX_DEPTH", "3")
+    monkeypatch.setenv("NUM_CELLS", "3")
+    monkeypatch.setenv("CLICK_VERIFY", "refine")
+    router = FakeRouter([4, 4, 4, 4])
+    monkeypatch.setattr(tool, "get_router", lambda: router)
+
+    desktop = ChangingDesktop()
+    semdesk = SemanticDesktop(
+        task=FakeTask(), desktop=desktop, data_path=str(tmp_path)  # type: ignore
+    )
+    clicks = []
+    monkeypatch.setattr(
+        semdesk, "_click_coords", lambda x, y, type, button: clicks.append((x, y))
+    )
+
+    # The screen doesn't change, the final 10px cell is zoomed into once more
+    semdesk.click_object("target", type="single")
+    assert len(router.calls) == 4
+    assert clicks == [(135, 135), (134, 134)]
+
+    # Clicking the same point again takes no request
+    monkeypatch.setenv("CLICK_VERIFY", "reclick")
+    router.answers = [4, 4, 4]
+    clicks.clear()
+    semdesk.click_object("target", type="single")
+    assert clicks == [(135, 135), (135, 135)]
+
+    # A click that changes the screen is left alone
+    def click(x, y, type, button):
+        clicks.append((x, y))
+        desktop.clicked = True
+
+    monkeypatch.setattr(semdesk, "_click_coords", click)
+    router.answers = [4, 4, 4]
+    clicks.clear()
+    semdesk.click_object("target", type="single")
+    assert clicks == [(135, 135)]
+
+    # Each click is compared with the screen right before it, not the one the targets
+    # were found in, so the second click is caught changing nothing
+    desktop.clicked = False
+    router.answers = [[0, 4], 4, 4, 4, 4]
+    clicks.clear()
+    semdesk.click_objects(["first", "second"], type="single")
+    assert clicks == [(45, 45), (135, 135), (135, 135)]
+
+
+def test_click_verification_survives_failed_refinement(tmp_path, monkeypatch):
+    """Test that a click isn't failed, or made again, when refining it fails."""
+    monkeypatch.setenv("MAX_DEPTH", "3")
+    monkeypatch.setenv("NUM_CELLS", "3")
+    monkeypatch.setenv("CLICK_VERIFY", "refine")
+    monkeypatch.setenv("ZOOM_RETRIES", "0")
+    router = FakeRouter([4, 4, 4])
+    monkeypatch.setattr(tool, "get_router", lambda: router)
+
+    semdesk = SemanticDesktop(
+        task=FakeTask(), desktop=FakeDesktop(), data_path=str(tmp_path)  # type: ignore
+    )
+    clicks = []
+    monkeypatch.setattr(
+        semdesk, "_click_coords", lambda x, y, type, button: clicks.append((x, y))
+    )
+
+    # The refinement request finds no answer left and fails
+    semdesk.click_object("target", type="single")
+    assert len(router.calls) == 4
+    assert clicks == [(135, 135)]
+
+
+def test_click_retries_input_not_grounding(tmp_path, monkeypatch):
+    """Test that a click that never reached the desktop is sent again without finding the target again."""
+    import requests
+    import urllib3
+
+    monkeypatch.setenv("MAX_DEPTH", "1")
+    monkeypatch.setenv("CLICK_SETTLE_SECONDS", "0")
+    router = FakeRouter([4])
+    monkeypatch.setattr(tool, "get_router", lambda: router)
+
+    semdesk = SemanticDesktop(
+        task=FakeTask(), desktop=FakeDesktop(), data_path=str(tmp_path)  # type: ignore
+    )
+    posts = []
+
+    def post(url, json):
+        posts.append(url)
+        if len(posts) == 2:
+            refused = urllib3.exceptions.NewConnectionError(None, "refused")  # type: ignore
+            raise requests.ConnectionError(
+                urllib3.exceptions.MaxRetryError(None, url, reason=refused)  # type: ignore
+            )
+        return SimpleNamespace(raise_for_status=lambda: None)
+
+    monkeypatch.setattr(semdesk.session, "post", post)
+
+    semdesk.click_object("target", type="single")
+    assert len(router.calls) == 1
+    assert posts == [
+        "http://desktop/v1/move_mouse",
+        "http://desktop/v1/click",
+        "http://desktop/v1/click",
+    ]
+
+
+def test_click_not_resent_after_timeout(tmp_path, monkeypatch):
+    """Test that a click that timed out isn't sent again, the desktop may already have made it."""
+    import requests
+
+    monkeypatch.setenv("MAX_DEPTH", "1")
+    monkeypatch.setenv("CLICK_SETTLE_SECONDS", "0")
+    monkeypatch.setattr(tool, "get_router", lambda: FakeRouter([4]))
+
+    semdesk = SemanticDesktop(
+        task=FakeTask(), desktop=FakeDesktop(), data_path=str(tmp_path)  # type: ignore
+    )
+    posts = []
+
+    def post(url, json):
+        posts.append(url)
+        if url.endswith("/v1/click"):
+            raise requests.ReadTimeout("slow")
+        return SimpleNamespace(raise_for_status=lambda: None)
+
+    monkeypatch.setattr(semdesk.session, "post", post)
+
+    with pytest.raises(requests.ReadTimeout):
+        semdesk.click_object("target", type="single")
+    assert posts == ["http://desktop/v1/move_mouse", "http://desktop/v1/click"]
+
+
+def test_debug_images_are_counted(tmp_path):
+    """Test that images posted to the debug thread count towards the bytes uploaded."""
+    semdesk = SemanticDesktop(
+        task=FakeTask(), desktop=FakeDesktop(), data_path=str(tmp_path)  # type: ignore
+    )
+    img = Image.effect_noise((64, 64), 40).convert("RGB")
+    uri = image_to_b64(img)
+    before = metrics.image_bytes_uploaded.value(kind="debug")
+
+    semdesk.post_debug("a screenshot", [uri, uri])
+
+    png = base64.b64decode(uri.split(",")[1])
+    assert metrics.image_bytes_uploaded.value(kind="debug") - before == 2 * len(png)
@@ -0,0 +1,54 @@
+import os
+import signal
+from io import BytesIO
+
+from PIL import Image
+
+from surfpizza.img import divide_image_into_cells, image_hash
+from surfpizza.workers import ImageWorkerPool, cpu_limit
+
+
+def test_worker_pool_matches_in_process():
+    """Test that composites and encodings built in the workers match those built in-process."""
+    img = Image.effect_noise((90, 60), 40).convert("RGB")
+    composite, _, _ = divide_image_into_cells(img, 3, rows=2)
+
+    workers = ImageWorkerPool(1)
+    try:
+        digest, png = workers.render_composite(img, 3, rows=2)
+        encoded = workers.encode(img)
+    finally:
+        workers.close()
+
+    assert digest == image_hash(composite)
+    assert image_hash(Image.open(BytesIO(png))) == digest
+    assert image_hash(Image.open(BytesIO(encoded)).convert("RGB")) == image_hash(img)
+
+
+def test_cpu_limit():
+    """Test that at least one CPU is always available."""
+    assert cpu_limit() >= 1
+
+
+def test_worker_pool_recovers_from_dead_worker():
+    """Test that the pool restarts after a worker dies, doing the failed work in-process."""
+    img = Image.effect_noise((40, 30), 40).convert("RGB")
+
+    workers = ImageWorkerPool(1)
+    try:
+        workers.encode(img)
+        for process in list(workers._executor._processes.values()):  # type: ignore
+            os.kill(process.pid, signal.SIGKILL)
+            process.join()
+
+        encoded = workers.encode(img)
+        assert workers.restarts == 1
+        assert image_hash(Image.open(BytesIO(encoded)).convert("RGB")) == image_hash(
+            img
+        )
+
+        # The restarted pool is used for the next call
+        assert workers.render_composite(img, 2)[0]
+        assert workers.restarts == 1
+    finally:
+        workers.close()